@@ -31,10 +31,6 @@ class CacheRequestMiddleware:
         self.process_request(request)
         response = self.get_response(request)
 
-        # All lru objects cleared
-        from sales.models.catalog import Catalog
-        Catalog().get_full_ancestor.cache_clear()
-
         # Code to be executed for each request/response after
         # the view is called.
 
@@ -1,7 +1,13 @@
+import hashlib
+
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.contrib.postgres.fields import ArrayField
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 
 from api.models import BaseModel, CompanyBuilder
 
@@ -54,6 +60,52 @@ class FileBuilder365(BaseModel):
     task_id = models.CharField(max_length=128, blank=True)
 
 
+class DocumentSnapshot(models.Model):
+    """
+    Rendered document shown to clients (formatting of a proposal, template of an invoice), served with
+    one indexed read until it is invalidated by a change of what it was rendered from
+    """
+    class Meta:
+        db_table = 'document_snapshot'
+
+    key = models.CharField(max_length=128, unique=True)
+    company = models.ForeignKey(CompanyBuilder, on_delete=models.CASCADE, null=True, blank=True,
+                                related_name='document_snapshots')
+    content = models.TextField(blank=True)
+    content_type = models.CharField(max_length=64, default='application/json')
+    etag = models.CharField(max_length=64, blank=True)
+    modified_date = models.DateTimeField(auto_now=True)
+    # PDF rendered from this version of the document by the workers
+    pdf = models.ForeignKey(FileBuilder365, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    @classmethod
+    def store(cls, key, content, company=None, content_type='application/json', save=True):
+        """Store the document under ``key``, drafts are not saved and only get an unsaved snapshot to serve"""
+        if isinstance(content, bytes):
+            content = content.decode()
+        values = {'content': content, 'company': company, 'content_type': content_type,
+                  'etag': hashlib.md5(content.encode()).hexdigest(), 'pdf': None}
+        if not save:
+            return cls(key=key, modified_date=timezone.now(), **values)
+        snapshot, _ = cls.objects.update_or_create(key=key, defaults=values)
+        return snapshot
+
+    @classmethod
+    def invalidate(cls, *keys):
+        cls.objects.filter(key__in=keys).delete()
+
+    def get_response(self, request, status=200):
+        """The document, or 304 when the ETag or the Last-Modified date sent by the client is current"""
+        etag = quote_etag(self.etag)
+        last_modified = int(self.modified_date.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = HttpResponse(self.content, content_type=self.content_type, status=status)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
+
+
 class Type(models.TextChoices):
     TEXT = 'text', 'TEXT'
     CHOICE = 'choice', 'CHOICE'
@@ -1,25 +1,36 @@
+import shutil
+import subprocess
+import tempfile
+import uuid
 import zipfile
+from collections import defaultdict
 from datetime import datetime, timedelta
-from io import BytesIO
+from itertools import islice
 
-from celery import shared_task, current_task
+from celery import chord, group, shared_task, current_task
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.mail import send_mail, EmailMessage
 from django.http import HttpRequest
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Prefetch
 from django.apps import apps
 from django.utils import timezone
+from django.utils.module_loading import import_string
 from openpyxl.workbook import Workbook
 from openpyxl.reader.excel import load_workbook
 
-from api.middleware import set_request
+from api.middleware import get_request, set_request
 from api.models import ActivityLog, CompanyBuilder
-from base.models.config import FileBuilder365
-from base.utils import str_to_class
-from base.constants import null, true, false
-from sales.models import Catalog, UnitLibrary, CatalogLevel, DataPoint, ScheduleEvent, ReminderType, TypeTime, Contact
+from base.models.config import DocumentSnapshot, FileBuilder365
+from base.utils import parse_literal, str_to_class
+from sales.models import Catalog, CatalogClosure, CostTableRow, UnitLibrary, CatalogLevel, DataPoint, ScheduleEvent, ReminderType, \
+    TypeTime, Contact
+from sales.models.catalog import invalidate_ancestors, invalidate_material_levels
 
 
 @shared_task()
@@ -46,77 +57,131 @@ def process_export_catalog(pk, company, user_id):
             data_parent_catalog = check_catalog.parents.first()
             handle_export(pk, workbook, data_parent_catalog.name)
 
-    bytes_io = BytesIO()
-    workbook.save(bytes_io)
-    bytes_io.seek(0)
     current_datetime = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"catalog_{current_datetime}.xlsx"
-    handle_save_file(bytes_io, filename, user_id, task_id)
+    with tempfile.TemporaryFile() as file:
+        workbook.save(file)
+        file.seek(0)
+        handle_save_file(file, filename, user_id, task_id)
+
+
+EXPORT_CHUNK_SIZE = 20
+
+
+def write_proposal_workbook(proposal, file):
+    """
+    Write the formulas, data entries and data views of a proposal into ``file`` with a write-only workbook,
+    rows are streamed to disk. Related data is loaded in four queries.
+    """
+    DataView = apps.get_model('sales', 'DataView')
+    POFormula = apps.get_model('sales', 'POFormula')
+    POFormulaToDataEntry = apps.get_model('sales', 'POFormulaToDataEntry')
+    estimates = list(proposal.get_estimates().prefetch_related(
+        Prefetch('data_views', queryset=DataView.objects.select_related('unit')),
+        Prefetch('data_entries', queryset=POFormulaToDataEntry.objects.select_related('data_entry__unit'))
+    ))
+    formulas = defaultdict(list)
+    for formula in POFormula.objects.filter(assemble__estimate_templates__in=estimates).annotate(
+            estimate_id=F('assemble__estimate_templates')):
+        formulas[formula.estimate_id].append(formula)
+
+    wb = Workbook(write_only=True)
+    formula_sheet = wb.create_sheet('Formula')
+    data_entry_sheet = wb.create_sheet('Data Entry')
+    data_view_sheet = wb.create_sheet('Data View')
+    formula_sheet.append(['Estimate', 'Formula', 'Material', 'Quantity', 'Unit', 'Unit Cost',
+                          'Total Cost', 'Markup', 'Margin', 'Charge'])
+    data_view_sheet.append(['Estimate', 'Name', 'Unit', 'Price'])
+    data_entry_sheet.append(['Estimate', 'Name', 'Unit', 'Value'])
+    for estimate in estimates:
+        # formula sheet
+        for formula in formulas[estimate.pk]:
+            material = formula.material or "{}"
+            formula_sheet.append(
+                [estimate.name, formula.name, parse_literal(material).get('name'), formula.quantity,
+                 formula.unit, formula.unit_price, formula.total_cost, formula.markup, formula.margin,
+                 formula.charge])
+
+        # Data view
+        for data_view in estimate.data_views.all():
+            unit = data_view.unit.name if data_view.unit else None
+            data_view_sheet.append([estimate.name, data_view.name, unit, data_view.result])
+
+        for data_entry in estimate.data_entries.all():
+            data_entry_sheet.append([estimate.name, data_entry.data_entry.name,
+                                     data_entry.get_unit(), data_entry.get_value()])
+    wb.save(file)
+
+
+def write_proposals_zip(proposal_ids, file):
+    """Write a workbook per proposal into a zip, one workbook at a time through a temporary file"""
+    ProposalWriting = apps.get_model('sales', 'ProposalWriting')
+    proposals = {proposal.pk: proposal for proposal in ProposalWriting.objects.filter(pk__in=proposal_ids)}
+    with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for pk in proposal_ids:
+            proposal = proposals[int(pk)]
+            with tempfile.TemporaryFile() as workbook:
+                write_proposal_workbook(proposal, workbook)
+                workbook.seek(0)
+                with zipf.open(f'{proposal.name}.xlsx', 'w') as entry:
+                    shutil.copyfileobj(workbook, entry)
+
+
+def start_export_proposal(list_proposal, user_id):
+    """
+    Export proposals in background, return the AsyncResult of the task saving the file.
+    Large batches are split in chunks exported by several workers, then merged into one zip.
+    """
+    if len(list_proposal) <= EXPORT_CHUNK_SIZE:
+        return export_proposal.delay(list_proposal=list_proposal, user_id=user_id)
+    chunks = [list_proposal[i:i + EXPORT_CHUNK_SIZE] for i in range(0, len(list_proposal), EXPORT_CHUNK_SIZE)]
+    return chord(export_proposal_chunk.s(chunk) for chunk in chunks)(merge_proposal_exports.s(user_id))
 
 
 @shared_task()
 def export_proposal(list_proposal, user_id):
-    zip_bytes = BytesIO()
-    rs = []
     task_id = current_task.request.id
-    for proposal in list_proposal:
-        wb = Workbook()
-        formula_sheet = wb.create_sheet('Formula')
-        data_entry_sheet = wb.create_sheet('Data Entry')
-        data_view_sheet = wb.create_sheet('Data View')
-        ProposalWriting = apps.get_model('sales', 'ProposalWriting')
-        proposal = ProposalWriting.objects.get(pk=proposal)
-        estimates = proposal.get_estimates()
-        formula_sheet.append(['Estimate', 'Formula', 'Material', 'Quantity', 'Unit', 'Unit Cost',
-                              'Total Cost', 'Markup', 'Margin', 'Charge'])
-        data_view_sheet.append(['Estimate', 'Name', 'Unit', 'Price'])
-        data_entry_sheet.append(['Estimate', 'Name', 'Unit', 'Value'])
-        for estimate in estimates:
-            # formula sheet
-            formulas = estimate.get_formula()
-            for formula in formulas:
-                material = formula.material or "{}"
-                formula_sheet.append(
-                    [estimate.name, formula.name, eval(material).get('name'), formula.quantity,
-                     formula.unit, formula.unit_price, formula.total_cost, formula.markup, formula.margin,
-                     formula.charge])
-
-            # Data view
-            for data_view in estimate.data_views.all():
-                unit = data_view.unit.name if data_view.unit else None
-                data_view_sheet.append([estimate.name, data_view.name, unit, data_view.result])
-
-            for data_entry in estimate.data_entries.all():
-                data_entry_sheet.append([estimate.name, data_entry.data_entry.name,
-                                         data_entry.get_unit(), data_entry.get_value()])
-
-        default_sheet = wb.active
-        wb.remove(default_sheet)
-        bytes_io = BytesIO()
-        wb.save(bytes_io)
-        bytes_io.seek(0)
-        temp = {'proposal_name': proposal.name, 'work_book': bytes_io}
-        rs.append(temp)
-
-    if len(rs) > 1:
-        with zipfile.ZipFile(zip_bytes, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for data in rs:
-                name = data['proposal_name']
-                zipf.writestr(f'{name}.xlsx', data['work_book'].getvalue())
-
-        zip_bytes.seek(0)
-        current_datetime = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"proposal_{current_datetime}.zip"
-        handle_save_file(zip_bytes, filename, user_id, task_id)
+    with tempfile.TemporaryFile() as file:
+        if len(list_proposal) > 1:
+            write_proposals_zip(list_proposal, file)
+            current_datetime = datetime.now().strftime("%Y%m%d_%H%M%S")
+            filename = f"proposal_{current_datetime}.zip"
+        else:
+            ProposalWriting = apps.get_model('sales', 'ProposalWriting')
+            proposal = ProposalWriting.objects.get(pk=list_proposal[0])
+            write_proposal_workbook(proposal, file)
+            filename = f"{proposal.name}.xlsx"
+        handle_save_file(file, filename, user_id, task_id)
 
-    else:
-        proposal_name = rs[0]['proposal_name']
-        file_name = f"{proposal_name}.xlsx"
-        handle_save_file(rs[0]['work_book'], file_name, user_id, task_id)
+
+@shared_task()
+def export_proposal_chunk(list_proposal):
+    """Export a chunk of proposals to a zip in the storage, shared by workers. Return its name"""
+    with tempfile.TemporaryFile() as file:
+        write_proposals_zip(list_proposal, file)
+        file.seek(0)
+        return default_storage.save(f'exports/tmp/{uuid.uuid4()}.zip', File(file, name='export.zip'))
+
+
+@shared_task()
+def merge_proposal_exports(chunk_names, user_id):
+    """Copy the workbooks of the exported chunks into one zip, entry by entry"""
+    task_id = current_task.request.id
+    with tempfile.TemporaryFile() as file:
+        with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for name in chunk_names:
+                with default_storage.open(name) as chunk, zipfile.ZipFile(chunk) as chunk_zip:
+                    for info in chunk_zip.infolist():
+                        with chunk_zip.open(info) as source, zipf.open(info.filename, 'w') as entry:
+                            shutil.copyfileobj(source, entry)
+                default_storage.delete(name)
+        current_datetime = datetime.now().strftime("%Y%m%d_%H%M%S")
+        handle_save_file(file, f"proposal_{current_datetime}.zip", user_id, task_id)
 
 
 def handle_save_file(bytes_io, file_name, user_id, task_id):
-    content = ContentFile(bytes_io.read())
+    # Copied to the storage by chunks, the file can be a temporary file on disk
+    content = File(bytes_io, name=file_name)
     content.seek(0)
 
     attachment = FileBuilder365()
@@ -130,6 +195,7 @@ def handle_save_file(bytes_io, file_name, user_id, task_id):
     attachment.name = file_name
     attachment.task_id = task_id
     attachment.save()
+    return attachment
 
 
 @shared_task()
@@ -205,6 +271,88 @@ def send_mail_with_attachment(subject, body, from_email, to, attachments, bcc=No
         email.attach(attachment.name, attachment.read())
     email.send()
 
+
+# Functions (request, pk) returning the html snapshot of a document and the name of its PDF
+PDF_DOCUMENTS = {
+    'proposal': 'sales.views.proposal.get_proposal_html',
+    'invoice': 'sales.views.invoice.get_invoice_html',
+}
+
+
+def render_pdf(html, file):
+    """Render ``html`` to a PDF written into ``file`` with the headless engine of the worker, scripts of the page are run"""
+    subprocess.run([settings.WKHTMLTOPDF_CMD, '--quiet', '--print-media-type', '--javascript-delay', '500', '-', '-'],
+                   input=html.encode(), stdout=file, check=True, timeout=settings.PDF_RENDER_TIMEOUT)
+
+
+@shared_task()
+def render_document_pdf(kind, pk, user_id):
+    """
+    Render a document to PDF once: the file is kept with the snapshot of the document until the document changes.
+    Return the pk of the FileBuilder365
+    """
+    request = HttpRequest()
+    request.user = get_user_model().objects.get(pk=user_id)
+    set_request(request)
+    snapshot, file_name = import_string(PDF_DOCUMENTS[kind])(request, pk)
+    if snapshot.pdf_id:
+        return snapshot.pdf_id
+    with tempfile.TemporaryFile() as file:
+        render_pdf(snapshot.content, file)
+        attachment = handle_save_file(file, file_name, user_id, current_task.request.id if current_task else '')
+    # Not kept if the document changed while it was rendered
+    DocumentSnapshot.objects.filter(pk=snapshot.pk, etag=snapshot.etag).update(pdf=attachment)
+    return attachment.pk
+
+
+def get_document_pdf(kind, pk, user_id):
+    """
+    The FileBuilder365 of a document rendered to PDF in the current process,
+    None when it can not be rendered (no owner, failure or timeout of the engine)
+    """
+    if not user_id:
+        return None
+    request = get_request()
+    try:
+        return FileBuilder365.objects.get(pk=render_document_pdf(kind, pk, user_id))
+    except (ObjectDoesNotExist, OSError, subprocess.SubprocessError):
+        return None
+    finally:
+        set_request(request)
+
+
+def start_mail_pdfs(kind, documents, user_id, subject, body):
+    """
+    Render documents to PDF in parallel on the workers, then mail each PDF to its recipients.
+    ``documents`` is a list of (pk, emails). Return the AsyncResult of the mailing task
+    """
+    renders = group(render_document_pdf.s(kind, pk, user_id) for pk, _ in documents)
+    return chord(renders)(mail_document_pdfs.s([emails for _, emails in documents], subject, body))
+
+
+@shared_task()
+def mail_document_pdfs(file_ids, recipients, subject, body):
+    files = FileBuilder365.objects.in_bulk(file_ids)
+    for file_id, emails in zip(file_ids, recipients):
+        if not emails:
+            continue
+        attachment = files[file_id]
+        with attachment.file.open('rb') as content:
+            send_mail_with_attachment(subject, body, settings.EMAIL_HOST_USER, emails,
+                                      [File(content, name=attachment.name)])
+
+
+@shared_task()
+def mail_signed_document(kind, pk, user_id, subject, body, recipients):
+    """Mail a signed document with its PDF rendered on the worker, without attachment when it can not be rendered"""
+    attachments = []
+    pdf = get_document_pdf(kind, pk, user_id)
+    if pdf:
+        with pdf.file.open('rb') as content:
+            attachments.append(ContentFile(content.read(), name=pdf.name))
+    send_mail_with_attachment(subject, body, settings.EMAIL_HOST_USER, recipients, attachments)
+
+
 @shared_task()
 def activity_log(model, instance, action, serializer_name, base_import_file, user_id):
     """
@@ -229,6 +377,30 @@ def activity_log(model, instance, action, serializer_name, base_import_file, use
                                action=action, last_state=data, next_state={})
 
 
+@shared_task()
+def delete_catalogs_task(catalog_ids, user_id):
+    """Delete catalogs with all their descendants, deleting a large branch can run in background"""
+    from base.views.base import log_delete_action
+    request = HttpRequest()
+    request.user = get_user_model().objects.get(pk=user_id)
+    set_request(request)
+    with transaction.atomic():
+        catalogs = Catalog.objects.filter(pk__in=catalog_ids).only('pk', 'name', 'created_date')
+        log_delete_action(catalogs, ContentType.objects.get_for_model(Catalog))
+        Catalog.delete_trees(catalog_ids)
+
+
+@shared_task()
+def reprice_formulas_task(catalog_ids, dry_run=True):
+    """Re-price the formulas using materials of these catalogs after their cost table changed"""
+    from sales.calculator import reprice_formulas
+    with transaction.atomic():
+        return reprice_formulas(catalog_ids, dry_run=dry_run)
+
+
+IMPORT_CHUNK_SIZE = 1000
+
+
 @shared_task()
 def import_catalog_task(file_pk, company_pk, user_pk):
     company = CompanyBuilder.objects.get(pk=company_pk)
@@ -241,31 +413,166 @@ def import_catalog_task(file_pk, company_pk, user_pk):
         catalog_sheet = workbook[sheetname]
         parent = None
         ancestor_name, parent_name = sheetname.split('-', 1)
-        ancestor = Catalog.objects.get_or_create(name=ancestor_name, company=company, is_ancestor=True)[0]
-        try:
-            parent = ancestor.children.get(name=parent_name)
-        except Catalog.DoesNotExist:
-            parent = Catalog.objects.create(name=parent_name, company=company)
-            parent.parents.add(ancestor)
-        except Catalog.MultipleObjectsReturned:
-            parent = ancestor.children.filter(name=parent_name).first()
-
-        for row in catalog_sheet.iter_rows(min_row=0, max_row=1, values_only=True):
-            header = row
-        length_level, length_cost_table, levels, c_table_header = count_level(header, parent)
-        c_table_header = ['name', 'unit', 'cost', *c_table_header[3:]]
-
-        cost_table_cache = set()
-        unit = set()
-        for row in catalog_sheet.iter_rows(min_row=2, values_only=True):
-            unit.add(create_catalog_by_row(row, length_level, company, parent, levels, c_table_header, cost_table_cache))
-
-        unit_library = set(UnitLibrary.objects.filter(company=company).values_list('name', flat=True))
-        UnitLibrary.objects.bulk_create([UnitLibrary(name=i, company=company) for i in unit.difference(unit_library) if i])
+        with transaction.atomic():
+            ancestor = Catalog.objects.get_or_create(name=ancestor_name, company=company, is_ancestor=True)[0]
+            try:
+                parent = ancestor.children.get(name=parent_name)
+            except Catalog.DoesNotExist:
+                parent = Catalog.objects.create(name=parent_name, company=company)
+                parent.parents.add(ancestor)
+            except Catalog.MultipleObjectsReturned:
+                parent = ancestor.children.filter(name=parent_name).first()
+
+            for row in catalog_sheet.iter_rows(min_row=0, max_row=1, values_only=True):
+                header = row
+            length_level, length_cost_table, levels, c_table_header = count_level(header, parent)
+            c_table_header = ['name', 'unit', 'cost', *c_table_header[3:]]
+
+            importer = CatalogSheetImporter(parent, company, request.user, levels[:length_level], c_table_header)
+            rows = catalog_sheet.iter_rows(min_row=2, values_only=True)
+            while True:
+                chunk = list(islice(rows, IMPORT_CHUNK_SIZE))
+                if not chunk:
+                    break
+                importer.import_rows(chunk)
+                update_progress({'sheet': sheetname, 'current_sheet': idx + 1,
+                                 'total_sheets': len(workbook.sheetnames), 'rows': importer.row_count})
+            importer.finish()
     file.file.delete(save=True)
     file.delete()
 
 
+def update_progress(meta):
+    """Report progress through the celery task state, when running in a worker"""
+    if current_task and current_task.request.id:
+        current_task.update_state(state='PROGRESS', meta=meta)
+
+
+class CatalogSheetImporter:
+    """
+    Import the rows of a catalog sheet under a root catalog.
+    Existing catalogs, data points and units of the root are loaded once, new ones are inserted
+    with bulk_create per chunk of rows and every cost table is written once by finish().
+    """
+
+    def __init__(self, root, company, user, levels, c_table_header):
+        self.root = root
+        self.company = company
+        self.user = user
+        self.levels = levels
+        self.c_table_header = c_table_header
+        self.row_count = 0
+        self.new_catalogs = set()
+        self.updated_icons = {}
+        self.cost_tables = defaultdict(list)
+        self.cost_table_units = set()
+
+        subtree = Catalog.objects.filter(ancestor_links__ancestor=root, company=company).defer('c_table')
+        catalogs = {c.pk: c for c in subtree}
+        # Same lookup as parent.children.get_or_create(name=..., level=..., level_index=...)
+        self.children = {}
+        edges = Catalog.parents.through.objects.filter(from_catalog_id__in=list(catalogs))
+        for child, parent in edges.values_list('from_catalog_id', 'to_catalog_id'):
+            if parent == root.pk or parent in catalogs:
+                c = catalogs[child]
+                self.children.setdefault((parent, c.name, c.level_id, c.level_index), c)
+        self.data_points = set(DataPoint.objects.filter(catalog_id__in=list(catalogs)).values_list(
+            'catalog_id', 'value', 'unit_id', 'linked_description'
+        ))
+        self.units = dict(UnitLibrary.objects.filter(company=company).values_list('name', 'pk'))
+
+    @staticmethod
+    def cell(row, index):
+        return row[index] if index < len(row) else None
+
+    def get_units(self, names):
+        """Return unit ids by name, creating the missing units"""
+        missing = {str(name) for name in names if name} - self.units.keys()
+        if missing:
+            UnitLibrary.objects.bulk_create([UnitLibrary(name=name, company=self.company, user_create=self.user)
+                                             for name in missing], ignore_conflicts=True)
+            self.units.update(UnitLibrary.objects.filter(company=self.company, name__in=missing).values_list('name', 'pk'))
+        return self.units
+
+    def import_rows(self, rows):
+        if not self.levels:
+            return
+        self.row_count += len(rows)
+        units = self.get_units([self.cell(row, i*5 + 3) for row in rows for i in range(len(self.levels))
+                                if self.cell(row, i*5)])
+        paths = [self.root] * len(rows)
+        data_points = []
+        # Resolve catalogs level by level, so children of catalogs created in this chunk are found
+        for i, level in enumerate(self.levels):
+            missing = {}
+            for r, row in enumerate(rows):
+                name = self.cell(row, i*5)
+                if not name:
+                    continue
+                key = (paths[r].pk, str(name), level.pk, i)
+                if key not in self.children and key not in missing:
+                    missing[key] = Catalog(name=str(name), company=self.company, level=level, level_index=i,
+                                           user_create=self.user)
+            if missing:
+                Catalog.objects.bulk_create(missing.values(), batch_size=IMPORT_CHUNK_SIZE)
+                Catalog.parents.through.objects.bulk_create(
+                    [Catalog.parents.through(from_catalog_id=c.pk, to_catalog_id=key[0]) for key, c in missing.items()],
+                    batch_size=IMPORT_CHUNK_SIZE
+                )
+                self.children.update(missing)
+                self.new_catalogs.update(c.pk for c in missing.values())
+
+            for r, row in enumerate(rows):
+                name = self.cell(row, i*5)
+                if not name:
+                    continue
+                catalog = self.children[(paths[r].pk, str(name), level.pk, i)]
+                icon = self.cell(row, i*5 + 1)
+                if icon and catalog.icon != icon:
+                    catalog.icon = icon
+                    self.updated_icons[catalog.pk] = catalog
+                unit = self.cell(row, i*5 + 3)
+                value = self.cell(row, i*5 + 2)
+                linked_description = self.cell(row, i*5 + 4)
+                data_point = (catalog.pk, str(value) if value else '', units[str(unit)] if unit else None,
+                              str(linked_description) if linked_description else '')
+                if data_point not in self.data_points:
+                    self.data_points.add(data_point)
+                    data_points.append(DataPoint(catalog_id=data_point[0], value=data_point[1], unit_id=data_point[2],
+                                                 linked_description=data_point[3], company=self.company,
+                                                 user_create=self.user))
+                paths[r] = catalog
+        DataPoint.objects.bulk_create(data_points, batch_size=IMPORT_CHUNK_SIZE)
+
+        start = len(self.levels) * 5
+        for r, row in enumerate(rows):
+            values = row[start:]
+            if any(values):
+                self.cost_tables[paths[r].pk].append(['' if value is None else str(value) for value in values])
+            self.cost_table_units.add(self.cell(row, start + 1))
+
+    def finish(self):
+        Catalog.objects.bulk_update(self.updated_icons.values(), ['icon'], batch_size=IMPORT_CHUNK_SIZE)
+        catalogs = list(Catalog.objects.filter(pk__in=list(self.cost_tables)))
+        for catalog in catalogs:
+            #  Get all data from dictionary except key 'data' and 'header'
+            c_table = {key: value for key, value in catalog.c_table.items() if key not in ['data', 'header']} if catalog.c_table else {}
+            c_table['header'] = self.c_table_header
+            c_table['data'] = self.cost_tables[catalog.pk]
+            new_header = []
+            for header in self.c_table_header:
+                format_header = [i for i in c_table.get('header_format', []) if i['name'] == header]
+                new_header.append(format_header[0] if format_header else {'name': header, 'isDisable': True, 'isFormula': False})
+            c_table['header_format'] = new_header
+            catalog.c_table = c_table
+        Catalog.objects.bulk_update(catalogs, ['c_table'], batch_size=100)
+        CostTableRow.sync(catalogs)
+        CatalogClosure.refresh(self.new_catalogs)
+        self.get_units(self.cost_table_units)
+        invalidate_ancestors([self.root.pk])
+        invalidate_material_levels(self.company.pk)
+
+
 def count_level(header, level_catalog):
     """
     Parameters:
@@ -298,67 +605,3 @@ def count_level(header, level_catalog):
     else:
         return 0, 0, [], []
     return level_column_number, length - length_level, levels, c_table_header
-
-
-def create_catalog_by_row(row, length_level, company, root, levels, level_header, cache=set()):
-    """
-    Parameters:
-        row: tuple
-        length_level: int
-        company: company object
-        root: catalog object
-        levels: list level objects
-    """
-    unit = None
-    parent = root
-    for i in range(length_level):
-        name = row[i*5]
-        if not name:
-            continue
-        icon = row[i*5 + 1]
-
-        if parent:
-            catalog = parent.children.get_or_create(name=name, company=company, level=levels[i], level_index=i)
-            catalog = catalog[0]
-            catalog.parents.add(parent)
-            if icon:
-                catalog.icon = icon
-                catalog.save(update_fields=['icon'])
-        else:
-            catalog = Catalog.objects.create(name=name, company=company)
-
-        unit = None
-        if row[i*5 + 3]:
-            unit = UnitLibrary.objects.get_or_create(name=row[i*5 + 3], company=company)
-            unit = unit[0]
-
-        data_point = {'value': row[i*5 + 2] or '', 'unit': unit, 'linked_description': row[i*5 + 4] or ''}
-        DataPoint.objects.get_or_create(catalog=catalog, **data_point)
-        parent = catalog
-    else:
-        if length_level:
-            c_table = parent.c_table or {'header': level_header, 'data': []}
-            if parent.id not in cache:
-                #  Get all data from dictionary except key 'data' and 'header'
-                c_table = {key: value for key, value in parent.c_table.items() if key not in ['data', 'header']} if parent.c_table else {}
-                c_table['header'] = level_header
-                c_table['data'] = []
-                new_header = []
-                for header in level_header:
-                    format_header = [i for i in c_table.get('header_format', []) if i['name'] == header]
-                    new_header.append(format_header[0] if format_header else {'name': header, 'isDisable': True, 'isFormula': False})
-                c_table['header_format'] = new_header
-
-            # Validate cost table data
-            data_create = ['' if value is None else str(value) for value in row[i*5 + 5:]]
-            if any(row[i*5 + 5:]):
-                c_table['data'].append(data_create)
-                parent.c_table = c_table
-                parent.save()
-            # No cost table
-            cache.add(parent.id)
-            try:
-                unit = row[i*5 + 6]
-            except IndexError:
-                return
-    return unit
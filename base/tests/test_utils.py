@@ -0,0 +1,23 @@
+from django.test import SimpleTestCase
+
+from base.utils import parse_literal
+
+
+class ParseLiteralTests(SimpleTestCase):
+
+    def test_parse_literal(self):
+        self.assertEqual(parse_literal('{"a": null, "b": [true, false]}'), {'a': None, 'b': [True, False]})
+        self.assertEqual(parse_literal("{'a': [1, 2.5], 'b': ('c',)}"), {'a': [1, 2.5], 'b': ('c',)})
+        # Python literals written with JSON names
+        self.assertEqual(parse_literal("{'a': null}"), {'a': None})
+        self.assertEqual(parse_literal("{'x': true, 'y': None, 'z': [false, 'null']}"),
+                         {'x': True, 'y': None, 'z': [False, 'null']})
+
+        value = parse_literal("{'a': [1]}")
+        value['a'].append(2)
+        self.assertEqual(parse_literal("{'a': [1]}"), {'a': [1]})
+
+    def test_parse_literal_errors(self):
+        for value in ("{'a': undefined}", "__import__('os')", "{'a': ", "{[1]: 2}", '[' * 100000, 1):
+            with self.assertRaises(ValueError):
+                parse_literal(value)
@@ -1,5 +1,9 @@
 from datetime import datetime
+from functools import lru_cache
+import ast
+import copy
 import io
+import json
 import sys
 
 from django.http import FileResponse
@@ -19,6 +23,40 @@ def pop(data, key, default_type):
     return default_type
 
 
+class _JSONNames(ast.NodeTransformer):
+    """Replace the JSON names null, true and false by their python constants"""
+    names = {'null': None, 'true': True, 'false': False}
+
+    def visit_Name(self, node):
+        if node.id in self.names:
+            return ast.copy_location(ast.Constant(self.names[node.id]), node)
+        return node
+
+
+@lru_cache(maxsize=4096)
+def _parse_literal(value):
+    try:
+        return json.loads(value)
+    except (ValueError, RecursionError):
+        pass
+    try:
+        # Values mixing JSON and python, like {'a': null}
+        return ast.literal_eval(_JSONNames().visit(ast.parse(value, mode='eval')))
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError) as e:
+        raise ValueError(str(e)) from e
+
+
+def parse_literal(value):
+    """
+    Parse a structured value stored as text: JSON (as exported by the frontend) or a python literal
+    (str of a dict). Replaces eval, raise ValueError when the value is not a literal.
+    Parsed values are cached per process, a copy is returned so callers can modify it
+    """
+    if not isinstance(value, str):
+        raise ValueError(f'{value!r} is not a string')
+    return copy.deepcopy(_parse_literal(value.strip()))
+
+
 def extra_kwargs_for_base_model():
     return {'created_date': {'read_only': True},
             'modified_date': {'read_only': True},
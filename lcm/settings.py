@@ -64,7 +64,8 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'api.middleware.CacheRequestMiddleware',
     'api.middleware.SettingTranslateMiddleware',
-    'api.middleware.SettingTimeZoneMiddleware'
+    'api.middleware.SettingTimeZoneMiddleware',
+    'sales.middleware.ProposalTotalMiddleware'
 ]
 
 AUTHENTICATION_BACKENDS = [
@@ -226,6 +227,10 @@ REDIS_HOST = config('REDIS_HOST', default='localhost')
 REDIS_PORT = config('REDIS_PORT', default='6379')
 REDIS_CELERY_DATABASE = config('REDIS_CELERY_DATABASE', default='0')
 
+# Headless HTML to PDF engine of the celery workers
+WKHTMLTOPDF_CMD = config('WKHTMLTOPDF_CMD', default='wkhtmltopdf')
+PDF_RENDER_TIMEOUT = config('PDF_RENDER_TIMEOUT', cast=int, default=120)
+
 USE_DEBUG_TOOLBAR = config('USE_DEBUG_TOOLBAR', cast=bool, default=False)
 
 if DEBUG:
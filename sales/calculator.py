@@ -0,0 +1,260 @@
+"""
+Server-side evaluation of estimate formulas.
+
+A formula is text using the names of other formulas, data entries and data views (see POFormulaDependency).
+Names are replaced by variables and the text is parsed once into a python expression, which is evaluated
+with Decimal arithmetic. Only numbers, arithmetic operators and a few functions are allowed.
+"""
+import ast
+import operator
+import re
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation, ROUND_CEILING, ROUND_FLOOR
+from functools import lru_cache
+
+from django.utils import timezone
+
+from sales.models.catalog import CatalogClosure, CostTableRow
+from sales.models.estimate import EstimateTemplate, POFormula, POFormulaDependency, POFormulaToDataEntry, RoundUpActionChoice, \
+    RoundUpChoice, topological_order
+
+OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+             ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+             ast.UAdd: operator.pos, ast.USub: operator.neg}
+FUNCTIONS = {'abs': abs, 'min': min, 'max': max, 'round': round,
+             'ceil': lambda value: value.to_integral_value(ROUND_CEILING),
+             'floor': lambda value: value.to_integral_value(ROUND_FLOOR)}
+PRICE_FIELDS = ('unit_price', 'total_cost', 'charge', 'margin')
+RESULT_FIELDS = ('quantity', 'order_quantity', *PRICE_FIELDS)
+
+
+@lru_cache(maxsize=4096)
+def compile_formula(text, names):
+    """
+    Parse a formula once. ``names`` (a tuple) are replaced by the variables v0, v1... in this order.
+    Raise ValueError when the formula is not an expression.
+    """
+    expression = text or '0'
+    if names:
+        index = {name: i for i, name in enumerate(names)}
+        # Longest names first so that "Wall Area" is not read as "Wall"
+        pattern = '|'.join(re.escape(name) for name in sorted(names, key=len, reverse=True))
+        expression = re.sub(rf'(?<!\w)(?:{pattern})(?!\w)', lambda match: f' v{index[match.group()]} ', expression)
+    try:
+        return ast.parse(expression.replace('^', '**').strip(), mode='eval').body
+    except SyntaxError as e:
+        raise ValueError(f'invalid formula: {text}') from e
+
+
+def evaluate(node, variables):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return Decimal(str(node.value))
+    if isinstance(node, ast.Name):
+        if node.id in variables:
+            return variables[node.id]
+        if node.id in FUNCTIONS:
+            raise ValueError(f'{node.id} must be called')
+        raise ValueError(f'unknown name {node.id}')
+    if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+        return OPERATORS[type(node.op)](evaluate(node.left, variables), evaluate(node.right, variables))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+        return OPERATORS[type(node.op)](evaluate(node.operand, variables))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+        return Decimal(FUNCTIONS[node.func.id](*[evaluate(arg, variables) for arg in node.args]))
+    raise ValueError('formula is not an arithmetic expression')
+
+
+def to_decimal(value, default=None):
+    try:
+        return Decimal(str(value).strip())
+    except (InvalidOperation, ValueError):
+        return default
+
+
+def ceil_to(value, step):
+    if not step or step <= 0:
+        return value
+    return (value / step).to_integral_value(ROUND_CEILING) * step
+
+
+def round_up(quantity, rule):
+    """Order quantity from the round up rule of a formula (POFormula.round_up)"""
+    rule = rule or {}
+    if rule.get('type') == RoundUpChoice.WHOLE_NUMBER:
+        return ceil_to(quantity, to_decimal(rule.get('whole_number'), Decimal(1)))
+    if rule.get('type') == RoundUpChoice.INCREMENT:
+        increments = sorted(filter(None, (to_decimal(increment) for increment in rule.get('increments') or [])))
+        for increment in increments:
+            if quantity <= increment:
+                return increment
+        if rule.get('last_action') == RoundUpActionChoice.WHOLE_NUMBER:
+            return ceil_to(quantity, Decimal(1))
+        if rule.get('last_action') == RoundUpActionChoice.INCREMENT:
+            base = increments[-1] if increments else Decimal(0)
+            return base + ceil_to(quantity - base, to_decimal(rule.get('action_value'), Decimal(1)))
+    return quantity
+
+
+def get_unit_cost(formula):
+    """Price of the selected material column, else the cost of the formula"""
+    value = (formula.default_column or {}).get('value')
+    if value not in (None, ''):
+        return to_decimal(value, Decimal(0))
+    return formula.cost or Decimal(0)
+
+
+def get_prices(formula, order_quantity, unit_cost):
+    unit_price = unit_cost * (100 + (formula.markup or 0)) / 100
+    total_cost = order_quantity * unit_cost
+    charge = order_quantity * unit_price
+    margin = (charge - total_cost) / charge * 100 if charge else Decimal(0)
+    return {'unit_price': unit_price, 'total_cost': total_cost, 'charge': charge, 'margin': margin}
+
+
+def calculate_formulas(formulas, data_entry_values=None, formula_values=None):
+    """
+    Evaluate formulas together, each one after the formulas it uses.
+    ``data_entry_values`` ({data entry id: value}) override the default values of the data entries,
+    ``formula_values`` ({formula id: {data entry id: value}}) the values of the estimate of each formula.
+    Formulas used but not in ``formulas`` keep their saved quantity.
+    Return {formula id: {quantity, order_quantity, unit_price, total_cost, charge, margin}}, or
+    {formula id: {'error': message}} when a formula can't be evaluated.
+    """
+    formulas = {formula.pk: formula for formula in formulas}
+    names = defaultdict(dict)
+    uses = defaultdict(set)
+    values = {}
+    edges = POFormulaDependency.objects.filter(formula__in=formulas).values_list(
+        'formula', 'formula_ref', 'formula_ref__name', 'data_entry', 'data_entry__name', 'data_view',
+        'data_view__name', 'data_view__result'
+    )
+    outside = set()
+    for formula, formula_ref, formula_name, data_entry, data_entry_name, data_view, data_view_name, result in edges:
+        if formula_ref:
+            names[formula][formula_name] = ('formula', formula_ref)
+            uses[formula].add(formula_ref)
+            if formula_ref not in formulas:
+                outside.add(formula_ref)
+        elif data_entry:
+            names[formula][data_entry_name] = ('data_entry', data_entry)
+        else:
+            names[formula][data_view_name] = ('data_view', data_view)
+            values[('data_view', data_view)] = result
+    for pk, quantity in POFormula.objects.filter(pk__in=outside).values_list('pk', 'quantity'):
+        values[('formula', pk)] = quantity
+
+    data_entries = POFormulaToDataEntry.objects.filter(po_formula__in=formulas, data_entry__isnull=False)
+    defaults = {(formula, data_entry): value for formula, data_entry, value
+                in data_entries.values_list('po_formula', 'data_entry', 'value')}
+    data_entry_values = {int(pk): value for pk, value in (data_entry_values or {}).items()}
+
+    results = {}
+    order = topological_order(formulas, uses)
+    for pk in formulas.keys() - set(order):
+        results[pk] = {'error': 'formula has a circular reference'}
+    for pk in order:
+        formula = formulas[pk]
+        references = tuple(names[pk])
+        variables = {}
+        try:
+            for i, name in enumerate(references):
+                kind, key = names[pk][name]
+                if kind == 'formula' and key in formulas:
+                    if 'error' in results[key]:
+                        raise ValueError(f'{name} has an error')
+                    value = results[key]['quantity']
+                elif kind == 'data_entry':
+                    value = data_entry_values.get(key, (formula_values or {}).get(pk, {}).get(key, defaults.get((pk, key))))
+                else:
+                    value = values.get((kind, key))
+                value = to_decimal(value) if value not in (None, '') else None
+                if value is None:
+                    raise ValueError(f'{name} has no value')
+                variables[f'v{i}'] = value
+            quantity = evaluate(compile_formula(formula.formula, references), variables)
+        except (ValueError, ArithmeticError, TypeError) as e:
+            results[pk] = {'error': str(e)}
+            continue
+
+        order_quantity = round_up(quantity, formula.round_up)
+        results[pk] = {'quantity': quantity, 'order_quantity': order_quantity,
+                       **get_prices(formula, order_quantity, get_unit_cost(formula))}
+    return results
+
+
+def save_results(formulas, results):
+    """Save the evaluated values of formulas in one bulk update, then queue the update of their proposals"""
+    from sales.models.proposal import queue_proposal_update
+
+    updated = []
+    now = timezone.now()
+    for formula in formulas:
+        result = results.get(formula.pk, {})
+        if 'error' in result or not result:
+            continue
+        for field in RESULT_FIELDS:
+            setattr(formula, field, result[field].quantize(Decimal('1.00000000')))
+        # bulk_update skips auto_now, the modified date versions the estimates (see EstimateTemplate.get_versions)
+        formula.modified_date = now
+        updated.append(formula)
+    POFormula.objects.bulk_update(updated, [*RESULT_FIELDS, 'modified_date'], batch_size=500)
+    queue_proposal_update([formula.assemble_id for formula in updated])
+    return updated
+
+
+def get_row_cost(row, column):
+    """Cost of a cost table row in the column selected by a formula, else in the cost column"""
+    if column:
+        for data in row.columns:
+            if data.get('name') == column:
+                cost = CostTableRow.parse_cost(data.get('value'))
+                if cost is not None:
+                    return cost
+    return row.cost
+
+
+def reprice_formulas(catalog_ids, dry_run=True):
+    """
+    Update the cost of formulas using a material of these catalogs (or their descendants) to the current cost table, and their price,
+    total cost, charge and margin at the same order quantity. Formulas of sent or approved proposals are kept.
+    Return the report of changes, without saving anything when ``dry_run``.
+    """
+    from sales.models.proposal import ProposalStatus, queue_proposal_update
+
+    catalog_ids = {*catalog_ids, *CatalogClosure.objects.filter(ancestor__in=catalog_ids).values_list('descendant', flat=True)}
+    rows = {row.material_id: row for row in CostTableRow.objects.filter(catalog__in=catalog_ids)}
+    formulas = POFormula.objects.filter(material_id__in=list(rows)).exclude(
+        assemble__estimate_templates__group_by_proposal__writing__status__in=[ProposalStatus.SENT,
+                                                                                ProposalStatus.APPROVED]
+    ).order_by('pk')
+    changed = []
+    report = []
+    for formula in formulas:
+        default_column = formula.default_column or {}
+        cost = get_row_cost(rows[formula.material_id], default_column.get('name'))
+        old_cost = get_unit_cost(formula)
+        if cost is None or cost == old_cost:
+            continue
+        quantity = formula.order_quantity if formula.order_quantity is not None else formula.quantity or Decimal(0)
+        prices = get_prices(formula, quantity, cost)
+        report.append({'id': formula.pk, 'name': formula.name, 'material': formula.material_id,
+                       'old_cost': str(old_cost), 'new_cost': str(cost),
+                       'old_charge': str(formula.charge), 'new_charge': str(prices['charge'].quantize(Decimal('1.00')))})
+        if 'value' in default_column:
+            formula.default_column = {**default_column, 'value': str(cost)}
+        formula.cost = cost
+        formula.modified_date = timezone.now()
+        for field, value in prices.items():
+            setattr(formula, field, value.quantize(Decimal('1.00000000')))
+        changed.append(formula)
+
+    assemble_ids = {formula.assemble_id for formula in changed} - {None}
+    estimates = EstimateTemplate.objects.filter(assembles__in=assemble_ids).distinct()
+    data = {'dry_run': dry_run, 'formulas': report,
+            'estimates': list(estimates.values_list('pk', flat=True)),
+            'proposals': list(estimates.exclude(group_by_proposal__writing=None).values_list(
+                'group_by_proposal__writing', flat=True).distinct())}
+    if not dry_run:
+        POFormula.objects.bulk_update(changed, ['cost', 'default_column', 'modified_date', *PRICE_FIELDS], batch_size=500)
+        queue_proposal_update(assemble_ids)
+    return data
@@ -0,0 +1,177 @@
+"""
+Bulk deep copy of proposals.
+
+A proposal is a graph: its formatting, groups, the estimates of the groups, the assembles of the estimates with
+their formulas, data entries (with their notes), data views, material views and formula dependencies.
+The graph of the source is read once, level by level, then each level is created for every copy at once with
+one bulk_create, and the ids of the created rows are remapped in the next levels.
+"""
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Q
+
+from api.middleware import get_request
+from api.models import BaseModel
+from base.tasks import activity_log
+from sales.models.estimate import Assemble, DataView, EstimateTemplate, MaterialView, Note, POFormula, POFormulaDependency, \
+    POFormulaToDataEntry
+from sales.models.lead_list import ActivitiesLog
+from sales.models.proposal import GroupByEstimate, ProposalFormatting, ProposalStatus, ProposalWriting
+
+# Fields of the formatting kept by a copy, the other ones (signature state, html) start over
+FORMATTING_FIELDS = ('show_format_fields', 'show_formula_fields', 'contacts', 'intro', 'default_note', 'signature',
+                     'pdf_file', 'closing_note', 'contract_note', 'print_date', 'primary_contact', 'group_templates',
+                     'template_type', 'active_tab', 'is_sent_otp')
+
+
+def copy_row(instance, user, fields=None, **values):
+    """Unsaved copy of a row with ``values`` changed, created by ``user`` as with BaseModel.save"""
+    model = type(instance)
+    if fields is None:
+        fields = [field.attname for field in model._meta.concrete_fields if not field.primary_key]
+    data = {field: getattr(instance, field) for field in fields}
+    if issubclass(model, BaseModel) and user:
+        data.update(user_create_id=user.pk, user_update_id=None, company_id=user.company_id)
+    if 'original' in data:
+        data['original'] = data['original'] or instance.pk
+    data.update(values)
+    return model(**data)
+
+
+def create_copies(model, sources, count, user, get_values, fields=None):
+    """
+    Create ``count`` copies of each (key, row) of ``sources`` in one bulk_create,
+    get_values(copy index, key, row) gives the changed fields. Return {(copy index, key): id of the copy}
+    """
+    keys, rows = [], []
+    for index in range(count):
+        for key, row in sources:
+            keys.append((index, key))
+            rows.append(copy_row(row, user, fields, **get_values(index, key, row)))
+    model.objects.bulk_create(rows, batch_size=1000)
+    return {key: row.pk for key, row in zip(keys, rows)}
+
+
+def clone_proposal(proposal, lead_ids, name):
+    """Copy a proposal with all its estimates once for each lead, in a fixed number of queries. Return the copies"""
+    request = get_request()
+    user = request.user if request and not request.user.is_anonymous else None
+    count = len(lead_ids)
+    if not count:
+        return []
+
+    # Read the graph of the source
+    formatting = ProposalFormatting.objects.filter(proposal_writing=proposal).first()
+    groups = list(GroupByEstimate.objects.filter(writing=proposal).order_by('pk'))
+    estimates = list(EstimateTemplate.objects.filter(group_by_proposal__in=groups).order_by('pk'))
+    # An assemble is copied for each of its estimates, copies of assembles are keyed by the estimate link
+    links = list(EstimateTemplate.assembles.through.objects.filter(estimatetemplate__in=estimates).select_related('assemble'))
+    formulas = defaultdict(list)
+    for formula in POFormula.objects.filter(assemble__in={link.assemble_id for link in links}).order_by('pk'):
+        formulas[formula.assemble_id].append(formula)
+    formula_ids = {formula.pk for assemble_formulas in formulas.values() for formula in assemble_formulas}
+    data_entries = POFormulaToDataEntry.objects.filter(Q(po_formula__in=formula_ids) | Q(estimate_template__in=estimates))
+    data_entries = list(data_entries.order_by('pk'))
+    formula_data_entries = defaultdict(list)
+    for data_entry in data_entries:
+        formula_data_entries[data_entry.po_formula_id].append(data_entry)
+    notes = defaultdict(list)
+    for note in Note.objects.filter(data_entry__in=data_entries).order_by('pk'):
+        notes[note.data_entry_id].append(note)
+    data_views = list(DataView.objects.filter(estimate_template__in=estimates).order_by('pk'))
+    material_views = list(MaterialView.objects.filter(estimate_template__in=estimates).order_by('pk'))
+    dependencies = defaultdict(list)
+    for dependency in POFormulaDependency.objects.filter(formula__in=formula_ids):
+        dependencies[dependency.formula_id].append(dependency)
+
+    with transaction.atomic():
+        proposal_ids = create_copies(ProposalWriting, [(proposal.pk, proposal)], count, user, lambda i, key, row: {
+            'lead_id': lead_ids[i], 'name': name, 'status': ProposalStatus.DRAFT
+        })
+        if formatting:
+            create_copies(ProposalFormatting, [(formatting.pk, formatting)], count, user, lambda i, key, row: {
+                'proposal_writing_id': proposal_ids[(i, proposal.pk)]
+            }, fields=FORMATTING_FIELDS)
+        group_ids = create_copies(GroupByEstimate, [(group.pk, group) for group in groups], count, user,
+                                  lambda i, key, row: {'writing_id': proposal_ids[(i, proposal.pk)]})
+
+        # Estimates are ordered in their group, the one at open_index of the group is selected
+        positions = {}
+        for group in groups:
+            group_estimates = [estimate for estimate in estimates if estimate.group_by_proposal_id == group.pk]
+            for index, estimate in enumerate(group_estimates):
+                positions[estimate.pk] = (index, index == int(group.open_index or 0))
+        estimate_ids = create_copies(EstimateTemplate, [(estimate.pk, estimate) for estimate in estimates], count, user,
+                                     lambda i, key, row: {'group_by_proposal_id': group_ids[(i, row.group_by_proposal_id)],
+                                                          'is_show': False, 'order': positions[key][0],
+                                                          'is_selected': positions[key][1]})
+        assemble_ids = create_copies(Assemble, [(link.pk, link.assemble) for link in links], count, user,
+                                     lambda i, key, row: {'is_show': False})
+        EstimateTemplate.assembles.through.objects.bulk_create([
+            EstimateTemplate.assembles.through(estimatetemplate_id=estimate_ids[(i, link.estimatetemplate_id)],
+                                               assemble_id=assemble_ids[(i, link.pk)])
+            for i in range(count) for link in links
+        ], batch_size=1000)
+
+        formula_sources = [((link.pk, formula.pk), formula) for link in links for formula in formulas[link.assemble_id]]
+        new_formula_ids = create_copies(POFormula, formula_sources, count, user, lambda i, key, row: {
+            'assemble_id': assemble_ids[(i, key[0])], 'is_show': False, 'group_id': None,
+            'formula_for_data_view': row.formula_for_data_view or row.pk
+        })
+        data_view_ids = create_copies(DataView, [(data_view.pk, data_view) for data_view in data_views], count, user,
+                                      lambda i, key, row: {'estimate_template_id': estimate_ids[(i, row.estimate_template_id)]})
+        create_copies(MaterialView, [(view.pk, view) for view in material_views], count, user,
+                      lambda i, key, row: {'estimate_template_id': estimate_ids[(i, row.estimate_template_id)]})
+
+        # Data entries of a formula and of an estimate are copied separately, like the serializers do
+        entry_sources = [((link.pk, formula.pk, data_entry.pk), data_entry) for link in links
+                         for formula in formulas[link.assemble_id]
+                         for data_entry in formula_data_entries[formula.pk]]
+        entry_sources += [((None, None, data_entry.pk), data_entry) for data_entry in data_entries
+                          if data_entry.estimate_template_id in positions]
+
+        def get_data_entry_values(i, key, row):
+            if key[0] is None:
+                return {'estimate_template_id': estimate_ids[(i, row.estimate_template_id)], 'po_formula_id': None}
+            return {'po_formula_id': new_formula_ids[(i, key[:2])], 'estimate_template_id': None}
+        data_entry_ids = create_copies(POFormulaToDataEntry, entry_sources, count, user, get_data_entry_values)
+
+        # Notes keep their date
+        note_ids = create_copies(Note, [((key, note.pk), note) for key, data_entry in entry_sources
+                                        for note in notes[data_entry.pk]],
+                                 count, user, lambda i, key, row: {'data_entry_id': data_entry_ids[(i, key[0])]})
+        dates = {note.pk: note.created_date for data_entry_notes in notes.values() for note in data_entry_notes}
+        Note.objects.bulk_update([Note(pk=pk, created_date=dates[key[1][1]]) for key, pk in note_ids.items()],
+                                 ['created_date'], batch_size=1000)
+
+        # Formulas refer to copies of the formulas of their assemble, or else of the proposal, and data views of their
+        # estimates. Formulas outside the proposal, as the ones of the library, are kept
+        proposal_formula_ids = {}
+        for (i, (link_pk, formula_pk)), pk in new_formula_ids.items():
+            proposal_formula_ids.setdefault((i, formula_pk), pk)
+
+        def get_formula_ref_id(i, link_pk, ref_id):
+            return new_formula_ids.get((i, (link_pk, ref_id)), proposal_formula_ids.get((i, ref_id), ref_id))
+        POFormulaDependency.objects.bulk_create([
+            copy_row(dependency, user, formula_id=new_formula_ids[(i, (link_pk, formula_pk))],
+                     formula_ref_id=get_formula_ref_id(i, link_pk, dependency.formula_ref_id),
+                     data_view_id=data_view_ids.get((i, dependency.data_view_id), dependency.data_view_id))
+            for i in range(count) for link_pk, formula_pk in [key for key, _ in formula_sources]
+            for dependency in dependencies[formula_pk]
+        ], batch_size=1000)
+
+        copies = ProposalWriting.objects.in_bulk(proposal_ids.values())
+        copies = [copies[proposal_ids[(i, proposal.pk)]] for i in range(count)]
+
+        ActivitiesLog.objects.bulk_create([
+            copy_row(ActivitiesLog(lead_id=copy.lead_id, status='draft', type_id=copy.pk, title=copy.name,
+                                   type='proposal', start_date=copy.created_date), user)
+            for copy in copies if copy.lead_id
+        ])
+        if user:
+            content_type = ContentType.objects.get_for_model(ProposalWriting).pk
+            transaction.on_commit(lambda: [activity_log.delay(content_type, copy.pk, 1, 'ProposalWritingSerializer',
+                                                              'sales.serializers.proposal', user.pk) for copy in copies])
+    return copies
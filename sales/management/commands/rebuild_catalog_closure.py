@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from sales.models.catalog import CatalogClosure
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the catalog closure table from Catalog.parents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, default=None, help='Only rebuild catalogs of this company')
+
+    def handle(self, *args, **options):
+        CatalogClosure.rebuild(company=options['company'])
+        self.stdout.write(self.style.SUCCESS('Catalog closure rebuilt'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from sales.models.estimate import POFormulaDependency
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the formula dependency graph from the text of formulas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, default=None, help='Only rebuild formulas of this company')
+
+    def handle(self, *args, **options):
+        POFormulaDependency.rebuild(company=options['company'])
+        self.stdout.write(self.style.SUCCESS('Formula dependencies rebuilt'))
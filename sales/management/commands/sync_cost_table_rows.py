@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from sales.models.catalog import Catalog, CostTableRow
+
+
+class Command(BaseCommand):
+    help = 'Rebuild cost table rows from Catalog.c_table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, default=None, help='Only sync catalogs of this company')
+
+    def handle(self, *args, **options):
+        catalogs = Catalog.objects.exclude(c_table={})
+        if options['company']:
+            catalogs = catalogs.filter(company=options['company'])
+        CostTableRow.sync(catalogs.iterator())
+        self.stdout.write(self.style.SUCCESS('Cost table rows synced'))
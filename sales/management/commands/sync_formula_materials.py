@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from sales.models.estimate import POFormula
+
+
+class Command(BaseCommand):
+    help = 'Fill POFormula.material_id from the material of formulas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, default=None, help='Only sync formulas of this company')
+
+    def handle(self, *args, **options):
+        formulas = POFormula.objects.exclude(material='')
+        if options['company']:
+            formulas = formulas.filter(company=options['company'])
+        batch = []
+        for formula in formulas.only('material', 'material_id').iterator():
+            formula.material_id = formula.get_material_id()
+            batch.append(formula)
+            if len(batch) == 1000:
+                POFormula.objects.bulk_update(batch, ['material_id'])
+                batch = []
+        POFormula.objects.bulk_update(batch, ['material_id'])
+        self.stdout.write(self.style.SUCCESS('Formula materials synced'))
@@ -0,0 +1,26 @@
+import logging
+
+from .models.proposal import batch_proposal_updates
+
+logger = logging.getLogger(__name__)
+
+
+class ProposalTotalMiddleware:
+    """
+    Update the totals of proposals whose formulas changed during the request once, after the view.
+    Serializers of proposals apply the queue before they read the totals
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = None
+        try:
+            with batch_proposal_updates():
+                response = self.get_response(request)
+        except Exception:
+            if response is None:
+                raise
+            # The changes of the request are saved, don't lose its response for totals failing after the view
+            logger.exception('Proposal totals of %s %s were not updated', request.method, request.path)
+        return response
@@ -1,10 +1,68 @@
 import copy
-from functools import lru_cache
-
-from django.db import models
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from decimal import Decimal, InvalidOperation
+
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import prefetch_related_objects
 from api.middleware import get_request
 
 from api.models import BaseModel
+from base.constants import DECIMAL_PLACE, MAX_DIGIT
+
+
+MATERIAL_LEVELS_CACHE_KEY = 'catalog-material-levels-{}'
+MATERIAL_LEVELS_CACHE_TIMEOUT = 60 * 60 * 24
+ANCESTOR_CACHE_KEY = 'catalog-ancestors-{}'
+ANCESTOR_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+_invalidation = threading.local()
+
+
+@contextmanager
+def defer_invalidation():
+    """
+    Skip the cache invalidation of every catalog saved or deleted inside the block,
+    the caller invalidates the whole set once at the end
+    """
+    _invalidation.deferred = True
+    try:
+        yield
+    finally:
+        _invalidation.deferred = False
+
+
+def invalidate_material_levels(company_id):
+    """Drop the cached ancestor levels of materials after the catalog tree of a company changed"""
+    if getattr(_invalidation, 'deferred', False):
+        return
+    cache.delete(MATERIAL_LEVELS_CACHE_KEY.format(company_id))
+
+
+def invalidate_ancestors(catalog_ids):
+    """Drop the cached full ancestor of catalogs which have changed and of all their descendants"""
+    if getattr(_invalidation, 'deferred', False):
+        return
+    catalog_ids = set(catalog_ids)
+    catalog_ids.update(CatalogClosure.objects.filter(ancestor_id__in=catalog_ids).values_list('descendant_id', flat=True))
+    cache.delete_many([ANCESTOR_CACHE_KEY.format(pk) for pk in catalog_ids])
+
+
+def make_unique_name(name, names):
+    """Add a number to name until it is not in names"""
+    if name not in names:
+        return name
+    i = 1
+    while name in names:
+        if name.split(' ')[-1].isdigit():
+            name = ' '.join(name.split(' ')[:-1]) + ' ' + str(i)
+        else:
+            name = name + f' {i}'
+        i += 1
+    return name
 
 
 class DataPointUnit(BaseModel):
@@ -29,19 +87,32 @@ class CatalogLevel(BaseModel):
         has_child = child_level.exists()
 
         if has_child:
-            catalogs = Catalog.objects.filter(level=self)
-            for c in catalogs:
-                children = Catalog.objects.filter(parents=c)
-                parent = c.parents.first()
-                for child in children:
-                    child.parents.clear()
-                    child.parents.add(parent)
+            # Move the children of catalogs in this level to the first parent of these catalogs
+            through = Catalog.parents.through
+            first_parents = {}
+            edges = through.objects.filter(from_catalog__level=self).order_by(
+                'to_catalog__index', '-to_catalog__modified_date'
+            ).values_list('from_catalog_id', 'to_catalog_id')
+            for catalog, parent in edges:
+                first_parents.setdefault(catalog, parent)
+            new_parents = dict(through.objects.filter(to_catalog__level=self).values_list('from_catalog_id', 'to_catalog_id'))
+            with transaction.atomic():
+                through.objects.filter(from_catalog_id__in=list(new_parents)).delete()
+                through.objects.bulk_create([
+                    through(from_catalog_id=child, to_catalog_id=first_parents[catalog])
+                    for child, catalog in new_parents.items() if first_parents.get(catalog)
+                ])
+                CatalogClosure.refresh(new_parents)
             child_level = child_level.first()
             child_level.parent = copy.copy(self.parent)
 
-        super(CatalogLevel, self).delete(using=using, keep_parents=keep_parents)
+        with defer_invalidation():
+            deleted = super(CatalogLevel, self).delete(using=using, keep_parents=keep_parents)
         if has_child:
             child_level.save()
+        invalidate_ancestors(new_parents if has_child else [])
+        invalidate_material_levels(self.company_id)
+        return deleted
 
     def get_ordered_descendant(self):
         descendant = [self]
@@ -65,6 +136,10 @@ class DataPoint(BaseModel):
                                 null=True, blank=True)
 
 
+TREE_FIELDS = ('id', 'name', 'is_ancestor', 'parents', 'icon', 'level', 'level_index', 'index', 'sequence')
+DEFAULT_TREE_FIELDS = ('id', 'name', 'is_ancestor', 'parents', 'icon', 'level')
+
+
 class Catalog(BaseModel):
     class Meta:
         db_table = 'catalog'
@@ -84,69 +159,226 @@ class Catalog(BaseModel):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Copied, the cost table is often changed in place
+        instance._loaded_c_table = copy.deepcopy(instance.__dict__.get('c_table'))
+        return instance
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        super().save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        if 'c_table' in self.get_deferred_fields():
+            return
+        if update_fields is not None and 'c_table' not in update_fields:
+            return
+        # Rows of the cost table are synced only when it changed
+        if self.c_table != getattr(self, '_loaded_c_table', {}):
+            CostTableRow.sync([self])
+            self._loaded_c_table = copy.deepcopy(self.c_table)
+
     def get_all_descendant(self, have_self=False):
         """Get all descendant of this catalog. Return a list of id"""
         descendants = []
         if have_self:
             descendants = [self.pk]
-        catalogs = self.children.all()
-        for c in catalogs:
-            descendants.append(c.pk)
-            descendants.extend(c.get_all_descendant(have_self=have_self))
+        descendants.extend(
+            CatalogClosure.objects.filter(ancestor=self).values_list('descendant_id', flat=True).distinct()
+        )
         return descendants
 
-    def get_tree_view(self):
-        tree = []
-        catalogs = Catalog.objects.filter(parents__id=self.pk)
-        for c in catalogs:
-            tree.append(c.get_tree_view())
-        return {
-            'id': self.pk,
-            'name': self.name,
-            'is_ancestor': self.is_ancestor,
-            'parents': self.parents.all().values_list('pk', flat=True),
-            'icon': self.icon,
-            'level': self.level.id if self.level else None,
-            'children': tree
+    def get_subtree(self, depth=None):
+        """
+        Load this catalog and its descendants in constant queries.
+        Parameters:
+            depth: int, only load descendants down to this depth (None is unlimited)
+        Return (catalogs by id, parent ids by id, ordered children by id)
+        """
+        descendants = CatalogClosure.objects.filter(ancestor=self)
+        if depth is not None:
+            descendants = descendants.filter(depth__lte=depth)
+        descendants = [self.pk, *descendants.values_list('descendant_id', flat=True).distinct()]
+        edges = Catalog.parents.through.objects.filter(
+            from_catalog_id__in=descendants
+        ).values_list('from_catalog_id', 'to_catalog_id')
+        parents = defaultdict(list)
+        for child, parent in edges:
+            parents[child].append(parent)
+        nodes = {}
+        children = defaultdict(list)
+        for c in Catalog.objects.filter(pk__in=descendants):
+            nodes[c.pk] = c
+            for parent in parents[c.pk]:
+                children[parent].append(c)
+        return nodes, parents, children
+
+    def get_tree_view(self, depth=None, fields=DEFAULT_TREE_FIELDS):
+        """
+        Build the nested tree of this catalog in 2 queries, whatever its size.
+        Parameters:
+            depth: int, only load descendants down to this depth (None is unlimited).
+                   Nodes whose children are not loaded have "has_children" to be lazy loaded later
+            fields: keys of each node, subset of TREE_FIELDS
+        """
+        subtree = CatalogClosure.objects.filter(ancestor=self)
+        if depth is not None:
+            subtree = subtree.filter(depth__lte=depth)
+        columns = [f for f in fields if f not in ('id', 'parents', 'children')]
+        nodes = {
+            c['id']: c for c in Catalog.objects.filter(
+                models.Q(pk=self.pk) | models.Q(pk__in=subtree.values('descendant_id'))
+            ).values('id', *columns)
         }
+        edges = Catalog.parents.through.objects.filter(
+            models.Q(from_catalog_id__in=list(nodes)) | models.Q(to_catalog_id__in=list(nodes))
+        ).values_list('from_catalog_id', 'to_catalog_id')
+        parents = defaultdict(list)
+        children = defaultdict(list)
+        for child, parent in edges:
+            if child in nodes:
+                parents[child].append(parent)
+            children[parent].append(child)
+        position = {pk: i for i, pk in enumerate(nodes)}
+
+        def build(pk, visited):
+            visited = visited | {pk}
+            node = {'id': pk, **{f: nodes[pk][f] for f in columns}}
+            if 'parents' in fields:
+                node['parents'] = parents[pk]
+            loaded = sorted([c for c in children[pk] if c in position and c not in visited], key=position.get)
+            if depth is not None:
+                node['has_children'] = bool(children[pk])
+            node['children'] = [build(c, visited) for c in loaded]
+            return node
+        return build(self.pk, set())
 
     def delete(self, *args, **kwargs):
         """Delete all descendant of this catalog (include itself)"""
-        ids = self.get_all_descendant()
-        catalogs = Catalog.objects.filter(pk__in=ids)
-        catalogs.delete()
-        return super(Catalog, self).delete(*args, **kwargs)
+        deleted = Catalog.delete_trees([self.pk])
+        self.pk = None
+        return deleted
 
-    def get_ancestors(self):
-        ancester = [self]
-        try:
-            parent = self.parents.all()[0]
-        except IndexError:
-            return []
-        if self.level:
-            ancester.extend(parent.get_ancestors())
-        else:
-            return []
+    @classmethod
+    @transaction.atomic
+    def delete_trees(cls, catalog_ids):
+        """
+        Delete catalogs and all their descendants in one pass, whatever the size of the branches:
+        the descendants are resolved in one query and each related table is deleted in batches.
+        Return the result of QuerySet.delete()
+        """
+        ids = list(cls.objects.filter(
+            models.Q(pk__in=catalog_ids) | models.Q(ancestor_links__ancestor__in=catalog_ids)
+        ).values_list('pk', flat=True).distinct())
+        companies = set(cls.objects.filter(pk__in=ids).values_list('company_id', flat=True).distinct())
+        with defer_invalidation():
+            deleted = cls.objects.filter(pk__in=ids).defer('c_table').delete()
+        # Descendants are deleted too, no other cached ancestor refers to them
+        cache.delete_many([ANCESTOR_CACHE_KEY.format(pk) for pk in ids])
+        for company in companies:
+            invalidate_material_levels(company)
+        return deleted
+
+    def get_ancestor_chain(self):
+        """
+        Return this catalog followed by its ancestors, nearest first, in one query.
+        The chain follows the parent edges from this catalog: when a catalog is linked to many parents,
+        its first parent is used, so the chain is a single lineage.
+        """
+        edges = CatalogClosure.get_parent_edges(
+            models.Q(descendant=self) | models.Q(descendant__descendant_links__descendant=self)
+        ).select_related('ancestor').defer('ancestor__c_table')
+        parents = {}
+        catalogs = {self.pk: self}
+        for edge in edges:
+            if edge.descendant_id not in parents:
+                parents[edge.descendant_id] = edge.ancestor_id
+                catalogs[edge.ancestor_id] = edge.ancestor
+        return [catalogs[pk] for pk in CatalogClosure.follow_parents(self.pk, parents)]
+
+    @classmethod
+    def get_ancestor_chains(cls, catalog_ids, catalogs=None):
+        """
+        get_ancestor_chain of many catalogs in 2 queries, by catalog id.
+        Parameters:
+            catalogs: queryset the catalogs of the chains are loaded from, to defer or prefetch fields
+        """
+        edges = CatalogClosure.get_parent_edges(
+            models.Q(descendant__in=catalog_ids) | models.Q(descendant__descendant_links__descendant__in=catalog_ids)
+        ).values_list('descendant_id', 'ancestor_id')
+        parents = {}
+        for descendant, ancestor in edges:
+            parents.setdefault(descendant, ancestor)
+        chains = {pk: CatalogClosure.follow_parents(pk, parents) for pk in catalog_ids}
+        if catalogs is None:
+            catalogs = cls.objects.defer('c_table')
+        catalogs = catalogs.in_bulk(set().union(*chains.values()))
+        return {pk: [catalogs[c] for c in chain if c in catalogs] for pk, chain in chains.items() if pk in catalogs}
+
+    def get_ancestors(self, chain=None):
+        """
+        Return this catalog and its ancestors which belong to a level, nearest first.
+        Return an empty list when this catalog has no parent or no level.
+        """
+        if chain is None:
+            chain = self.get_ancestor_chain()
+        ancester = []
+        for c in chain[:-1]:
+            if not c.level_id:
+                break
+            ancester.append(c)
         return ancester
 
-    @lru_cache(128)
     def get_full_ancestor(self):
-        ancestor = self.get_ancestors()
-        first_ancestor = ancestor[-1]
-        ancestor.append(first_ancestor.parents.first())
-        first_ancestor = ancestor[-1]
-        ancestor.append(first_ancestor.parents.first())
+        """
+        Cached by catalog id in the Django cache, so it is shared by threads and processes
+        and stays valid across requests until invalidate_ancestors is called for this catalog
+        """
+        key = ANCESTOR_CACHE_KEY.format(self.pk)
+        ancestor = cache.get(key)
+        if ancestor is None:
+            chain = self.get_ancestor_chain()
+            # Never store the cost table in the cache
+            chain[0] = copy.copy(self)
+            chain[0].__dict__.pop('c_table', None)
+            try:
+                ancestor = self.get_full_ancestor_from_chain(chain)
+            except IndexError:
+                ancestor = []
+            prefetch_related_objects([c for c in ancestor if c], 'data_points')
+            cache.set(key, ancestor, ANCESTOR_CACHE_TIMEOUT)
+        if not ancestor:
+            raise IndexError('Catalog has no ancestor')
         return ancestor
 
+    def get_full_ancestor_from_chain(self, chain):
+        """
+        Ancestors which belong to a level, followed by the category and the root catalog.
+        Parameters:
+            chain: result of get_ancestor_chain
+        """
+        ancestor = self.get_ancestors(chain)
+        if not ancestor:
+            raise IndexError('Catalog has no ancestor')
+        rest = chain[len(ancestor):len(ancestor) + 2]
+        return ancestor + rest + [None] * (2 - len(rest))
+
     def get_ordered_levels(self):
         """
         Ancestor level will be the first and descendant will be the last
         """
-        levels = self.all_levels.all()
+        levels = list(self.all_levels.all())
         if not levels:
             return []
-        ancester = levels.get(parent=None)
-        return ancester.get_ordered_descendant()
+        roots = [level for level in levels if level.parent_id is None]
+        if not roots:
+            raise CatalogLevel.DoesNotExist('Catalog has no first level')
+        if len(roots) > 1:
+            raise CatalogLevel.MultipleObjectsReturned('Catalog has many first levels')
+        children = {level.parent_id: level for level in levels}
+        ordered = roots
+        while ordered[-1].pk in children:
+            ordered.append(children[ordered[-1].pk])
+        return ordered
 
     def link(self, pk):
         catalog = Catalog.objects.get(pk=pk)
@@ -160,59 +392,78 @@ class Catalog(BaseModel):
             names = Catalog.objects.filter(parents=parent, level=self.level).values_list('name', flat=True)
         except AttributeError:
             return ''
-        name = self.name
-        if name not in names:
-            return name
-        i = 1
-        while name in names:
-            if name.split(' ')[-1].isdigit():
-                name = ' '.join(name.split(' ')[:-1]) + ' ' + str(i)
-            else:
-                name = name + f' {i}'
-            i += 1
-        return name
+        return make_unique_name(self.name, names)
 
-    def clone(self, parent=None, data_points=[]):
-        c = copy.copy(self)
-        c.id = None
-        c.sequence = self.sequence + 1
-        c.name = c.get_unique_name(parent) or self.get_unique_name(parent)
-        c.save()
-        if parent:
-            c.parents.add(parent)
-        points = self.data_points.filter(id__in=data_points) if data_points else self.data_points.all()
-        d_points = []
-        for p in points:
-            params = {'value': p.value,
-                      'unit_id': p.unit_id,
-                      'linked_description': p.linked_description,
-                      'is_linked': p.is_linked,
-                      'catalog_id': c.id,
-                      'company': get_request().user.company}
-            d_points.append(DataPoint(**params))
-        DataPoint.objects.bulk_create(d_points)
-        return c
-
-    def duplicate(self, parent=None, depth=0, data_points=[]):
-        """
-        duplicate by depth (level)
-        """
-        c = self.clone(parent=parent, data_points=data_points)
-        if depth:
-            children = Catalog.objects.filter(parents__id=self.pk)
-            for child in children:
-                child.duplicate(parent=c, depth=depth-1, data_points=data_points)
-        return c
-
-    def duplicate_by_catalog(self, parent=None, descendant=[], data_points=[]):
-        """
-        duplicate by descendant
-        """
-        c = self.clone(parent=parent, data_points=data_points)
-        if descendant:
-            children = Catalog.objects.filter(parents__id=self.pk, id__in=descendant)
-            for child in children:
-                child.duplicate_by_catalog(parent=c, descendant=descendant, data_points=data_points)
+    @transaction.atomic
+    def duplicate(self, parent=None, depth=None, descendant=None, data_points=None):
+        """
+        Copy this catalog under parent with its descendants, one level at a time.
+        The subtree is loaded once, names are made unique in memory, then catalogs, parent links
+        and data points of each level are created with bulk_create.
+        Parameters:
+            depth: int, copy descendants down to this depth (None is unlimited)
+            descendant: list id, only copy descendants in this list
+            data_points: list id, only copy these data points (empty copies all of them)
+        Return {catalog id: id of its copy}
+        """
+        request = get_request()
+        user = request.user if request and not request.user.is_anonymous else None
+        nodes, _, children = self.get_subtree(depth)
+        points = DataPoint.objects.filter(catalog_id__in=list(nodes))
+        if data_points:
+            points = points.filter(id__in=data_points)
+        catalog_points = defaultdict(list)
+        for point in points:
+            catalog_points[point.catalog_id].append(point)
+        if descendant is not None:
+            descendant = {int(pk) for pk in descendant}
+
+        parent_id = parent.pk if parent else None
+        names = {(parent_id, self.level_id): list(
+            Catalog.objects.filter(parents=parent, level=self.level).values_list('name', flat=True)
+        )}
+        fields = [f.attname for f in Catalog._meta.concrete_fields if not f.primary_key]
+        mapping = {}
+        copies = []
+        current = [(nodes[self.pk], parent_id)]
+        current_depth = 0
+        while current:
+            level_copies = []
+            for catalog, new_parent in current:
+                c = Catalog(**{field: getattr(catalog, field) for field in fields})
+                c.sequence = catalog.sequence + 1
+                c.user_create = user
+                c.user_update = None
+                siblings = names.setdefault((new_parent, catalog.level_id), [])
+                c.name = make_unique_name(catalog.name, siblings)
+                siblings.append(c.name)
+                level_copies.append((catalog, c, new_parent))
+            Catalog.objects.bulk_create([c for _, c, _ in level_copies])
+            Catalog.parents.through.objects.bulk_create([
+                Catalog.parents.through(from_catalog_id=c.pk, to_catalog_id=new_parent)
+                for _, c, new_parent in level_copies if new_parent
+            ])
+            DataPoint.objects.bulk_create([
+                DataPoint(value=p.value, unit_id=p.unit_id, linked_description=p.linked_description,
+                          is_linked=p.is_linked, catalog_id=c.pk, company=user.company if user else None,
+                          user_create=user)
+                for catalog, c, _ in level_copies for p in catalog_points[catalog.pk]
+            ])
+
+            current = []
+            for catalog, c, _ in level_copies:
+                mapping[catalog.pk] = c.pk
+                copies.append(c)
+                if depth is not None and current_depth >= depth:
+                    continue
+                current.extend((child, c.pk) for child in children[catalog.pk]
+                               if descendant is None or child.pk in descendant)
+            current_depth += 1
+
+        CostTableRow.sync(copies)
+        CatalogClosure.refresh([c.pk for c in copies])
+        invalidate_material_levels(self.company_id)
+        return mapping
 
     def get_ancestor_linked_description(self):
         catalogs = self.get_ancestors()
@@ -226,12 +477,10 @@ class Catalog(BaseModel):
         """
         pk_catalog, row_index = material.split(':')
         pk_catalog, row_index = int(pk_catalog), int(row_index)
-        try:
-            d = self.c_table['data'][row_index]
-            header = self.c_table['header']
-            return {**{header[i]: d[i] for i in range(len(header))}, **{"id": f'{self.pk}:{row_index}'}}
-        except (KeyError, IndexError):
+        row = self.cost_table_rows.filter(row_index=row_index).first()
+        if not row:
             return {}
+        return row.get_material()
 
     def update_unit_c_table(self, old_name, new_name):
         c_table = self.c_table
@@ -243,6 +492,179 @@ class Catalog(BaseModel):
         return c_table, have_changed
 
 
+class CatalogClosure(models.Model):
+    """
+    Materialized ancestor/descendant pairs of the catalog tree, kept in sync with ``Catalog.parents``.
+    A catalog is not stored as its own ancestor.
+    """
+    class Meta:
+        db_table = 'catalog_closure'
+        unique_together = ('ancestor', 'descendant')
+        indexes = [models.Index(fields=['descendant', 'depth'])]
+
+    ancestor = models.ForeignKey(Catalog, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Catalog, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField(default=1)
+
+    @classmethod
+    def get_parent_edges(cls, query):
+        """Edges from catalogs to their direct parents matching ``query``, the first parent of a catalog first"""
+        ordering = [f'-ancestor__{f[1:]}' if f.startswith('-') else f'ancestor__{f}' for f in Catalog._meta.ordering]
+        return cls.objects.filter(query, depth=1).order_by(*ordering)
+
+    @staticmethod
+    def follow_parents(catalog_id, parents):
+        """
+        Ids of a catalog and its ancestors, nearest first, following ``parents``:
+        the id of the first parent of each catalog, by catalog id
+        """
+        chain = [catalog_id]
+        while chain[-1] in parents and parents[chain[-1]] not in chain:
+            chain.append(parents[chain[-1]])
+        return chain
+
+    @classmethod
+    @transaction.atomic
+    def refresh(cls, catalog_ids):
+        """
+        Recompute the ancestors of catalogs whose parents have changed, and of all their descendants.
+        Use a constant number of queries whatever the size of the subtree.
+        """
+        catalog_ids = set(catalog_ids)
+        if not catalog_ids:
+            return
+        nodes = catalog_ids | set(cls.objects.filter(ancestor_id__in=catalog_ids).values_list('descendant_id', flat=True))
+        parents = defaultdict(list)
+        outside = set()
+        edges = Catalog.parents.through.objects.filter(from_catalog_id__in=nodes)
+        for child, parent in edges.values_list('from_catalog_id', 'to_catalog_id'):
+            parents[child].append(parent)
+            if parent not in nodes:
+                outside.add(parent)
+
+        # Ancestors of catalogs outside of the subtree are not affected
+        ancestors = {pk: {} for pk in outside}
+        rows = cls.objects.filter(descendant_id__in=outside).values_list('ancestor_id', 'descendant_id', 'depth')
+        for ancestor, descendant, depth in rows:
+            ancestors[descendant][ancestor] = depth
+
+        def resolve(pk, visiting):
+            if pk in ancestors:
+                return ancestors[pk]
+            visiting.add(pk)
+            data = {}
+            for parent in parents[pk]:
+                if parent in visiting:
+                    continue
+                for ancestor, depth in [(parent, 0), *resolve(parent, visiting).items()]:
+                    if ancestor != pk and depth + 1 < data.get(ancestor, depth + 2):
+                        data[ancestor] = depth + 1
+            visiting.discard(pk)
+            ancestors[pk] = data
+            return data
+
+        cls.objects.filter(descendant_id__in=nodes).delete()
+        cls.objects.bulk_create(
+            [cls(ancestor_id=ancestor, descendant_id=pk, depth=depth)
+             for pk in nodes for ancestor, depth in resolve(pk, set()).items()],
+            batch_size=1000
+        )
+
+    @classmethod
+    def rebuild(cls, company=None):
+        """Rebuild the closure of every catalog, or catalogs of a company"""
+        catalogs = Catalog.objects.all()
+        if company:
+            catalogs = catalogs.filter(company=company)
+        cls.refresh(catalogs.values_list('pk', flat=True))
+
+
+class CostTableRow(models.Model):
+    """
+    One row of ``Catalog.c_table['data']``, kept in sync on every write of ``c_table``
+    so that materials can be looked up by index instead of scanning the JSON.
+    """
+    class Meta:
+        db_table = 'cost_table_row'
+        ordering = ['catalog', 'row_index']
+        unique_together = ('catalog', 'row_index')
+        indexes = [models.Index(fields=['company', 'name']),
+                   models.Index(fields=['company', 'unit'])]
+
+    catalog = models.ForeignKey(Catalog, on_delete=models.CASCADE, related_name='cost_table_rows')
+    company = models.ForeignKey('api.CompanyBuilder', on_delete=models.CASCADE, null=True, blank=True,
+                                related_name='cost_table_rows')
+    row_index = models.IntegerField()
+    name = models.TextField(blank=True, default='')
+    unit = models.TextField(blank=True, default='')
+    cost = models.DecimalField(max_digits=MAX_DIGIT, decimal_places=DECIMAL_PLACE, null=True, blank=True)
+    columns = models.JSONField(default=list, blank=True)  # [{"name": header, "value": value, "is_formula": bool, "default_value": value},]
+
+    @property
+    def material_id(self):
+        return f'{self.catalog_id}:{self.row_index}'
+
+    def get_material(self):
+        return {**{column['name']: column['value'] for column in self.columns}, **{"id": self.material_id}}
+
+    @staticmethod
+    def parse_cost(value):
+        try:
+            cost = Decimal(str(value).replace(',', ''))
+        except (InvalidOperation, ValueError):
+            return None
+        return cost if cost.is_finite() else None
+
+    @classmethod
+    def from_c_table(cls, catalog):
+        """Parse the cost table of a catalog into unsaved rows. Invalid old rows are ignored one by one"""
+        rows = []
+        c_table = catalog.c_table
+        if not c_table:
+            return rows
+        try:
+            header = c_table['header']
+            header_formats = [is_formula.get('isFormula') for is_formula in c_table.get('header_format', [])]
+            actual_data = c_table.get('actual_data', [])
+            data = c_table['data']
+        except (KeyError, TypeError, AttributeError):
+            """Some old data is not valid"""
+            return rows
+        for i, d in enumerate(data):
+            try:
+                actual_value = actual_data[i] if i < len(actual_data) else []
+                columns = [{'name': header[j], 'value': d[j] if j < len(d) else '',
+                            'is_formula': header_formats[j] if j < len(header_formats) else False,
+                            'default_value': actual_value[j] if j < len(actual_value) else 0}
+                           for j in range(len(header))]
+                values = [str(d[j]) if j < len(d) and d[j] is not None else '' for j in range(3)]
+            except (KeyError, IndexError, TypeError, AttributeError):
+                """Some old rows are not valid"""
+                continue
+            rows.append(cls(catalog_id=catalog.pk, company_id=catalog.company_id, row_index=i,
+                            name=values[0], unit=values[1], cost=cls.parse_cost(values[2]), columns=columns))
+        return rows
+
+    @classmethod
+    @transaction.atomic
+    def sync(cls, catalogs):
+        """Update the rows of the given catalogs in place from their current c_table, rows keep their id"""
+        catalogs = list(catalogs)
+        if not catalogs:
+            return
+        existing = {(catalog_id, row_index): pk for pk, catalog_id, row_index in
+                    cls.objects.filter(catalog__in=catalogs).values_list('pk', 'catalog_id', 'row_index')}
+        created, updated = [], []
+        for catalog in catalogs:
+            for row in cls.from_c_table(catalog):
+                row.pk = existing.pop((row.catalog_id, row.row_index), None)
+                (updated if row.pk else created).append(row)
+        if existing:
+            cls.objects.filter(pk__in=existing.values()).delete()
+        cls.objects.bulk_update(updated, ['company', 'name', 'unit', 'cost', 'columns'], batch_size=1000)
+        cls.objects.bulk_create(created, batch_size=1000)
+
+
 class CostTableTemplate(BaseModel):
     name = models.CharField(max_length=256, blank=True)
     c_table = models.JSONField(default=dict, blank=True)  # {"header": [col1, col2], "data": [[col2, col2],]}
@@ -60,16 +60,11 @@ class ChangeOrder(BaseModel):
                                                 related_name='change_order', symmetrical=False)
 
     def _get_formulas(self):
-        estimate_templates = self.existing_estimates.all()
-        for group in self.groups.all():
-            estimate_templates |= group.estimate_templates.all()
-        assembles = Assemble.objects.none()
-        for estimate in estimate_templates:
-            assembles |= estimate.assembles.all()
-        poformulas = POFormula.objects.none()
-        for assemble in assembles:
-            poformulas |= assemble.assemble_formulas.all()
-        return poformulas
+        assembles = Assemble.objects.filter(
+            models.Q(estimate_templates__change_order=self) |
+            models.Q(estimate_templates__change_order_group__change_order=self)
+        )
+        return POFormula.objects.filter(assemble__in=assembles)
 
     def _get_flat_rate(self):
         flat_rates = FlatRate.objects.none()
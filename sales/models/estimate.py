@@ -1,13 +1,17 @@
+import re
+from collections import defaultdict
 from decimal import Decimal
 from django.db import models
 from django.apps import apps
 from django.contrib.postgres.fields import ArrayField
-from django.db.models import Sum
+from django.db.models import Count, Max, Q, Sum
+from django.utils import timezone
 from api.middleware import get_request
 
 from api.models import BaseModel
-from base.constants import DECIMAL_PLACE, MAX_DIGIT, null, true, false
-from sales.models import Catalog
+from base.constants import DECIMAL_PLACE, MAX_DIGIT
+from base.utils import parse_literal
+from sales.models import Catalog, CostTableRow
 
 
 class UnitLibrary(BaseModel):
@@ -19,7 +23,9 @@ class UnitLibrary(BaseModel):
 
     def get_related_cost_table(self, unit_name):
         model = apps.get_model(app_label='sales', model_name='Catalog')
-        catalogs = model.objects.filter(c_table__data__icontains=unit_name, company=get_request().user.company)
+        catalogs = model.objects.filter(
+            pk__in=CostTableRow.objects.filter(unit=unit_name, company=get_request().user.company).values('catalog_id')
+        )
         return catalogs
 
 
@@ -106,9 +112,70 @@ class POFormula(BaseModel):
     order_quantity = models.DecimalField(max_digits=MAX_DIGIT, decimal_places=DECIMAL_PLACE, blank=True, default=None, null=True)
     selected_description = models.IntegerField(blank=True, default=None, null=True)
     is_custom_po = models.BooleanField(blank=True, default=False)  # Used for proposal writing
+    material_id = models.CharField(max_length=64, blank=True, default='', db_index=True)  # "catalog_id:row_index" of material
+
+    # Fields changing the totals of proposals
+    TOTAL_FIELDS = ('assemble_id', 'charge', 'total_cost', 'markup')
+    # Fields changing the dependencies of the formula
+    DEPENDENCY_FIELDS = ('assemble_id', 'formula', 'formula_mentions')
+    # Fields changing which formulas can name the formula
+    REFERENCE_FIELDS = ('assemble_id', 'company_id', 'name', 'is_show')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_totals = instance.get_totals()
+        instance._loaded_dependencies = instance.get_values(cls.DEPENDENCY_FIELDS)
+        instance._loaded_references = instance.get_values(cls.REFERENCE_FIELDS)
+        return instance
+
+    def get_values(self, fields):
+        return {field: self.__dict__.get(field) for field in fields}
+
+    def get_totals(self):
+        return self.get_values(self.TOTAL_FIELDS)
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        self.material_id = self.get_material_id()
+        if update_fields is not None and 'material' in update_fields:
+            update_fields = [*update_fields, 'material_id']
+        super().save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+
+    def get_material_id(self):
+        """Id of the cost table row used as material, '' when the material is not from a catalog"""
+        try:
+            material = parse_literal(self.material)
+        except ValueError:
+            return ''
+        material_id = material.get('id') if isinstance(material, dict) else None
+        if isinstance(material_id, str) and ':' in material_id:
+            return material_id[:64]
+        return ''
+
+    def get_referrers(self):
+        """Formulas using this formula, read from the edges of the dependency graph"""
+        return POFormula.objects.filter(dependencies__formula_ref=self).distinct()
+
+    def rename_references(self, old_name, referrers):
+        """
+        Replace the old name of this formula in the formulas using it, only whole names are replaced.
+        ``referrers`` are read by get_referrers before the rename, then their edges are rebuilt
+        """
+        pattern = re.compile(rf'(?<!\w){re.escape(old_name)}(?!\w)')
+        renamed = []
+        for formula in referrers:
+            text = pattern.sub(lambda match: self.name, formula.formula)
+            mentions = pattern.sub(lambda match: self.name, formula.formula_mentions)
+            if (text, mentions) == (formula.formula, formula.formula_mentions):
+                continue
+            formula.formula, formula.formula_mentions = text, mentions
+            formula.modified_date = timezone.now()
+            renamed.append(formula)
+        POFormula.objects.bulk_update(renamed, ['formula', 'formula_mentions', 'modified_date'], batch_size=128)
+        POFormulaDependency.refresh(renamed)
 
     def parse_material(self):
-        primary_key = eval(self.material)
+        primary_key = parse_literal(self.material)
         pk_catalog, row_index = primary_key.get('id').split(':')
         return pk_catalog, row_index
 
@@ -123,8 +190,8 @@ class POFormula(BaseModel):
     def get_catalog(self):
         default = {'name' : ''}
         try:
-            material = eval(self.material)
-        except NameError:
+            material = parse_literal(self.material)
+        except ValueError:
             return default
         if material:
             try:
@@ -200,6 +267,159 @@ class POFormula(BaseModel):
         return ((100 + self.markup)/100) * self.get_unit_price()
 
 
+def topological_order(nodes, uses):
+    """
+    Kahn's algorithm: order nodes so that a node comes after every node it uses.
+    Nodes on a circular reference (or using one) are left out.
+    """
+    nodes = set(nodes)
+    dependents = defaultdict(list)
+    remaining = {}
+    for pk in nodes:
+        refs = uses[pk] & nodes
+        remaining[pk] = len(refs)
+        for ref in refs:
+            dependents[ref].append(pk)
+    order = sorted(pk for pk, count in remaining.items() if not count)
+    for pk in order:
+        for dependent in sorted(dependents[pk]):
+            remaining[dependent] -= 1
+            if not remaining[dependent]:
+                order.append(dependent)
+    return order
+
+
+class POFormulaDependency(models.Model):
+    """
+    Edge of the formula dependency graph: ``formula`` uses the value of exactly one of ``formula_ref``,
+    ``data_entry`` or ``data_view``. Rebuilt by ``refresh`` when the text of a formula changes.
+    """
+    class Meta:
+        db_table = 'po_formula_dependency'
+
+    # Data entries are mentioned as $[name](pk) in formula_mentions
+    DATA_ENTRY_MENTION = re.compile(r'\$\[[^\]]*\]\((\d+)\)')
+
+    formula = models.ForeignKey(POFormula, on_delete=models.CASCADE, related_name='dependencies')
+    formula_ref = models.ForeignKey(POFormula, on_delete=models.CASCADE, null=True, related_name='dependents')
+    data_entry = models.ForeignKey('sales.DataEntry', on_delete=models.CASCADE, null=True, related_name='dependents')
+    data_view = models.ForeignKey('sales.DataView', on_delete=models.CASCADE, null=True, related_name='dependents')
+
+    @classmethod
+    def get_references(cls, formula, formula_mentions='', assemble_id=None, company=None, exclude=None):
+        """
+        Parse the nodes used by a formula: formulas (of the same assemble, or formula templates of the
+        company when the formula has no assemble) and data views of its estimates referenced by name,
+        and data entries mentioned in formula_mentions.
+        Return a dict of field name to set of ids.
+        """
+        references = {'formula_ref': set(), 'data_entry': set(), 'data_view': set()}
+        if assemble_id:
+            formulas = POFormula.objects.filter(assemble_id=assemble_id)
+            data_views = DataView.objects.filter(estimate_template__assembles=assemble_id)
+        else:
+            formulas = POFormula.objects.filter(company=company, is_show=True, assemble__isnull=True)
+            data_views = DataView.objects.none()
+        for field, queryset in (('formula_ref', formulas.exclude(pk=exclude)), ('data_view', data_views)):
+            names = defaultdict(set)
+            for pk, name in queryset.values_list('pk', 'name'):
+                if name:
+                    names[name].add(pk)
+            if not names or not formula:
+                continue
+            # Longest names first so that "Wall Area" is not read as "Wall"
+            pattern = '|'.join(re.escape(name) for name in sorted(names, key=len, reverse=True))
+            for match in re.finditer(rf'(?<!\w)(?:{pattern})(?!\w)', formula):
+                references[field] |= names[match.group()]
+        data_entries = {int(pk) for pk in cls.DATA_ENTRY_MENTION.findall(formula_mentions or '')}
+        if data_entries:
+            references['data_entry'] = set(DataEntry.objects.filter(pk__in=data_entries).values_list('pk', flat=True))
+        return references
+
+    @classmethod
+    def refresh(cls, formulas):
+        """Rebuild the edges of these formulas from their text"""
+        edges = []
+        for formula in formulas:
+            references = cls.get_references(formula.formula, formula.formula_mentions, formula.assemble_id,
+                                            formula.company_id, exclude=formula.pk)
+            edges.extend(cls(formula_id=formula.pk, **{f'{field}_id': pk})
+                         for field, ids in references.items() for pk in ids)
+        cls.objects.filter(formula__in=[formula.pk for formula in formulas]).delete()
+        cls.objects.bulk_create(edges, batch_size=1000)
+
+    @classmethod
+    def refresh_referrers(cls, formula):
+        """
+        Rebuild the edges of the formulas which may name ``formula`` after it was created, renamed or moved:
+        the formulas using it and the formulas of its scope with its name in their text
+        """
+        query = Q(dependencies__formula_ref=formula)
+        if formula.name:
+            if formula.assemble_id:
+                query |= Q(assemble_id=formula.assemble_id, formula__contains=formula.name)
+            elif formula.is_show:
+                query |= Q(company=formula.company_id, assemble__isnull=True, formula__contains=formula.name)
+        referrers = POFormula.objects.filter(query).exclude(pk=formula.pk).distinct()
+        cls.refresh(list(referrers.only('formula', 'formula_mentions', 'assemble', 'company')))
+
+    @classmethod
+    def rebuild(cls, company=None):
+        """Rebuild the edges of every formula, or formulas of a company"""
+        formulas = POFormula.objects.exclude(formula='', formula_mentions='')
+        if company:
+            formulas = formulas.filter(company=company)
+        batch = []
+        for formula in formulas.only('formula', 'formula_mentions', 'assemble', 'company').iterator():
+            batch.append(formula)
+            if len(batch) == 1000:
+                cls.refresh(batch)
+                batch = []
+        cls.refresh(batch)
+
+    @classmethod
+    def depends_on(cls, formula_ids, target):
+        """Whether one of these formulas uses the formula ``target``, directly or not"""
+        seen = set()
+        nodes = set(formula_ids)
+        while nodes:
+            if target in nodes:
+                return True
+            seen |= nodes
+            nodes = set(cls.objects.filter(
+                formula__in=nodes, formula_ref__isnull=False
+            ).values_list('formula_ref', flat=True)) - seen
+        return False
+
+    @classmethod
+    def get_affected(cls, formula_ids=(), data_entry_ids=(), data_view_ids=()):
+        """
+        Formulas to re-evaluate when these nodes change, in topological order: a formula comes after
+        every formula it uses. Changed formulas themselves are included first.
+        One query per level of the graph. Raise ValueError when the affected formulas have a circular reference.
+        """
+        edges = cls.objects.filter(
+            models.Q(formula_ref__in=formula_ids) | models.Q(data_entry__in=data_entry_ids) |
+            models.Q(data_view__in=data_view_ids)
+        )
+        affected = set(formula_ids)
+        uses = defaultdict(set)
+        while edges is not None:
+            nodes = set()
+            for formula, formula_ref in edges.values_list('formula', 'formula_ref'):
+                if formula_ref:
+                    uses[formula].add(formula_ref)
+                if formula not in affected:
+                    nodes.add(formula)
+            affected |= nodes
+            edges = cls.objects.filter(formula_ref__in=nodes) if nodes else None
+
+        order = topological_order(affected, uses)
+        if len(order) < len(affected):
+            raise ValueError(f'Formulas {sorted(affected - set(order))} have a circular reference')
+        return order
+
+
 class POFormulaToDataEntry(BaseModel):
     data_entry = models.ForeignKey(DataEntry, on_delete=models.CASCADE, blank=True, null=True)
     po_formula = models.ForeignKey(POFormula, on_delete=models.CASCADE, blank=True,
@@ -364,36 +584,63 @@ class EstimateTemplate(BaseModel):
         return self.name
 
     def sync_data_entries(self):
-        # Delete POFormulaToDataEntry with no data entry
-        POFormulaToDataEntry.objects.filter(estimate_template=self, data_entry__isnull=true).delete()
-        # Delete POFormulaToDataEntry with no formula
-        objs = POFormulaToDataEntry.objects.filter(estimate_template=self)
-        for obj in objs:
-            if POFormula.objects.filter(formula_for_data_view__in=[e['formula'] for e in obj.copies_from]).exists():
-                obj.delete()
+        """
+        Link the estimate to the data entries of its formulas. Current links and the formula/data entry pairs
+        are loaded in two queries, the difference is applied with one delete and one bulk_create.
+        """
+        links = POFormulaToDataEntry.objects.filter(estimate_template=self)
+        current = list(links.values_list('pk', 'data_entry', 'copies_from'))
+        # Delete POFormulaToDataEntry with no data entry, or copied from a formula used for data view
+        copied = {e.get('formula') for _, _, copies_from in current for e in copies_from or []}
+        used = set(POFormula.objects.filter(
+            formula_for_data_view__in=copied
+        ).values_list('formula_for_data_view', flat=True).distinct()) if copied else set()
+        removed = [pk for pk, data_entry, copies_from in current
+                   if data_entry is None or any(e.get('formula') in used for e in copies_from or [])]
+        if removed:
+            links.filter(pk__in=removed).delete()
+        existing = {data_entry for pk, data_entry, _ in current if pk not in removed}
 
         # Get data entries from formula
-        data_entries = DataEntry.objects.filter(poformulatodataentry__po_formula__in=self.get_formula()).distinct()
-        for data_entry in data_entries:
-            obj, is_created = POFormulaToDataEntry.objects.get_or_create(estimate_template=self, data_entry=data_entry)
-            if is_created:
-                # Get formula from data entry
-                formulas = self.get_formula().filter(self_data_entries__data_entry=data_entry)
-                obj.copies_from = [{'id': POFormulaToDataEntry.objects.get(po_formula=formula, data_entry=data_entry).pk,
-                                    'formula': formula.formula_for_data_view, 'data_entry': data_entry.pk, 'formula_name': formula.name}
-                                   for formula in formulas]
-                if obj.copies_from:
-                    default_obj = POFormulaToDataEntry.objects.get(pk=obj.copies_from[0]['id'])
-                    obj.value = default_obj.value
-                    obj.dropdown_value = default_obj.dropdown_value
-                obj.save()
+        pairs = POFormulaToDataEntry.objects.filter(
+            po_formula__in=self.get_formula(), data_entry__isnull=False
+        ).values_list('pk', 'data_entry', 'po_formula', 'po_formula__name', 'po_formula__formula_for_data_view',
+                      'value', 'dropdown_value').order_by('po_formula', 'pk')
+        copies = defaultdict(dict)
+        for pk, data_entry, formula, name, formula_for_data_view, value, dropdown_value in pairs:
+            if data_entry not in existing and formula not in copies[data_entry]:
+                copies[data_entry][formula] = ({'id': pk, 'formula': formula_for_data_view, 'data_entry': data_entry,
+                                                'formula_name': name}, value, dropdown_value)
+
+        request = get_request()
+        user = request.user if request and not request.user.is_anonymous else None
+        created = []
+        for data_entry, formulas in copies.items():
+            copies_from = [copy for copy, _, _ in formulas.values()]
+            _, value, dropdown_value = next(iter(formulas.values()))
+            created.append(POFormulaToDataEntry(
+                estimate_template=self, data_entry_id=data_entry, copies_from=copies_from, value=value,
+                dropdown_value=dropdown_value, user_create=user, company=user.company if user else None
+            ))
+        POFormulaToDataEntry.objects.bulk_create(created)
 
     def get_formula(self):
-        assembles = self.assembles.all()
-        poformulas = POFormula.objects.none()
-        for assemble in assembles:
-            poformulas |= assemble.assemble_formulas.all()
-        return poformulas
+        return POFormula.objects.filter(assemble__in=self.assembles.all())
+
+    def calculate(self, data_entry_values=None, save=False):
+        """
+        Evaluate every formula of the estimate with the values of its data entries, or ``data_entry_values``.
+        Return {formula id: results} (see sales.calculator.calculate_formulas)
+        """
+        from sales.calculator import calculate_formulas, save_results
+
+        values = dict(self.data_entries.filter(data_entry__isnull=False).exclude(value='').values_list('data_entry', 'value'))
+        values.update({int(pk): value for pk, value in (data_entry_values or {}).items()})
+        formulas = list(self.get_formula())
+        results = calculate_formulas(formulas, values)
+        if save:
+            save_results(formulas, results)
+        return results
 
     def export_to_json(self):
         return [self.name]
@@ -408,44 +655,82 @@ class EstimateTemplate(BaseModel):
         return False
 
     def get_value_quantity(self):
-        if not self.quantity:
-            return Decimal(1)
-        name = self.quantity.get('name')
-        type = self.quantity.get('type')
-        data_entries = self.data_entries.all()
-        data_views = self.data_views.all()
-        formulas = self.get_formula()
-        value = 1
-        if not self.quantity.get('type'):
-            filtered = data_views.filter(name__exact=name)
-            if filtered:
-                value = filtered.first().result
-            filtered = data_entries.filter(data_entry__name__exact=name)
-            if filtered:
-                value = filtered.first().get_value()
-            filtered = formulas.filter(name__exact=name)
-            if filtered:
-                value = filtered.first().quantity
-        else:
-            if type == 'data_entry':
-                filtered = data_entries.filter(data_entry__name__exact=name)
-                if filtered:
-                    value = filtered.first().get_value()
-            if type == 'data_view':
-                filtered = data_views.filter(name__exact=name)
-                if filtered:
-                    value = filtered.first().result
-            if type == 'po':
-                filtered = formulas.filter(name__exact=name)
-                if filtered:
-                    value = filtered.first().quantity
-        value = 1 if value == None else value
-        return Decimal(value)
+        if not hasattr(self, '_value_quantity'):
+            EstimateTemplate.resolve_quantities([self])
+        return self._value_quantity
+
+    @classmethod
+    def resolve_quantities(cls, estimates):
+        """
+        Resolve get_value_quantity of estimates in three queries whatever their number: the data view,
+        data entry or formula named by the quantity of each estimate. Return the estimates as a list.
+        """
+        estimates = list(estimates)
+        names = {estimate.quantity.get('name') for estimate in estimates if estimate.quantity}
+        found = defaultdict(dict)
+        if names:
+            # Ordered by pk so that the first match of each name wins, as with first()
+            data_views = DataView.objects.filter(estimate_template__in=estimates, name__in=names).order_by('-pk')
+            for estimate, name, result in data_views.values_list('estimate_template', 'name', 'result'):
+                found[('data_view', estimate)][name] = result
+            data_entries = POFormulaToDataEntry.objects.filter(
+                estimate_template__in=estimates, data_entry__name__in=names
+            ).select_related('data_entry').order_by('-pk')
+            for data_entry in data_entries:
+                found[('data_entry', data_entry.estimate_template_id)][data_entry.data_entry.name] = data_entry.get_value()
+            formulas = POFormula.objects.filter(assemble__estimate_templates__in=estimates, name__in=names).order_by('-pk')
+            for estimate, name, quantity in formulas.values_list('assemble__estimate_templates', 'name', 'quantity'):
+                found[('po', estimate)][name] = quantity
+
+        for estimate in estimates:
+            value = 1
+            if estimate.quantity:
+                name = estimate.quantity.get('name')
+                type = estimate.quantity.get('type')
+                # Without type, formulas take precedence over data entries, then data views
+                for source in ('data_view', 'data_entry', 'po') if not type else (type,):
+                    if name in found[(source, estimate.pk)]:
+                        value = found[(source, estimate.pk)][name]
+            estimate._value_quantity = Decimal(1 if value is None else value)
+        return estimates
+
+    INFO_FIELDS = {'total_charge': 'charge', 'unit_cost': 'cost', 'unit_price': 'unit_price', 'quantity': 'quantity',
+                   'total_cost': 'total_cost'}
 
     def get_info(self):
-        self.info = self.get_formula().aggregate(total_charge=Sum('charge'), unit_cost=Sum('cost'),
-                                                 unit_price=Sum('unit_price'), quantity=Sum('quantity'),
-                                                 total_cost=Sum('total_cost'))
+        self.info = self.get_formula().aggregate(**{name: Sum(field) for name, field in self.INFO_FIELDS.items()})
+
+    @classmethod
+    def resolve_info(cls, estimates):
+        """Set the info of get_info on estimates in one query whatever their number, return the estimates as a list"""
+        estimates = list(estimates)
+        infos = POFormula.objects.filter(assemble__estimate_templates__in=estimates).values(
+            'assemble__estimate_templates'
+        ).annotate(**{name: Sum(field) for name, field in cls.INFO_FIELDS.items()}).order_by()
+        infos = {info.pop('assemble__estimate_templates'): info for info in infos}
+        for estimate in estimates:
+            estimate.info = infos.get(estimate.pk, dict.fromkeys(cls.INFO_FIELDS))
+        return estimates
+
+    @classmethod
+    def get_versions(cls, estimates):
+        """
+        Version of each estimate by id: its modified date, and the last modified date and number of its formulas,
+        data views and data entries. Any change of what an estimate shows changes its version.
+        """
+        versions = {pk: [modified_date] for pk, modified_date in estimates.values_list('pk', 'modified_date')}
+        related = (
+            (POFormula.objects.filter(assemble__estimate_templates__in=versions), 'assemble__estimate_templates'),
+            (DataView.objects.filter(estimate_template__in=versions), 'estimate_template'),
+            (POFormulaToDataEntry.objects.filter(estimate_template__in=versions), 'estimate_template'),
+        )
+        for queryset, field in related:
+            stamps = {pk: (modified_date, count) for pk, modified_date, count in queryset.values(field).annotate(
+                last=Max('modified_date'), count=Count('pk')
+            ).order_by().values_list(field, 'last', 'count')}
+            for pk, version in versions.items():
+                version.append(stamps.get(pk))
+        return {pk: tuple(version) for pk, version in versions.items()}
 
     def get_total_prices(self):
         return self.info.get('total_charge')
@@ -7,6 +7,9 @@ from django.contrib.postgres.fields import ArrayField
 from api.models import BaseModel
 from base.constants import DECIMAL_PLACE, MAX_DIGIT
 
+# Key of the DocumentSnapshot of the template data of an invoice, by invoice id
+INVOICE_DOCUMENT_KEY = 'invoice-template-{}'
+INVOICE_HTML_KEY = 'invoice-template-html-{}'
 
 class TableInvoice(BaseModel):
     class TableTypeInvoice(models.TextChoices):
@@ -1,12 +1,73 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 from decimal import Decimal
-from django.db import models
+from django.db import models, transaction
 from django.contrib.postgres.fields import ArrayField
 from django.utils import timezone
-from django.db.models import Sum
+from django.core.cache import cache
+from django.db.models import Count, Max, Sum
 
 from api.models import BaseModel
-from sales.models import EstimateTemplate, Assemble, POFormula, Catalog
-from base.constants import DECIMAL_PLACE, MAX_DIGIT, true, null, false
+from sales.models import EstimateTemplate, Assemble, POFormula, POFormulaToDataEntry, Catalog
+from base.constants import DECIMAL_PLACE, MAX_DIGIT
+
+
+IMAGES_CACHE_KEY = 'proposal-images-{}-{}-{}'
+# Keys of the DocumentSnapshot of the formatting of a proposal (by proposal id) and of its html page (by formatting id)
+PROPOSAL_DOCUMENT_KEY = 'proposal-formatting-{}'
+PROPOSAL_HTML_KEY = 'proposal-formatting-html-{}'
+IMAGES_CACHE_TIMEOUT = 60 * 60 * 24
+_queue = threading.local()
+
+
+@contextmanager
+def batch_proposal_updates():
+    """
+    Queue the proposal updates of formulas changed inside the block and apply them once at the end.
+    Nested blocks join the outermost one, which applies the queue
+    """
+    depth = getattr(_queue, 'depth', 0)
+    if not depth:
+        _queue.assembles, _queue.updated = set(), set()
+    _queue.depth = depth + 1
+    try:
+        yield
+    finally:
+        _queue.depth = depth
+        if not depth:
+            assemble_ids, _queue.assembles, _queue.updated = _queue.assembles, None, None
+            if assemble_ids:
+                ProposalWriting.update_estimates(assemble_ids)
+
+
+def flush_proposal_updates():
+    """
+    Apply the queued proposal updates now, so that totals read inside the batch are current.
+    Return the proposals updated by the flushes of the batch
+    """
+    assemble_ids = getattr(_queue, 'assembles', None)
+    if assemble_ids is None:
+        return set()
+    if assemble_ids:
+        _queue.assembles = set()
+        _queue.updated |= ProposalWriting.update_estimates(assemble_ids)
+    return _queue.updated
+
+
+def queue_proposal_update(assemble_ids):
+    """
+    Queue assembles whose formula totals changed. Inside batch_proposal_updates (every request)
+    their proposals are updated once at the end, otherwise when the transaction commits
+    """
+    assemble_ids = set(assemble_ids) - {None}
+    if not assemble_ids:
+        return
+    queued = getattr(_queue, 'assembles', None)
+    if queued is None:
+        transaction.on_commit(lambda: ProposalWriting.update_estimates(assemble_ids))
+    else:
+        queued.update(assemble_ids)
 
 
 class ProposalTemplate(BaseModel):
@@ -61,17 +122,8 @@ class PriceComparison(BaseModel):
                              blank=True, null=True)
 
     def get_formulas(self):
-        groups = self.groups.all()
-        estimates = EstimateTemplate.objects.none()
-        for group in groups:
-            estimates |= group.estimate_templates.all()
-        assembles = Assemble.objects.none()
-        for estimate in estimates:
-            assembles |= estimate.assembles.all()
-        poformulas = POFormula.objects.none()
-        for assemble in assembles:
-            poformulas |= assemble.assemble_formulas.all()
-        return poformulas
+        assembles = Assemble.objects.filter(estimate_templates__group_price__price_comparison=self)
+        return POFormula.objects.filter(assemble__in=assembles)
 
 
 class ProposalStatus(models.TextChoices):
@@ -121,79 +173,158 @@ class ProposalWriting(BaseModel):
     def __str__(self):
         return self.name
 
+    # Totals of a group type, prefixed by the group type
+    TOTAL_FIELDS = ('total_project_price', 'total_project_cost', 'gross_profit', 'avg_markup', 'gross_profit_percent')
+
+    @staticmethod
+    def get_group_fields():
+        """(group type, prefix of its total fields, its breakdown field) of each group type"""
+        return ((GroupByEstimate.Type.GENERAL, '', 'cost_breakdown'),
+                (GroupByEstimate.Type.ADD_ON, 'add_on_', 'add_on_cost_breakdown'),
+                (GroupByEstimate.Type.ADDITIONAL_COST, 'additional_cost_', 'additional_cost_breakdown'))
+
     def sync_data(self):
-        self.cost_breakdown = self.sync_data_type(type=GroupByEstimate.Type.GENERAL)
-        self.add_on_cost_breakdown = self.sync_data_type(type=GroupByEstimate.Type.ADD_ON)
-        self.additional_cost_breakdown = self.sync_data_type(type=GroupByEstimate.Type.ADDITIONAL_COST)
-        self.save(update_fields=['cost_breakdown', 'add_on_cost_breakdown', 'additional_cost_breakdown'])
+        """Update the cost breakdown of the three group types from one query grouped by estimate"""
+        rollups = self.get_estimate_rollups()
+        update_fields = []
+        for type, _, field in self.get_group_fields():
+            setattr(self, field, [self.get_cost_breakdown(rollup) for rollup in rollups
+                                  if rollup['group_by_proposal__type'] == type])
+            update_fields.append(field)
+        self.save(update_fields=update_fields)
 
     def update_info(self):
-        total_charge, total_cost, gross_profit, markup, gross_profit_percent = self.calculation_formula(self.get_formulas(type=GroupByEstimate.Type.GENERAL))
-        self.gross_profit = gross_profit
-        self.avg_markup = markup
-        self.total_project_price = total_charge
-        self.gross_profit_percent = gross_profit_percent
-        self.total_project_cost = total_cost
-        self.save(update_fields=['total_project_price', 'total_project_cost', 'gross_profit', 'avg_markup', 'gross_profit_percent'])
-
-    def sync_data_type(self, type):
-        data = []
-        for estimate in self.get_estimates(type=type):
-            formulas = estimate.get_formula()
-            # Sum charge field for formulas
-            total_charge, total_cost, gross_profit, markup, gross_profit_percent = self.calculation_formula(formulas)
-            data.append({'id': estimate.original, 'cost': str(total_cost), 'count': formulas.count(), 'total_price': total_charge,
-                        'profit': str(gross_profit.quantize(Decimal('1.00'))),  'markup': str(markup), 'name': estimate.name,
-                        'profit_percent': f'{gross_profit_percent:.2f})'})
-        return data
+        self.save(update_fields=self.set_totals())
+
+    @classmethod
+    def update_estimates(cls, assemble_ids):
+        """
+        Incremental sync_data then update_info: rebuild the breakdowns of the group types with an estimate using
+        these assembles only, then the general totals when a general estimate changed. Entries are rebuilt from
+        the estimates of the group, so an estimate keeps one entry whatever its name.
+        Return the ids of the updated proposals
+        """
+        changed = set(EstimateTemplate.objects.filter(
+            assembles__in=assemble_ids, group_by_proposal__writing__isnull=False
+        ).values_list('group_by_proposal__writing', 'group_by_proposal__type'))
+        estimates = EstimateTemplate.objects.filter(group_by_proposal__writing__in={pk for pk, _ in changed},
+                                                    group_by_proposal__type__in={type for _, type in changed})
+        rollups = defaultdict(list)
+        for rollup in cls.rollup(estimates):
+            rollups[rollup['group_by_proposal__writing']].append(rollup)
+
+        for proposal in cls.objects.filter(pk__in=list(rollups)):
+            update_fields = []
+            for type, _, field in cls.get_group_fields():
+                if (proposal.pk, type) not in changed:
+                    continue
+                setattr(proposal, field, [proposal.get_cost_breakdown(rollup) for rollup in rollups[proposal.pk]
+                                          if rollup['group_by_proposal__type'] == type])
+                update_fields.append(field)
+                if type == GroupByEstimate.Type.GENERAL:
+                    update_fields.extend(proposal.set_totals())
+            proposal.save(update_fields=update_fields)
+        return set(rollups)
+
+    def get_estimate_rollups(self, type=None):
+        return self.rollup(self.get_estimates(type=type))
+
+    @staticmethod
+    def rollup(estimates):
+        """Sum the formulas of each estimate in one query grouped by estimate"""
+        formula = 'assembles__assemble_formulas__'
+        return list(estimates.values(
+            'id', 'original', 'name', 'group_by_proposal__type', 'group_by_proposal__writing'
+        ).annotate(
+            total_charge=Sum(formula + 'charge'), total_costs=Sum(formula + 'total_cost'),
+            avg_markup=Sum(formula + 'markup'), count=Count(formula + 'id')
+        ).order_by('id'))
+
+    def get_cost_breakdown(self, rollup):
+        total_charge, total_cost, gross_profit, markup, gross_profit_percent = self.calculation_aggregate(rollup)
+        return {'id': rollup['original'], 'cost': str(total_cost), 'count': rollup['count'], 'total_price': float(total_charge),
+                'profit': str(gross_profit.quantize(Decimal('1.00'))), 'markup': str(markup), 'name': rollup['name'],
+                'profit_percent': f'{gross_profit_percent:.2f}'}
+
+    @classmethod
+    def get_total_fields(cls):
+        """Breakdown and total fields of the three group types"""
+        return [name for _, prefix, field in cls.get_group_fields()
+                for name in (field, *(prefix + total for total in cls.TOTAL_FIELDS))]
+
+    def apply_queued_totals(self):
+        """Apply the totals queued by the formulas changed in the current batch before they are read"""
+        if self.pk in flush_proposal_updates():
+            self.refresh_from_db(fields=self.get_total_fields())
+
+    def set_totals(self):
+        """Set the general totals from the formulas of the general estimates, return the updated fields"""
+        totals = self.calculation_formula(self.get_formulas(type=GroupByEstimate.Type.GENERAL))
+        for field, value in zip(self.TOTAL_FIELDS, totals):
+            setattr(self, field, value)
+        return list(self.TOTAL_FIELDS)
 
     def calculation_formula(self, formulas):
         aggregate = formulas.aggregate(total_charge=Sum('charge'), total_costs=Sum('total_cost'), avg_markup=Sum('markup'))
-        total_charge = aggregate.get('total_charge', Decimal(0)).quantize(Decimal('1.00'))
-        total_cost = aggregate.get('total_costs', Decimal(0)).quantize(Decimal('1.00'))
+        return self.calculation_aggregate(aggregate)
+
+    @staticmethod
+    def calculation_aggregate(aggregate):
+        total_charge = Decimal(aggregate.get('total_charge') or 0).quantize(Decimal('1.00'))
+        total_cost = Decimal(aggregate.get('total_costs') or 0).quantize(Decimal('1.00'))
         gross_profit = total_charge - total_cost
         gross_profit_percent = (gross_profit / total_charge) * 100 if total_charge != 0 else 0
-        markup = aggregate.get('avg_markup', Decimal(0)).quantize(Decimal('1.00'))
+        markup = Decimal(aggregate.get('avg_markup') or 0).quantize(Decimal('1.00'))
         return total_charge, total_cost, gross_profit, markup, gross_profit_percent
 
     def _get_poformula(self):
         return self.get_formulas()
 
     def get_estimates(self, type=None):
-        groups = self.writing_groups.all()
+        estimates = EstimateTemplate.objects.filter(group_by_proposal__writing=self)
         if type != None:
-            groups = self.writing_groups.filter(type=type)
-        estimates = EstimateTemplate.objects.none()
-        for group in groups:
-            estimates |= group.estimate_templates.all()
+            estimates = estimates.filter(group_by_proposal__type=type)
         return estimates
 
     def get_assembles(self, type=None):
-        estimates = self.get_estimates(type=type)
-        assembles = Assemble.objects.none()
-        for estimate in estimates:
-            assembles |= estimate.assembles.all()
-        return assembles
+        return Assemble.objects.filter(estimate_templates__in=self.get_estimates(type=type)).distinct()
 
     def get_formulas(self, type=None):
-        assembles = self.get_assembles(type=type)
-        poformulas = POFormula.objects.none()
-        for assemble in assembles:
-            poformulas |= assemble.assemble_formulas.all()
-        return poformulas
+        # An assemble linked to many estimates would duplicate its formulas in a join, filter by subquery
+        assembles = Assemble.objects.filter(estimate_templates__in=self.get_estimates(type=type))
+        return POFormula.objects.filter(assemble__in=assembles)
+
+    def calculate(self, save=False):
+        """
+        Evaluate the formulas of every estimate in one pass, each with the data entry values of its estimate.
+        Return {estimate id: {formula id: results}}
+        """
+        from sales.calculator import calculate_formulas, save_results
+
+        estimate_ids = list(self.get_estimates().values_list('pk', flat=True))
+        formulas = list(POFormula.objects.filter(assemble__estimate_templates__in=estimate_ids).annotate(
+            estimate=models.F('assemble__estimate_templates')
+        ))
+        values = defaultdict(dict)
+        data_entries = POFormulaToDataEntry.objects.filter(estimate_template__in=estimate_ids, data_entry__isnull=False)
+        for estimate, data_entry, value in data_entries.exclude(value='').values_list('estimate_template', 'data_entry', 'value'):
+            values[estimate][data_entry] = value
+        # A formula of an assemble shared by estimates is evaluated once
+        unique = list({formula.pk: formula for formula in formulas}.values())
+        results = calculate_formulas(unique, formula_values={formula.pk: values[formula.estimate] for formula in formulas})
+        if save:
+            save_results(unique, results)
+        data = {pk: {} for pk in estimate_ids}
+        for formula in formulas:
+            data[formula.estimate][formula.pk] = results[formula.pk]
+        return data
 
     def get_checked_estimate(self):
         return self.get_estimates().filter(is_selected=True)
 
     def get_checked_formula(self):
-        estimates = self.get_checked_estimate()
-        assembles = Assemble.objects.none()
-        for estimate in estimates:
-            assembles |= estimate.assembles.all()
-        poformulas = POFormula.objects.none()
-        for assemble in assembles:
-            poformulas |= assemble.assemble_formulas.all()
-        return poformulas
+        assembles = Assemble.objects.filter(estimate_templates__in=self.get_checked_estimate())
+        return POFormula.objects.filter(assemble__in=assembles)
 
     def get_data_formula(self):
         """Get data from po formula"""
@@ -212,23 +343,30 @@ class ProposalWriting(BaseModel):
             proposal_formatting.save()
 
     def get_imgs(self):
-        """Get image from catalog"""
-        poformulas = self._get_poformula()
+        """
+        Catalogs of the materials of the formulas, with their ancestors which belong to a level.
+        Catalog ids are read from material_id of the formulas, the ancestors from the closure table. The ids
+        are cached per version of the formulas, the catalogs themselves are always read again.
+        """
+        version = self.get_formulas().aggregate(last=Max('modified_date'), count=Count('pk'))
+        key = IMAGES_CACHE_KEY.format(self.pk, version['last'].timestamp() if version['last'] else None, version['count'])
+        ids = cache.get(key)
+        if ids is None:
+            ids = self.get_image_ids()
+            cache.set(key, ids, IMAGES_CACHE_TIMEOUT)
+        return list(Catalog.objects.defer('c_table').filter(pk__in=ids))
+
+    def get_image_ids(self):
         catalog_ids = set()
-        for poformula in poformulas:
-            try:
-                primary_key = eval(poformula.material)
-            except SyntaxError:
-                continue
-            if isinstance(primary_key, dict) and primary_key:
-                """Somehow material on poformula is still string so we ignore this"""
-                pk_catalog, row_index = primary_key.get('id').split(':')
-                catalog_ids.add(pk_catalog)
-        catalogs = Catalog.objects.filter(pk__in=catalog_ids)
-        ancestors = []
-        for catalog in catalogs:
-            ancestors.extend(catalog.get_ancestors())
-        return set(ancestors)
+        for material_id in self.get_formulas().exclude(material_id='').values_list('material_id', flat=True).distinct():
+            pk_catalog = material_id.split(':')[0]
+            if pk_catalog.isdigit():
+                catalog_ids.add(int(pk_catalog))
+        # Same as Catalog.get_ancestors, from the chain of each catalog
+        images = set()
+        for chain in Catalog.get_ancestor_chains(catalog_ids, Catalog.objects.only('level')).values():
+            images.update(c.pk for c in chain[0].get_ancestors(chain))
+        return sorted(images)
 
 
 class ProposalFormatting(BaseModel):
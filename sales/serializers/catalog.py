@@ -1,10 +1,11 @@
+from django.db import transaction
 from django.utils import timezone
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from api.serializers.base import SerializerMixin
 from base.serializers.base import IDAndNameSerializer
-from base.constants import true, null, false
+from base.utils import parse_literal
 from ..models import catalog, Catalog
 
 
@@ -74,7 +75,7 @@ class CatalogImportSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         if validated_data['c_table']:
-            validated_data['c_table'] = eval(validated_data['c_table'])
+            validated_data['c_table'] = parse_literal(validated_data['c_table'])
         return super().create(validated_data)
 
 
@@ -117,7 +118,7 @@ class CatalogSerializer(serializers.ModelSerializer):
         data_points = validated_data.pop('data_points', '[]')
         count = 0
         if data_points:
-            data_points = eval(data_points)
+            data_points = parse_literal(data_points)
         else:
             data_points = []
         parent = validated_data.pop('parent', None)
@@ -153,7 +154,7 @@ class CatalogSerializer(serializers.ModelSerializer):
         data_points = validated_data.pop('data_points', '[]')
         company = self.context['request'].user.company
         if data_points:
-            data_points = eval(data_points)
+            data_points = parse_literal(data_points)
         else:
             data_points = []
         parent = validated_data.pop('parent', None)
@@ -225,7 +226,13 @@ class CatalogEstimateSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        data['data_point'] = instance.data_points.values('value', 'unit', 'linked_description', 'is_linked', 'catalog').first()
+        if 'data_points' in getattr(instance, '_prefetched_objects_cache', {}):
+            data_point = min(instance.data_points.all(), key=lambda p: p.pk, default=None)
+            data['data_point'] = data_point and {'value': data_point.value, 'unit': data_point.unit_id,
+                                                 'linked_description': data_point.linked_description,
+                                                 'is_linked': data_point.is_linked, 'catalog': data_point.catalog_id}
+        else:
+            data['data_point'] = instance.data_points.values('value', 'unit', 'linked_description', 'is_linked', 'catalog').first()
         return data
 
 
@@ -260,18 +267,20 @@ class DeleteCatalogSerializer(serializers.Serializer):
         deleted_catalogs = catalog.Catalog.objects.filter(pk__in=deleted_items)
 
         if is_delete_children:
-            for c in deleted_catalogs:
-                c.delete()
+            catalog.Catalog.delete_trees(deleted_items)
             return object
 
         tree = validated_data.get('tree')
-        for key in tree.keys():
-            parent = catalog.Catalog.objects.get(pk=key)
-            children = catalog.Catalog.objects.filter(pk__in=tree[key])
-            for child in children:
-                child.parents.clear()
-                child.parents.add(parent)
-        deleted_catalogs.delete()
+        # children are validated by validate_tree, move all of them at once
+        children = {int(child): int(key) for key in tree.keys() for child in tree[key]}
+        through = catalog.Catalog.parents.through
+        with transaction.atomic():
+            through.objects.filter(from_catalog_id__in=list(children)).delete()
+            through.objects.bulk_create([through(from_catalog_id=child, to_catalog_id=parent)
+                                         for child, parent in children.items()])
+            catalog.CatalogClosure.refresh(children)
+            deleted_catalogs.delete()
+        catalog.invalidate_ancestors(children)
 
         return object
 
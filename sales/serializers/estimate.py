@@ -7,18 +7,18 @@ from django.db.models import Sum
 from django.contrib.contenttypes.models import ContentType
 from django.db.utils import DataError
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from api.middleware import get_request
 from api.serializers.auth import UserSerializer
 from base.serializers.base import IDAndNameSerializer
-from base.constants import true, null, false
 from base.tasks import activity_log
-from base.utils import pop, extra_kwargs_for_base_model
-from sales.models import DataPoint, Catalog
+from base.utils import pop, extra_kwargs_for_base_model, parse_literal
+from sales.models import DataPoint, Catalog, CostTableRow
 from sales.models.estimate import Note, POFormula, POFormulaGrouping, DataEntry, POFormulaToDataEntry, RoundUpActionChoice, RoundUpChoice, \
-    UnitLibrary, DescriptionLibrary, Assemble, EstimateTemplate, DataView, MaterialView, GroupTemplate
+    POFormulaDependency, UnitLibrary, DescriptionLibrary, Assemble, EstimateTemplate, DataView, MaterialView, GroupTemplate
 from sales.serializers import ContentTypeSerializerMixin
 from sales.serializers.catalog import CatalogEstimateSerializer, DataPointForLinkDescription
 
@@ -111,8 +111,9 @@ class DataEntrySerializer(ContentTypeSerializerMixin):
                 obj = obj.po_formula
                 obj.formula = obj.formula.replace(old_name, new_name)
                 obj.formula_mentions = obj.formula_mentions.replace(old_name, new_name)
+                obj.modified_date = timezone.now()
                 data.append(obj)
-            POFormula.objects.bulk_update(data, ['formula', 'formula_mentions'], batch_size=128)
+            POFormula.objects.bulk_update(data, ['formula', 'formula_mentions', 'modified_date'], batch_size=128)
 
         activity_log.delay(instance.get_content_type().pk, instance.pk, 2,
                            DataEntrySerializer.__name__, __name__, self.context['request'].user.pk)
@@ -268,6 +269,17 @@ class POFormulaSerializer(ContentTypeSerializerMixin):
         extra_kwargs = {**{'id': {'read_only': False, 'required': False}}, **extra_kwargs_for_base_model()}
         read_only_fields = ('assemble', 'group')
 
+    def validate(self, validated_data):
+        instance = self.instance
+        if isinstance(instance, POFormula) and 'formula' in validated_data:
+            references = POFormulaDependency.get_references(
+                validated_data['formula'], validated_data.get('formula_mentions', instance.formula_mentions),
+                instance.assemble_id, instance.company_id, exclude=instance.pk
+            )
+            if POFormulaDependency.depends_on(references['formula_ref'], instance.pk):
+                raise serializers.ValidationError({'formula': 'formula has a circular reference'})
+        return super().validate(validated_data)
+
     def create(self, validated_data):
         data_entries = pop(validated_data, 'self_data_entries', [])
         pop(validated_data, 'id', None)
@@ -288,23 +300,18 @@ class POFormulaSerializer(ContentTypeSerializerMixin):
                            POFormulaSerializer.__name__, __name__, self.context['request'].user.pk)
         new_name = validated_data['name']
         old_name = instance.name
+        # Edges to the formula are rebuilt by the rename, read the formulas using it before
+        referrers = list(instance.get_referrers()) if new_name != old_name else []
         update = super().update(instance, validated_data)
         # Update all formula mentioned on this formula
         if new_name != old_name:
-            company = self.context.get('request').user.company
-            data = []
-            objs = POFormula.objects.filter(company=company, formula__icontains=old_name)
-            for obj in objs:
-                obj.formula = obj.formula.replace(old_name, new_name)
-                obj.formula_mentions = obj.formula_mentions.replace(old_name, new_name)
-                data.append(obj)
-            POFormula.objects.bulk_update(data, ['formula', 'formula_mentions'], batch_size=128)
+            instance.rename_references(old_name, referrers)
         return update
 
     def validate_material(self, value):
         if value:
             try:
-                parsed_value = eval(value)
+                parsed_value = parse_literal(value)
                 if not isinstance(parsed_value, dict):
                     raise serializers.ValidationError("material is not valid")
             except:
@@ -321,9 +328,9 @@ class POFormulaSerializer(ContentTypeSerializerMixin):
         data = super().to_representation(instance)
         if data['material']:
             try:
-                primary_key = eval(data['material'])
+                primary_key = parse_literal(data['material'])
                 pk_catalog, row_index = primary_key.get('id').split(':')
-                catalog = Catalog.objects.get(pk=pk_catalog)
+                catalog = Catalog.objects.defer('c_table').get(pk=pk_catalog)
                 ancestors = catalog.get_full_ancestor()
                 ancestor = ancestors[-1]
                 data['catalog_ancestor'] = ancestor.pk
@@ -452,6 +459,7 @@ class UnitLibrarySerializer(ContentTypeSerializerMixin):
                 cs.append(c)
         model = apps.get_model(app_label='sales', model_name='Catalog')
         model.objects.bulk_update(cs, ['c_table'])
+        CostTableRow.sync(cs)
         return obj
 
 
@@ -654,8 +662,8 @@ class POFormulaItemSerializer(serializers.ModelSerializer):
     def to_representation(self, instance):
         data = super().to_representation(instance)
         try:
-            data['material'] = eval(data['material'])
-        except SyntaxError:
+            data['material'] = parse_literal(data['material'])
+        except ValueError:
             data['material'] = ''
         if data['material'] and isinstance(data['material'], dict):
             data['material'] = data['material'].get('name')
@@ -803,6 +811,17 @@ class EstimateTemplateSerializer(ContentTypeSerializerMixin):
         return data
 
 
+class CalculateEstimateSerializer(serializers.Serializer):
+    data_entries = serializers.DictField(child=serializers.CharField(allow_blank=True), required=False, default=dict)
+    save = serializers.BooleanField(required=False, default=False)
+
+    def validate_data_entries(self, value):
+        try:
+            return {int(pk): entry for pk, entry in value.items()}
+        except ValueError:
+            raise serializers.ValidationError('Keys must be ids of data entries')
+
+
 class TaggingSerializer(serializers.Serializer):
     """
     Tagging for PO formula or Data point in Catalog
@@ -315,6 +315,7 @@ class ProposalForInvoiceSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'created_date', 'lead', 'total_project_price', 'total_project_cost', 'additional_information')
 
     def to_representation(self, instance):
+        instance.apply_queued_totals()
         data = super().to_representation(instance)
         data['status'] = 'Approved'
         data['owner_price'] = instance.total_project_price
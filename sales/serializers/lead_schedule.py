@@ -13,8 +13,7 @@ from api.serializers.auth import UserCustomSerializer
 from api.serializers.base import SerializerMixin
 from base.serializers.base import IDAndNameSerializer
 from base.serializers import base
-from base.utils import pop, extra_kwargs_for_base_model
-from base.constants import true, null, false
+from base.utils import pop, extra_kwargs_for_base_model, parse_literal
 from base.views.base import remove_file
 from ..models import lead_schedule, ActivitiesLog
 from ..models.lead_schedule import TagSchedule, ToDo, CheckListItems, Messaging, CheckListItemsTemplate, \
@@ -171,7 +170,7 @@ class ToDoChecklistItemSerializer(serializers.ModelSerializer):
         file = pop(validated_data, 'file', [])
         files = request.FILES.getlist('file')
         if assigned_to:
-            assigned_to = eval(assigned_to)
+            assigned_to = parse_literal(assigned_to)
         else:
             assigned_to = []
 
@@ -222,7 +221,7 @@ class ToDoChecklistItemSerializer(serializers.ModelSerializer):
         file = pop(data, 'file', [])
         files = request.FILES.getlist('file')
         if assigned_to:
-            assigned_to = eval(assigned_to)
+            assigned_to = parse_literal(assigned_to)
         else:
             assigned_to = []
         checklist_item = lead_schedule.CheckListItems.objects.filter(pk=instance.pk)
@@ -676,7 +675,7 @@ class CheckListItemsTemplateSerializer(serializers.ModelSerializer, SerializerMi
         files = request.FILES.getlist('file')
         rq_uuid = pop(validated_data, 'uuid', None)
         if assigned_to:
-            assigned_to = eval(assigned_to)
+            assigned_to = parse_literal(assigned_to)
         else:
             assigned_to = []
         todo = pop(validated_data, 'todo', None)
@@ -711,7 +710,7 @@ class CheckListItemsTemplateSerializer(serializers.ModelSerializer, SerializerMi
         file = pop(data, 'file', [])
         files = request.FILES.getlist('file')
         if assigned_to:
-            assigned_to = eval(assigned_to)
+            assigned_to = parse_literal(assigned_to)
         else:
             assigned_to = []
         checklist_item_template = lead_schedule.CheckListItemsTemplate.objects.filter(pk=instance.pk)
@@ -396,11 +396,13 @@ class FormatEstimateSerializer(serializers.ModelSerializer):
         data = super().to_representation(instance)
         data['unit'] = instance.unit.name if instance.unit else ''
         data['quantity'] = instance.get_value_quantity()
-        instance.get_info()
+        if not hasattr(instance, 'info'):
+            instance.get_info()
         data['total_price'] = instance.get_total_prices() or Decimal(0)
         data['unit_price'] = data['total_price'] / data['quantity']
         data['description'] = data['contract_description']
-        data['formulas'] = FormatFormulaSerializer(instance.get_formula().order_by('order'), many=True).data
+        if self.context.get('formulas', True):
+            data['formulas'] = FormatFormulaSerializer(instance.get_formula().order_by('order'), many=True).data
         del data['contract_description']
         return data
 
@@ -415,7 +417,11 @@ class FormatFormulaSerializer(serializers.ModelSerializer):
         data = super().to_representation(instance)
         data['catalog_name'] = instance.get_catalog()['name']
         data['total_price'] = instance.total_cost
-        data['estimate_name'] = instance.assemble.estimate_templates.first().name
+        estimate_names = self.context.get('estimate_names', {})
+        if instance.assemble_id in estimate_names:
+            data['estimate_name'] = estimate_names[instance.assemble_id]
+        else:
+            data['estimate_name'] = instance.assemble.estimate_templates.first().name
         return data
 
 
@@ -438,7 +444,7 @@ class GroupTemplateSerializer(serializers.ModelSerializer):
             data['items'] = FormatFormulaSerializer(formulas, many=True).data
             data['total_price'] = sum(Decimal(d['total_cost'] or 0) for d in data['items'])
         else:
-            estimates = EstimateTemplate.objects.filter(pk__in=instance.items)
+            estimates = EstimateTemplate.resolve_quantities(EstimateTemplate.objects.filter(pk__in=instance.items))
             data['items'] = FormatEstimateSerializer(estimates, many=True).data
             data['total_price'] = sum(Decimal(d['total_price'] or 0) for d in data['items'])
         return data
@@ -536,6 +542,7 @@ class ProposalWritingSerializer(ContentTypeSerializerMixin):
         return super().update(instance, validated_data)
 
     def to_representation(self, instance):
+        instance.apply_queued_totals()
         data = super().to_representation(instance)
         user = get_request().user
         data['permissions'] = {
@@ -0,0 +1,297 @@
+from celery.signals import task_postrun, task_prerun
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from api.models import CompanyBuilder
+from base.models.config import DocumentSnapshot
+from .models.catalog import Catalog, CatalogClosure, DataPoint, invalidate_ancestors, invalidate_material_levels
+from .models.estimate import POFormula, POFormulaDependency
+from .models.invoice import INVOICE_DOCUMENT_KEY, INVOICE_HTML_KEY, AttachmentInvoice, ChangeOrderItem, CustomTable, \
+    GroupChangeOrder, GroupProposal, Invoice, PaymentHistory, ProgressPayment, ProposalItem, TableInvoice, TemplateInvoice
+from .models.lead_list import Activities, Contact, ContactType, ContactTypeName, LeadDetail, PhaseActivity, PhoneOfContact, \
+    Photos, ProjectType, SourceLead, TagActivity, TagLead
+from .models.proposal import PROPOSAL_DOCUMENT_KEY, PROPOSAL_HTML_KEY, ProposalFormatting, ProposalSetting, ProposalWriting, \
+    batch_proposal_updates, queue_proposal_update
+
+# Fields of a proposal shown in the document of its formatting
+PROPOSAL_DOCUMENT_FIELDS = {'name', 'status', 'additional_information', 'lead'}
+
+
+@receiver(m2m_changed, sender=Catalog.parents.through)
+def sync_catalog_closure(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep CatalogClosure in sync with every change of ``Catalog.parents``
+    (parents.add/remove/clear/set and children.add/remove/clear/set)
+    """
+    if action == 'pre_clear' and reverse:
+        # children.clear() doesn't send the removed ids on post_clear
+        instance._cleared_children = set(instance.children.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        catalog_ids = {instance.pk}
+    elif action == 'post_clear':
+        catalog_ids = instance.__dict__.pop('_cleared_children', set())
+    else:
+        catalog_ids = pk_set
+    CatalogClosure.refresh(catalog_ids)
+    invalidate_ancestors(catalog_ids)
+    invalidate_material_levels(instance.company_id)
+
+
+@receiver(post_save, sender=Catalog)
+@receiver(post_delete, sender=Catalog)
+def clear_catalog_cache(sender, instance, created=False, **kwargs):
+    if not created:
+        invalidate_ancestors([instance.pk])
+    invalidate_material_levels(instance.company_id)
+
+
+@receiver(post_save, sender=DataPoint)
+@receiver(post_delete, sender=DataPoint)
+def clear_data_point_cache(sender, instance, **kwargs):
+    if instance.catalog_id:
+        invalidate_ancestors([instance.catalog_id])
+    invalidate_material_levels(instance.company_id)
+
+
+@receiver(post_save, sender=POFormula)
+def queue_changed_formula(sender, instance, **kwargs):
+    """Queue the update of proposal totals when the assemble, charge, cost or markup of a formula changed"""
+    loaded = getattr(instance, '_loaded_totals', None) or {}
+    totals = instance.get_totals()
+    if loaded == totals:
+        return
+    instance._loaded_totals = totals
+    queue_proposal_update([loaded.get('assemble_id'), totals['assemble_id']])
+
+
+@receiver(post_save, sender=POFormula)
+def refresh_formula_dependencies(sender, instance, created, **kwargs):
+    """
+    Rebuild the dependency edges of a formula when its text or its assemble changed,
+    and the edges of the formulas which may name it when it is created, renamed or moved
+    """
+    values = instance.get_values(POFormula.DEPENDENCY_FIELDS)
+    if created or getattr(instance, '_loaded_dependencies', None) != values:
+        instance._loaded_dependencies = values
+        if not created or instance.formula or instance.formula_mentions:
+            POFormulaDependency.refresh([instance])
+    references = instance.get_values(POFormula.REFERENCE_FIELDS)
+    if created or getattr(instance, '_loaded_references', None) != references:
+        instance._loaded_references = references
+        POFormulaDependency.refresh_referrers(instance)
+
+
+@receiver(post_delete, sender=POFormula)
+def queue_deleted_formula(sender, instance, **kwargs):
+    queue_proposal_update([instance.assemble_id])
+
+
+# batch_proposal_updates of the running celery tasks, by task id
+_task_batches = {}
+
+
+@task_prerun.connect
+def start_task_proposal_updates(task_id=None, **kwargs):
+    """Formulas saved by a celery task update their proposals once when the task ends, as in a request"""
+    batch = batch_proposal_updates()
+    batch.__enter__()
+    _task_batches[task_id] = batch
+
+
+@task_postrun.connect
+def apply_task_proposal_updates(task_id=None, **kwargs):
+    batch = _task_batches.pop(task_id, None)
+    if batch is not None:
+        batch.__exit__(None, None, None)
+
+
+def invalidate_documents(proposal_ids=(), invoice_ids=()):
+    """Drop the snapshots of the formatting of these proposals and of the template of these invoices"""
+    keys = [PROPOSAL_DOCUMENT_KEY.format(pk) for pk in proposal_ids if pk]
+    for pk in invoice_ids:
+        if pk:
+            keys += [INVOICE_DOCUMENT_KEY.format(pk), INVOICE_HTML_KEY.format(pk)]
+    if keys:
+        DocumentSnapshot.invalidate(*keys)
+
+
+def invalidate_lead_documents(lead_ids):
+    """Proposals of the leads show their address and contacts, invoices of these proposals the whole lead"""
+    lead_ids = [pk for pk in lead_ids if pk]
+    if lead_ids:
+        invalidate_documents(ProposalWriting.objects.filter(lead__in=lead_ids).values_list('pk', flat=True),
+                             Invoice.objects.filter(proposal__lead__in=lead_ids).values_list('pk', flat=True))
+
+
+def invalidate_contact_documents(contact_id):
+    """Formattings list their contacts, leads show theirs"""
+    invalidate_documents(ProposalFormatting.objects.filter(contacts__contains=[contact_id])
+                         .values_list('proposal_writing', flat=True))
+    invalidate_lead_documents(Contact.leads.through.objects.filter(contact=contact_id).values_list('leaddetail', flat=True))
+
+
+@receiver(post_save, sender=ProposalWriting)
+@receiver(post_delete, sender=ProposalWriting)
+def invalidate_proposal_document(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not PROPOSAL_DOCUMENT_FIELDS.intersection(update_fields):
+        return
+    # Invoices show the lead of their proposal, the page of a formatting is stored once the proposal is published
+    invalidate_documents([instance.pk], instance.invoices.values_list('pk', flat=True))
+    DocumentSnapshot.invalidate(*[PROPOSAL_HTML_KEY.format(pk) for pk in
+                                  ProposalFormatting.objects.filter(proposal_writing=instance.pk).values_list('pk', flat=True)])
+
+
+@receiver(post_save, sender=ProposalFormatting)
+@receiver(post_delete, sender=ProposalFormatting)
+def invalidate_formatting_document(sender, instance, **kwargs):
+    DocumentSnapshot.invalidate(PROPOSAL_DOCUMENT_KEY.format(instance.proposal_writing_id), PROPOSAL_HTML_KEY.format(instance.pk))
+
+
+@receiver(post_save, sender=Invoice)
+@receiver(post_delete, sender=Invoice)
+def invalidate_invoice_document(sender, instance, **kwargs):
+    invalidate_documents(invoice_ids=[instance.pk])
+
+
+@receiver(post_save, sender=TemplateInvoice)
+@receiver(post_delete, sender=TemplateInvoice)
+@receiver(post_save, sender=PaymentHistory)
+@receiver(post_delete, sender=PaymentHistory)
+@receiver(post_save, sender=TableInvoice)
+@receiver(post_delete, sender=TableInvoice)
+def invalidate_invoice_template_document(sender, instance, **kwargs):
+    invalidate_documents(invoice_ids=[instance.invoice_id])
+
+
+@receiver(post_save, sender=CustomTable)
+@receiver(post_delete, sender=CustomTable)
+@receiver(post_save, sender=GroupChangeOrder)
+@receiver(post_delete, sender=GroupChangeOrder)
+@receiver(post_save, sender=GroupProposal)
+@receiver(post_delete, sender=GroupProposal)
+@receiver(post_save, sender=ProgressPayment)
+@receiver(post_delete, sender=ProgressPayment)
+def invalidate_invoice_table_document(sender, instance, **kwargs):
+    """Items of the tables of an invoice"""
+    if instance.table_invoice_id:
+        invalidate_documents(invoice_ids=TableInvoice.objects.filter(pk=instance.table_invoice_id)
+                             .values_list('invoice', flat=True))
+
+
+@receiver(post_save, sender=ProposalItem)
+@receiver(post_delete, sender=ProposalItem)
+@receiver(post_save, sender=ChangeOrderItem)
+@receiver(post_delete, sender=ChangeOrderItem)
+def invalidate_invoice_item_document(sender, instance, **kwargs):
+    if sender is ProposalItem:
+        tables = TableInvoice.objects.filter(group_proposal=instance.group_proposal_id) if instance.group_proposal_id else []
+    else:
+        tables = TableInvoice.objects.filter(group_change_orders=instance.group_change_order_id) \
+            if instance.group_change_order_id else []
+    if tables:
+        invalidate_documents(invoice_ids=tables.values_list('invoice', flat=True))
+
+
+@receiver(post_save, sender=AttachmentInvoice)
+@receiver(post_delete, sender=AttachmentInvoice)
+def invalidate_invoice_attachment_document(sender, instance, **kwargs):
+    if instance.content_type_id == ContentType.objects.get_for_model(Invoice).pk:
+        invalidate_documents(invoice_ids=[instance.object_id])
+
+
+@receiver(post_save, sender=LeadDetail)
+@receiver(pre_delete, sender=LeadDetail)
+def invalidate_lead_document(sender, instance, **kwargs):
+    invalidate_lead_documents([instance.pk])
+
+
+@receiver(post_save, sender=Activities)
+@receiver(post_delete, sender=Activities)
+@receiver(post_save, sender=Photos)
+@receiver(post_delete, sender=Photos)
+@receiver(post_save, sender=ContactType)
+@receiver(post_delete, sender=ContactType)
+def invalidate_lead_item_document(sender, instance, **kwargs):
+    invalidate_lead_documents([instance.lead_id])
+    if sender is ContactType and instance.contact_id:
+        invalidate_contact_documents(instance.contact_id)
+
+
+@receiver(post_save, sender=Contact)
+@receiver(pre_delete, sender=Contact)
+@receiver(post_save, sender=PhoneOfContact)
+@receiver(post_delete, sender=PhoneOfContact)
+def invalidate_contact_document(sender, instance, **kwargs):
+    invalidate_contact_documents(instance.pk if sender is Contact else instance.contact_id)
+
+
+def get_lead_ids(instance):
+    """Leads whose documents show a contact, a user, a phase, a tag, a source, a project type or a contact type name"""
+    if isinstance(instance, (Contact, SourceLead, ProjectType)):
+        return instance.leads.values_list('pk', flat=True)
+    if isinstance(instance, TagLead):
+        return instance.lead_tags.values_list('pk', flat=True)
+    if isinstance(instance, ContactTypeName):
+        return ContactType.objects.filter(contact_type_name=instance).values_list('lead', flat=True)
+    if isinstance(instance, TagActivity):
+        return Activities.objects.filter(tags=instance).values_list('lead', flat=True)
+    if isinstance(instance, PhaseActivity):
+        return Activities.objects.filter(phase=instance).values_list('lead', flat=True)
+    # Users are shown as salesperson of leads, assignees and attendees of their activities
+    return LeadDetail.objects.filter(
+        Q(salesperson=instance) | Q(activities__assigned_to=instance) | Q(activities__attendees=instance)
+    ).values_list('pk', flat=True).distinct()
+
+
+@receiver(m2m_changed, sender=Contact.leads.through)
+@receiver(m2m_changed, sender=LeadDetail.project_types.through)
+@receiver(m2m_changed, sender=LeadDetail.salesperson.through)
+@receiver(m2m_changed, sender=LeadDetail.sources.through)
+@receiver(m2m_changed, sender=LeadDetail.tags.through)
+@receiver(m2m_changed, sender=Activities.tags.through)
+@receiver(m2m_changed, sender=Activities.assigned_to.through)
+@receiver(m2m_changed, sender=Activities.attendees.through)
+def invalidate_lead_relation_document(sender, instance, action, model, pk_set, **kwargs):
+    """Relations of leads shown by the documents"""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if isinstance(instance, LeadDetail):
+        lead_ids = [instance.pk]
+    elif isinstance(instance, Activities):
+        lead_ids = [instance.lead_id]
+    elif model is LeadDetail and pk_set is not None:
+        lead_ids = pk_set
+    elif model is Activities and pk_set is not None:
+        lead_ids = Activities.objects.filter(pk__in=pk_set).values_list('lead', flat=True)
+    else:
+        # Leads of a contact, a tag, a source or a user cleared
+        lead_ids = get_lead_ids(instance)
+    invalidate_lead_documents(lead_ids)
+
+
+@receiver(post_save, sender=ProposalSetting)
+@receiver(post_save, sender=CompanyBuilder)
+def invalidate_company_documents(sender, instance, **kwargs):
+    """Documents show the company and its proposal setting"""
+    company_id = instance.pk if sender is CompanyBuilder else instance.company_id
+    DocumentSnapshot.objects.filter(company_id=company_id).delete()
+
+
+@receiver(post_save, sender=SourceLead)
+@receiver(post_save, sender=ProjectType)
+@receiver(post_save, sender=TagLead)
+@receiver(post_save, sender=ContactTypeName)
+@receiver(post_save, sender=TagActivity)
+@receiver(post_save, sender=PhaseActivity)
+@receiver(post_save, sender=get_user_model())
+def invalidate_named_documents(sender, instance, created, update_fields=None, **kwargs):
+    """Names of users, phases, tags and types are shown by the documents of the leads using them"""
+    if created or (update_fields is not None and set(update_fields) <= {'last_login'}):
+        return
+    invalidate_lead_documents(get_lead_ids(instance))
@@ -1,8 +1,20 @@
+from decimal import Decimal
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from openpyxl.reader.excel import load_workbook
+from openpyxl.workbook import Workbook
 from rest_framework import status
 
+from api.models import ActivityLog, CompanyBuilder
+from base.models.config import FileBuilder365
+from base.tasks import import_catalog_task, process_export_catalog, reprice_formulas_task
 from .test_base import BaseTest
-from ..models import Catalog
+from ..models import Assemble, Catalog, CatalogClosure, CatalogLevel, CostTableRow, DataPoint, \
+    EstimateTemplate, GroupByEstimate, POFormula, ProposalWriting, UnitLibrary
 
 
 class CatalogTests(BaseTest):
@@ -52,3 +64,364 @@ class CatalogTests(BaseTest):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         catalog = Catalog.objects.get(pk=response.data['catalog']['id'])
         self.assertEqual(len(catalog.get_ordered_levels()), len(data['levels']))
+
+    def test_catalog_closure_follow_parents(self):
+        root = Catalog.objects.create(name='root', is_ancestor=True)
+        category = Catalog.objects.create(name='category')
+        category.parents.add(root)
+        level = CatalogLevel.objects.create(name='level', catalog=category)
+        first = Catalog.objects.create(name='first', level=level)
+        second = Catalog.objects.create(name='second', level=level)
+        category.children.add(first, second)
+        leaf = Catalog.objects.create(name='leaf', level=level)
+        leaf.parents.add(first)
+
+        self.assertEqual(set(root.get_all_descendant()), {category.pk, first.pk, second.pk, leaf.pk})
+        self.assertEqual(leaf.get_ancestors(), [leaf, first])
+        self.assertEqual(leaf.get_full_ancestor(), [leaf, first, category, root])
+        self.assertEqual(CatalogClosure.objects.get(ancestor=root, descendant=leaf).depth, 3)
+
+        # Move a branch
+        first.parents.clear()
+        first.parents.add(second)
+        self.assertEqual(CatalogClosure.objects.get(ancestor=root, descendant=leaf).depth, 4)
+        self.assertEqual(set(second.get_all_descendant()), {first.pk, leaf.pk})
+        tree = root.get_tree_view()
+        self.assertEqual(tree['children'][0]['children'][0]['id'], second.pk)
+        self.assertEqual(tree['children'][0]['children'][0]['children'][0]['children'][0]['id'], leaf.pk)
+
+        category.children.clear()
+        self.assertEqual(root.get_all_descendant(), [category.pk])
+        self.assertFalse(CatalogClosure.objects.filter(ancestor=category).exists())
+
+        # A catalog linked to two parents follows the lineage of its first parent
+        first_root = Catalog.objects.create(name='first root', index=1)
+        second_root = Catalog.objects.create(name='second root', index=1)
+        middle = Catalog.objects.create(name='middle', index=0)
+        middle.parents.add(second_root)
+        first_parent = Catalog.objects.create(name='first parent', index=0)
+        first_parent.parents.add(first_root)
+        second_parent = Catalog.objects.create(name='second parent', index=1)
+        second_parent.parents.add(middle)
+        leaf = Catalog.objects.create(name='leaf')
+        leaf.parents.add(first_parent, second_parent)
+        with self.assertNumQueries(1):
+            self.assertEqual(leaf.get_ancestor_chain(), [leaf, first_parent, first_root])
+        with self.assertNumQueries(2):
+            chains = Catalog.get_ancestor_chains([leaf.pk, second_parent.pk])
+        self.assertEqual(chains, {leaf.pk: [leaf, first_parent, first_root],
+                                  second_parent.pk: [second_parent, middle, second_root]})
+
+    def test_get_catalog_tree_by_depth(self):
+        root = Catalog.objects.create(name='root', is_ancestor=True)
+        parent = root
+        for i in range(4):
+            catalog = Catalog.objects.create(name=f'child {i}')
+            catalog.parents.add(parent)
+            parent = catalog
+
+        with self.assertNumQueries(2):
+            tree = root.get_tree_view(depth=2, fields=['name'])
+        self.assertEqual(set(tree.keys()), {'id', 'name', 'has_children', 'children'})
+        node = tree['children'][0]['children'][0]
+        self.assertEqual(node['name'], 'child 1')
+        self.assertTrue(node['has_children'])
+        self.assertEqual(node['children'], [])
+
+        response = self.client.get(f'/api/sales/catalog/list/{root.pk}/tree/', {'fields': 'name,parents,level'},
+                                   HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['children'][0]['parents'], [root.pk])
+        response = self.client.get(f'/api/sales/catalog/list/{root.pk}/tree/', {'fields': 'c_table'},
+                                   HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cost_table_rows_follow_c_table(self):
+        catalog = Catalog.objects.create(name='material', c_table={
+            'header': ['name', 'unit', 'cost', 'color'],
+            'data': [['Brick', 'pcs', '1,200.5', 'red'], ['Tile', 'm2', '', 'white']]
+        })
+        rows = list(catalog.cost_table_rows.all())
+        self.assertEqual([r.name for r in rows], ['Brick', 'Tile'])
+        self.assertEqual(rows[0].cost, Decimal('1200.5'))
+        self.assertIsNone(rows[1].cost)
+        self.assertEqual(catalog.get_material(f'{catalog.pk}:1'),
+                         {'name': 'Tile', 'unit': 'm2', 'cost': '', 'color': 'white', 'id': f'{catalog.pk}:1'})
+
+        # Rows are updated in place, a short or invalid row is skipped alone
+        ids = [r.pk for r in rows]
+        catalog.c_table['data'] = [['Tile', 'm2'], None, ['Stone', 'kg', '3']]
+        catalog.save()
+        rows = list(catalog.cost_table_rows.all())
+        self.assertEqual([(r.pk, r.name, r.row_index) for r in rows], [(ids[0], 'Tile', 0), (rows[1].pk, 'Stone', 2)])
+        self.assertEqual(rows[0].get_material(), {'name': 'Tile', 'unit': 'm2', 'cost': '', 'color': '',
+                                                  'id': f'{catalog.pk}:0'})
+        self.assertEqual(catalog.get_material(f'{catalog.pk}:1'), {})
+
+        catalog.c_table['data'] = [['Tile', 'm2']]
+        catalog.save()
+        self.assertEqual(list(catalog.cost_table_rows.values_list('pk', 'name', 'row_index')), [(ids[0], 'Tile', 0)])
+
+        # Saves that leave the cost table alone don't touch its rows
+        catalog = Catalog.objects.get(pk=catalog.pk)
+        catalog.name = 'renamed'
+        with CaptureQueriesContext(connection) as queries:
+            catalog.save()
+        self.assertFalse([q for q in queries.captured_queries if CostTableRow._meta.db_table in q['sql']])
+
+    def test_get_materials_paginated_and_searchable(self):
+        root = Catalog.objects.create(name='root', is_ancestor=True)
+        category = Catalog.objects.create(name='category')
+        category.parents.add(root)
+        level = CatalogLevel.objects.create(name='level', catalog=category)
+        catalog = Catalog.objects.create(name='bricks', level=level, c_table={
+            'header': ['name', 'unit', 'cost'],
+            'data': [[f'Brick {i}', 'pcs' if i % 2 else 'box', str(i)] for i in range(5)]
+        })
+        catalog.parents.add(category)
+        url = reverse('catalog-materials')
+
+        response = self.client.get(url, {'page_size': 2}, HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['name'] for m in response.data['results']], ['Brick 0', 'Brick 1'])
+        self.assertEqual([level['id'] for level in response.data['results'][0]['levels']],
+                         [root.pk, category.pk, catalog.pk])
+        response = self.client.get(response.data['next'], HTTP_AUTHORIZATION=self.token)
+        self.assertEqual([m['id'] for m in response.data['results']], [f'{catalog.pk}:2', f'{catalog.pk}:3'])
+
+        response = self.client.get(url, {'search': 'box'}, HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(len(response.data['results']), 3)
+        response = self.client.get(url, {'search': '4'}, HTTP_AUTHORIZATION=self.token)
+        self.assertEqual([m['cost'] for m in response.data['results']], ['4'])
+
+        # Cached levels are dropped when the tree changes
+        catalog.name = 'tiles'
+        catalog.save()
+        response = self.client.get(url, {'unit': 'pcs'}, HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.data['results'][0]['levels'][-1]['name'], 'tiles')
+
+    def test_full_ancestor_cache_invalidated_on_tree_edit(self):
+        root = Catalog.objects.create(name='root', is_ancestor=True)
+        category = Catalog.objects.create(name='category')
+        category.parents.add(root)
+        level = CatalogLevel.objects.create(name='level', catalog=category)
+        leaf = Catalog.objects.create(name='leaf', level=level)
+        leaf.parents.add(category)
+
+        self.assertEqual([c.name for c in leaf.get_full_ancestor()], ['leaf', 'category', 'root'])
+        leaf = Catalog.objects.get(pk=leaf.pk)
+        with self.assertNumQueries(1):
+            # Only the cache lookup
+            leaf.get_full_ancestor()
+
+        root.name = 'new root'
+        root.save()
+        self.assertEqual(leaf.get_full_ancestor()[-1].name, 'new root')
+
+        leaf.parents.clear()
+        with self.assertRaises(IndexError):
+            leaf.get_full_ancestor()
+
+    def test_import_catalog_task(self):
+        company = CompanyBuilder.objects.create(company_name='company')
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.title = 'Materials-Lumber'
+        sheet.append(['Type', 'icon', 'value', 'unit', 'description',
+                      'Size', 'icon', 'value', 'unit', 'description', 'name', 'unit', 'cost'])
+        sheet.append(['Pine', 'tree', None, None, None, '2x4', None, '8', 'ft', None, 'Stud', 'pcs', 3])
+        sheet.append(['Pine', None, None, None, None, '2x6', None, None, None, None, 'Joist', 'box', 5])
+        sheet.append(['Pine', None, None, None, None, '2x4', None, '8', 'ft', None, 'Long stud', 'pcs', 4])
+        content = BytesIO()
+        workbook.save(content)
+
+        for _ in range(2):
+            file = FileBuilder365.objects.create(file=ContentFile(content.getvalue(), name='catalog.xlsx'))
+            import_catalog_task(file.pk, company.pk, self.user_id)
+
+        lumber = Catalog.objects.get(name='Lumber', parents__name='Materials', company=company)
+        self.assertEqual([level.name for level in lumber.get_ordered_levels()], ['Type', 'Size'])
+        pine = Catalog.objects.get(name='Pine', company=company)
+        self.assertEqual(pine.icon, 'tree')
+        self.assertEqual(set(pine.children.values_list('name', flat=True)), {'2x4', '2x6'})
+        self.assertEqual(len(lumber.get_all_descendant()), 3)
+
+        stud = Catalog.objects.get(name='2x4', company=company)
+        self.assertEqual(stud.c_table['header'], ['name', 'unit', 'cost'])
+        self.assertEqual(stud.c_table['data'], [['Stud', 'pcs', '3'], ['Long stud', 'pcs', '4']])
+        self.assertEqual([row.name for row in stud.cost_table_rows.order_by('row_index')], ['Stud', 'Long stud'])
+        self.assertEqual(DataPoint.objects.filter(catalog=stud, value='8', unit__name='ft').count(), 1)
+        self.assertEqual(set(UnitLibrary.objects.filter(company=company).values_list('name', flat=True)),
+                         {'ft', 'pcs', 'box'})
+
+    def test_export_catalog_task(self):
+        root = Catalog.objects.create(name='Materials', is_ancestor=True)
+        lumber = Catalog.objects.create(name='Lumber')
+        lumber.parents.add(root)
+        level = CatalogLevel.objects.create(name='Size', catalog=lumber)
+        for name in ['2x4', '2x6']:
+            catalog = Catalog.objects.create(name=name, level=level, c_table={
+                'header': ['name', 'unit', 'cost'],
+                'data': [[f'{name} stud', 'pcs', '3'], [f'{name} joist', 'pcs', '5']]
+            })
+            catalog.parents.add(lumber)
+
+        task_id = process_export_catalog.apply(args=(root.pk, None, self.user_id)).id
+        file = FileBuilder365.objects.get(task_id=task_id)
+        rows = list(load_workbook(file.file, read_only=True)['Materials-Lumber'].iter_rows(values_only=True))
+        file.file.delete()
+        self.assertEqual(rows[0], ('Size', 'image', 'value', 'unit', 'des', 'name', 'unit', 'cost'))
+        self.assertEqual(sorted((row[0], row[5], row[7]) for row in rows[1:]), [
+            ('2x4', '2x4 joist', '5'), ('2x4', '2x4 stud', '3'), ('2x6', '2x6 joist', '5'), ('2x6', '2x6 stud', '3')
+        ])
+
+    def test_duplicate_catalog_subtree(self):
+        root = Catalog.objects.create(name='root', is_ancestor=True)
+        lumber = Catalog.objects.create(name='Lumber')
+        lumber.parents.add(root)
+        level = CatalogLevel.objects.create(name='Size', catalog=lumber)
+        other = Catalog.objects.create(name='Lumber 1')
+        other.parents.add(root)
+        leaves = []
+        for name in ['2x4', '2x6']:
+            leaf = Catalog.objects.create(name=name, level=level, c_table={
+                'header': ['name', 'unit', 'cost'], 'data': [[f'{name} stud', 'pcs', '3']]
+            })
+            leaf.parents.add(lumber)
+            leaves.append(leaf)
+        kept = DataPoint.objects.create(catalog=leaves[0], value='8')
+        DataPoint.objects.create(catalog=leaves[0], value='10')
+
+        response = self.client.post(reverse('catalog-copy', args=[root.pk]),
+                                    [{'id': lumber.pk, 'depth': 1, 'data_points': [kept.pk]}],
+                                    format='json', HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 3)
+        copy = Catalog.objects.get(pk=[c['id'] for c in response.data if c['parent'] == root.pk][0])
+        self.assertEqual(copy.name, 'Lumber 2')
+        self.assertEqual(sorted(copy.children.values_list('name', flat=True)), ['2x4', '2x6'])
+        self.assertEqual(len(copy.get_all_descendant()), 2)
+        new_leaf = copy.children.get(name='2x4')
+        self.assertEqual(list(new_leaf.data_points.values_list('value', flat=True)), ['8'])
+        self.assertEqual(new_leaf.cost_table_rows.get().name, '2x4 stud')
+        self.assertEqual(new_leaf.get_full_ancestor()[-1], root)
+
+        mapping = lumber.duplicate(parent=root, depth=0)
+        self.assertEqual(list(mapping), [lumber.pk])
+        self.assertEqual(Catalog.objects.get(pk=mapping[lumber.pk]).name, 'Lumber 3')
+
+    def test_delete_catalog_branches(self):
+        root = Catalog.objects.create(name='root', is_ancestor=True)
+        lumber = Catalog.objects.create(name='Lumber')
+        lumber.parents.add(root)
+        size = CatalogLevel.objects.create(name='Size', catalog=lumber)
+        length = CatalogLevel.objects.create(name='Length', catalog=lumber, parent=size)
+        sizes = []
+        for name in ['2x4', '2x6']:
+            catalog = Catalog.objects.create(name=name, level=size)
+            catalog.parents.add(lumber)
+            sizes.append(catalog)
+            DataPoint.objects.create(catalog=catalog, value='8')
+            for i in range(3):
+                leaf = Catalog.objects.create(name=f'{name} {i}', level=length, c_table={
+                    'header': ['name', 'unit', 'cost'], 'data': [['stud', 'pcs', '3']]
+                })
+                leaf.parents.add(catalog)
+        leaf = sizes[1].children.first()
+        self.assertEqual(leaf.get_full_ancestor()[1], sizes[1])
+
+        # Children of a deleted level are moved to the parent of its catalogs
+        size.delete()
+        self.assertFalse(Catalog.objects.filter(pk__in=[c.pk for c in sizes]).exists())
+        self.assertEqual(lumber.children.count(), 6)
+        self.assertEqual(leaf.get_full_ancestor()[1], lumber)
+        self.assertEqual(CatalogLevel.objects.get(pk=length.pk).parent, None)
+
+        response = self.client.delete(f"{reverse('catalog-delete')}?background=true", [root.pk], format='json',
+                                      HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('task_id', response.data)
+        self.assertTrue(Catalog.objects.filter(pk=lumber.pk).exists())
+
+        response = self.client.delete(reverse('catalog-delete'), [lumber.pk], format='json',
+                                      HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(list(Catalog.objects.values_list('pk', flat=True)), [root.pk])
+        self.assertFalse(CatalogClosure.objects.exists())
+        log = ActivityLog.objects.get(object_id=lumber.pk)
+        self.assertEqual(log.last_state['name'], 'Lumber')
+
+    def test_swap_level_and_move_catalog(self):
+        lumber = Catalog.objects.create(name='Lumber')
+        size = CatalogLevel.objects.create(name='Size', catalog=lumber)
+        length = CatalogLevel.objects.create(name='Length', catalog=lumber, parent=size)
+        sizes = [Catalog.objects.create(name=name, level=size, level_index=0) for name in ['2x4', '2x6']]
+        lumber.children.add(*sizes)
+        lengths = []
+        for catalog in sizes:
+            leaf = Catalog.objects.create(name=f'{catalog.name} 8ft', level=length, level_index=1)
+            leaf.parents.add(catalog)
+            lengths.append(leaf)
+
+        data = {
+            'levels': [{'id': length.pk, 'parent': None}, {'id': size.pk, 'parent': length.pk}],
+            'catalogs': {str(lumber.pk): [c.pk for c in lengths],
+                         str(lengths[0].pk): [sizes[0].pk], str(lengths[1].pk): [sizes[1].pk]}
+        }
+        response = self.client.put(reverse('swap-level', args=[lumber.pk]), data, format='json',
+                                   HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(lumber.get_ordered_levels(), [length, size])
+        self.assertEqual(sorted(lumber.children.values_list('name', flat=True)), ['2x4 8ft', '2x6 8ft'])
+        self.assertEqual(list(Catalog.objects.get(pk=sizes[0].pk).parents.all()), [lengths[0]])
+        self.assertEqual(Catalog.objects.get(pk=sizes[0].pk).level_index, 1)
+        self.assertEqual(Catalog.objects.get(pk=lengths[0].pk).level_index, 0)
+        self.assertEqual(CatalogClosure.objects.get(ancestor=lumber, descendant=sizes[1]).depth, 2)
+
+        response = self.client.put(reverse('move-catalog'), [lengths[1].pk, lengths[0].pk], format='json',
+                                   HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(lumber.children.values_list('pk', flat=True)), [lengths[1].pk, lengths[0].pk])
+
+    def test_reprice_formulas(self):
+        root = Catalog.objects.create(name='root', icon='')
+        catalog = Catalog.objects.create(name='bricks', icon='', c_table={
+            'header': ['name', 'unit', 'cost', 'supplier'], 'data': [['Brick', 'pcs', '2', '3']]
+        })
+        catalog.parents.add(root)
+        material = str({'id': f'{catalog.pk}:0', 'name': 'Brick'})
+        formula = POFormula.objects.create(name='bricks', material=material, quantity=10, cost=2, markup=50,
+                                           default_column={'name': 'cost', 'value': '2'})
+        supplier = POFormula.objects.create(name='supplier', material=material, quantity=10, cost=3,
+                                            default_column={'name': 'supplier', 'value': '3'})
+        proposal = ProposalWriting.objects.create(name='sent', status='sent')
+        estimate = EstimateTemplate.objects.create(
+            name='estimate', group_by_proposal=GroupByEstimate.objects.create(writing=proposal)
+        )
+        assemble = Assemble.objects.create(name='assemble')
+        estimate.assembles.add(assemble)
+        sent = POFormula.objects.create(name='sent', material=material, quantity=10, cost=2, assemble=assemble)
+        self.assertEqual(formula.material_id, f'{catalog.pk}:0')
+
+        catalog.c_table['data'][0][2] = '2.5'
+        catalog.save()
+        url = reverse('catalog-reprice')
+        response = self.client.post(url, {'catalogs': [root.pk]}, format='json', HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(f['id'], f['new_cost'], f['new_charge']) for f in response.data['formulas']],
+                         [(formula.pk, '2.5', '37.50')])
+        formula.refresh_from_db()
+        self.assertEqual(formula.cost, 2)
+
+        response = self.client.post(url, {'catalogs': [root.pk], 'dry_run': 'false'}, format='json',
+                                    HTTP_AUTHORIZATION=self.token)
+        self.assertIn('task_id', response.data)
+        formula.refresh_from_db()
+        self.assertEqual(formula.cost, 2)
+        reprice_formulas_task([root.pk], dry_run=False)
+        formula.refresh_from_db()
+        self.assertEqual((formula.cost, formula.charge, formula.default_column['value']), (Decimal('2.5'), 37.5, '2.5'))
+        supplier.refresh_from_db()
+        self.assertEqual(supplier.cost, 3)
+        sent.refresh_from_db()
+        self.assertEqual(sent.cost, 2)
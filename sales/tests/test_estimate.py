@@ -1,7 +1,13 @@
+from decimal import Decimal
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
 
 from .test_base import BaseTest
+from ..models import Assemble, DataEntry, EstimateTemplate, GroupByEstimate, POFormula, POFormulaDependency, POFormulaToDataEntry, \
+    ProposalWriting
 
 
 class DataEntryTest(BaseTest):
@@ -27,3 +33,175 @@ class DataEntryTest(BaseTest):
 
         response = self.client.delete(self.data_entry_detail_url, HTTP_AUTHORIZATION=self.token)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+
+class POFormulaTest(BaseTest):
+    def test_parse_material(self):
+        formula = POFormula(name='formula', material='{"id": "12:3", "name": "wood", "is_default": true, "unit": null}')
+        self.assertEqual(formula.parse_material(), ('12', '3'))
+        formula.material = "{'id': '12:4', 'name': 'wood', 'levels': [{'name': 'lumber'}]}"
+        self.assertEqual(formula.parse_material(), ('12', '4'))
+        self.assertEqual(formula.get_catalog(), {'name': 'lumber'})
+
+        # parsed values are cached, callers get their own copy
+        formula.get_catalog()['name'] = 'changed'
+        self.assertEqual(formula.get_catalog(), {'name': 'lumber'})
+
+        formula.material = "__import__('os').getcwd()"
+        self.assertEqual(formula.get_catalog(), {'name': ''})
+        with self.assertRaises(ValueError):
+            formula.parse_material()
+
+    def test_formula_dependencies(self):
+        assemble = Assemble.objects.create(name='assemble')
+        entry = DataEntry.objects.create(name='Length')
+        wall = POFormula.objects.create(name='Wall', assemble=assemble, formula='Length * 2',
+                                        formula_mentions=f'$[Length]({entry.pk}) * 2')
+        area = POFormula.objects.create(name='Wall Area', assemble=assemble, formula='Wall * 3')
+        paint = POFormula.objects.create(name='Paint', assemble=assemble, formula='Wall Area + Wall')
+        other = POFormula.objects.create(name='Other', formula='Wall Area')
+        self.assertEqual(set(wall.dependencies.values_list('data_entry', flat=True)), {entry.pk})
+        self.assertEqual(set(paint.dependencies.values_list('formula_ref', flat=True)), {wall.pk, area.pk})
+        self.assertFalse(other.dependencies.exists())
+
+        self.assertEqual(POFormulaDependency.get_affected(data_entry_ids=[entry.pk]), [wall.pk, area.pk, paint.pk])
+        self.assertEqual(POFormulaDependency.get_affected(formula_ids=[area.pk]), [area.pk, paint.pk])
+
+        wall.formula = wall.formula_mentions = '4'
+        wall.save(update_fields=['formula', 'formula_mentions'])
+        self.assertFalse(wall.dependencies.filter(data_entry=entry).exists())
+
+        url = f'/api/sales/estimate/po-formula/{wall.pk}/'
+        response = self.client.patch(url, {'name': 'Wall', 'formula': 'Paint / 2'}, format='json',
+                                     HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        POFormulaDependency.objects.create(formula=wall, formula_ref=paint)
+        with self.assertRaises(ValueError):
+            POFormulaDependency.get_affected(formula_ids=[area.pk])
+
+    def test_reference_created_after_referrer(self):
+        assemble = Assemble.objects.create(name='assemble')
+        paint = POFormula.objects.create(name='Paint', assemble=assemble, formula='Wall2 * 2')
+        self.assertFalse(paint.dependencies.exists())
+        wall = POFormula.objects.create(name='Wall2', assemble=assemble, formula='3')
+        self.assertEqual(list(paint.dependencies.values_list('formula_ref', flat=True)), [wall.pk])
+        self.assertEqual(POFormulaDependency.get_affected(formula_ids=[wall.pk]), [wall.pk, paint.pk])
+
+        # Renamed to the name used by a formula, then away from it
+        side = POFormula.objects.create(name='Side', assemble=assemble, formula='4')
+        wall.name = 'Wall'
+        wall.save()
+        side.name = 'Wall2'
+        side.save()
+        self.assertEqual(list(paint.dependencies.values_list('formula_ref', flat=True)), [side.pk])
+
+    def test_rename_formula(self):
+        wall = POFormula.objects.create(name='Wall', formula='2')
+        area = POFormula.objects.create(name='Area', formula='Wall * Wallpaper', formula_mentions='@[Wall] * Wallpaper')
+        other = POFormula.objects.create(name='Other', assemble=Assemble.objects.create(name='assemble'), formula='Wall')
+
+        url = f'/api/sales/estimate/po-formula/{wall.pk}/'
+        response = self.client.patch(url, {'name': 'Side'}, format='json', HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        area.refresh_from_db()
+        self.assertEqual(area.formula, 'Side * Wallpaper')
+        self.assertEqual(area.formula_mentions, '@[Side] * Wallpaper')
+        self.assertEqual(list(area.dependencies.values_list('formula_ref', flat=True)), [wall.pk])
+        # Only formulas using the renamed formula are rewritten
+        other.refresh_from_db()
+        self.assertEqual(other.formula, 'Wall')
+
+    def test_calculate_estimate(self):
+        estimate = EstimateTemplate.objects.create(name='estimate')
+        assemble = Assemble.objects.create(name='assemble')
+        estimate.assembles.add(assemble)
+        entry = DataEntry.objects.create(name='Length')
+        wall = POFormula.objects.create(name='Wall', assemble=assemble, formula='Length * 2',
+                                        formula_mentions=f'$[Length]({entry.pk}) * 2', cost=10, markup=50)
+        POFormulaToDataEntry.objects.create(po_formula=wall, data_entry=entry, value='3')
+        area = POFormula.objects.create(name='Wall Area', assemble=assemble, formula='ceil(Wall * 1.25)', cost=2,
+                                        round_up={'type': 'increment', 'increments': [5, 10],
+                                                  'last_action': 'increment', 'action_value': 4})
+        broken = POFormula.objects.create(name='Broken', assemble=assemble, formula='Wall +')
+        hack = POFormula.objects.create(name='Hack', assemble=assemble, formula="__import__('os')")
+
+        results = estimate.calculate()
+        self.assertEqual(results[wall.pk]['quantity'], 6)
+        self.assertEqual(results[wall.pk]['charge'], 90)
+        self.assertEqual(results[wall.pk]['margin'].quantize(Decimal('1.00')), Decimal('33.33'))
+        self.assertEqual(results[area.pk]['quantity'], 8)
+        self.assertEqual(results[area.pk]['order_quantity'], 10)
+        self.assertIn('error', results[broken.pk])
+        self.assertIn('error', results[hack.pk])
+
+        POFormulaToDataEntry.objects.create(estimate_template=estimate, data_entry=entry, value='4')
+        quantity = POFormula.objects.get(pk=area.pk).quantity
+        response = self.client.post(reverse('sales.estimate.calculate', args=[estimate.pk]),
+                                    {'data_entries': {str(entry.pk): '8'}, 'save': 'false'}, format='json',
+                                    HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.data[area.pk]['quantity'], 20)
+        self.assertEqual(POFormula.objects.get(pk=area.pk).quantity, quantity)
+        response = self.client.post(reverse('sales.estimate.calculate', args=[estimate.pk]),
+                                    {'data_entries': {str(entry.pk): '8'}, 'save': True}, format='json',
+                                    HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        area.refresh_from_db()
+        self.assertEqual(area.quantity, 20)
+        self.assertEqual(area.order_quantity, 22)
+        self.assertEqual(area.total_cost, 44)
+        self.assertEqual(estimate.calculate()[wall.pk]['quantity'], 8)
+        for data_entries in ({'x': '1'}, ['1'], {str(entry.pk): None}):
+            response = self.client.post(reverse('sales.estimate.calculate', args=[estimate.pk]),
+                                        {'data_entries': data_entries}, format='json', HTTP_AUTHORIZATION=self.token)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_calculate_proposal(self):
+        proposal = ProposalWriting.objects.create(name='proposal')
+        group = GroupByEstimate.objects.create(writing=proposal)
+        entry = DataEntry.objects.create(name='Length')
+        walls = []
+
+        def calculate():
+            with CaptureQueriesContext(connection) as queries:
+                results = proposal.calculate(save=True)
+            return results, len(queries)
+
+        for i in range(3):
+            if i == 2:
+                _, count = calculate()
+            estimate = EstimateTemplate.objects.create(name=f'estimate {i}', group_by_proposal=group)
+            assemble = Assemble.objects.create(name='assemble')
+            estimate.assembles.add(assemble)
+            POFormulaToDataEntry.objects.create(estimate_template=estimate, data_entry=entry, value=str(i + 1))
+            walls.append(POFormula.objects.create(name='Wall', assemble=assemble, formula='Length * 2', cost=1,
+                                                  formula_mentions=f'$[Length]({entry.pk}) * 2'))
+        empty = EstimateTemplate.objects.create(name='empty', group_by_proposal=group)
+
+        results, queries = calculate()
+        # The formulas of every estimate are evaluated in one pass
+        self.assertEqual(queries, count)
+        self.assertEqual(results[empty.pk], {})
+        self.assertEqual([results[wall.assemble.estimate_templates.get().pk][wall.pk]['quantity'] for wall in walls],
+                         [2, 4, 6])
+        self.assertEqual([POFormula.objects.get(pk=wall.pk).total_cost for wall in walls], [2, 4, 6])
+
+    def test_sync_data_entries(self):
+        estimate = EstimateTemplate.objects.create(name='estimate')
+        assemble = Assemble.objects.create(name='assemble')
+        estimate.assembles.add(assemble)
+        length, width = DataEntry.objects.create(name='Length'), DataEntry.objects.create(name='Width')
+        formulas = [POFormula.objects.create(name=f'formula {i}', assemble=assemble) for i in range(3)]
+        links = [POFormulaToDataEntry.objects.create(po_formula=formulas[0], data_entry=length, value='3'),
+                 POFormulaToDataEntry.objects.create(po_formula=formulas[1], data_entry=length, value='4'),
+                 POFormulaToDataEntry.objects.create(po_formula=formulas[2], data_entry=width, value='5')]
+        POFormulaToDataEntry.objects.create(estimate_template=estimate, data_entry=width, value='6')
+        POFormulaToDataEntry.objects.create(estimate_template=estimate)
+
+        with self.assertNumQueries(6):
+            estimate.sync_data_entries()
+        self.assertEqual(sorted(estimate.data_entries.values_list('data_entry', 'value')),
+                         [(length.pk, '3'), (width.pk, '6')])
+        self.assertEqual([e['id'] for e in estimate.data_entries.get(data_entry=length).copies_from],
+                         [links[0].pk, links[1].pk])
+        estimate.sync_data_entries()
+        self.assertEqual(estimate.data_entries.count(), 2)
@@ -0,0 +1,55 @@
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from rest_framework import status
+
+from base.models.config import DocumentSnapshot
+from .test_base import BaseTest
+from ..models.invoice import INVOICE_DOCUMENT_KEY, CustomTable, Invoice, TableInvoice
+from ..models.lead_list import Activities, LeadDetail, TagActivity
+from ..models.proposal import ProposalWriting
+
+
+class InvoiceTests(BaseTest):
+
+    def test_template_snapshot_follows_items(self):
+        lead = LeadDetail.objects.create(lead_title='lead')
+        invoice = Invoice.objects.create(name='invoice', date_paid=timezone.now(), status=Invoice.InvoiceStatus.SENT,
+                                         proposal=ProposalWriting.objects.create(name='proposal', lead=lead))
+        table = TableInvoice.objects.create(invoice=invoice, type=TableInvoice.TableTypeInvoice.CUSTOM)
+        item = CustomTable.objects.create(name='item', cost_type='', unit_cost=10, quantity=2, unit='',
+                                          table_invoice=table)
+        url = f'/api/sales/invoice/{invoice.pk}/template-data/'
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['items'][0]['total_price'], 20)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION=self.token, HTTP_IF_NONE_MATCH=etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
+        item.quantity = 3
+        item.save()
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.token, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['items'][0]['total_price'], 30)
+
+        lead.lead_title = 'renamed'
+        lead.save()
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION=self.token).json()['lead']['lead_title'], 'renamed')
+
+        # Names of users and tags only drop the documents showing them
+        kept = DocumentSnapshot.store('kept', b'{}')
+        snapshot = DocumentSnapshot.objects.filter(key=INVOICE_DOCUMENT_KEY.format(invoice.pk))
+        user = get_user_model().objects.get(pk=self.user_id)
+        tag = TagActivity.objects.create(name='tag')
+        user.save()
+        tag.save()
+        self.assertTrue(snapshot.exists())
+        activity = Activities.objects.create(title='visit', lead=lead, start_date=timezone.now(), end_date=timezone.now())
+        activity.tags.add(tag)
+        lead.salesperson.add(user)
+        for instance in (user, tag):
+            self.client.get(url, HTTP_AUTHORIZATION=self.token)
+            self.assertTrue(snapshot.exists())
+            instance.save()
+            self.assertFalse(snapshot.exists())
+        self.assertTrue(DocumentSnapshot.objects.filter(pk=kept.pk).exists())
@@ -1,7 +1,31 @@
+import os
+import tempfile
+import zipfile
+from decimal import Decimal
+from unittest import mock
+
+from celery.signals import task_postrun, task_prerun
+from django.core import mail
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
+from openpyxl.reader.excel import load_workbook
 from rest_framework import status
 
+from base.models.config import DocumentSnapshot, FileBuilder365
+from base.tasks import export_proposal, export_proposal_chunk, mail_document_pdfs, mail_signed_document, merge_proposal_exports, \
+    render_document_pdf
+
 from .test_base import BaseTest
+from ..cloning import clone_proposal
+from ..middleware import ProposalTotalMiddleware
+from ..models.lead_list import ActivitiesLog, Contact
+from ..models.proposal import batch_proposal_updates
+from ..models import Assemble, Catalog, CatalogLevel, ChangeOrder, DataEntry, DataView, EstimateTemplate, GroupByEstimate, GroupEstimate, GroupEstimatePrice, \
+    LeadDetail, Note, POFormula, POFormulaDependency, POFormulaToDataEntry, PriceComparison, ProposalFormatting, ProposalWriting
 
 
 class CatalogTests(BaseTest):
@@ -72,3 +96,415 @@ class CatalogTests(BaseTest):
             format='json',
             HTTP_AUTHORIZATION=self.token)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_formulas_of_proposal(self):
+        proposal = ProposalWriting.objects.create(name='proposal')
+        price_comparison = PriceComparison.objects.create(name='price comparison')
+        change_order = ChangeOrder.objects.create(name='change order')
+        formulas = {}
+        for type in GroupByEstimate.Type:
+            group = GroupByEstimate.objects.create(writing=proposal, type=type)
+            price_group = GroupEstimatePrice.objects.create(price_comparison=price_comparison)
+            for i in range(2):
+                estimate = EstimateTemplate.objects.create(name=f'estimate {type} {i}', group_by_proposal=group,
+                                                           is_selected=bool(i))
+                price_group.estimate_templates.add(estimate)
+                assemble = Assemble.objects.create(name='assemble')
+                estimate.assembles.add(assemble)
+                formulas[estimate.pk] = POFormula.objects.create(name='formula', assemble=assemble, charge=type + 1)
+        # An assemble shared by two estimates
+        shared = Assemble.objects.create(name='shared')
+        shared.estimate_templates.add(*proposal.get_estimates(type=GroupByEstimate.Type.GENERAL))
+        formulas[0] = POFormula.objects.create(name='shared formula', assemble=shared)
+        change_order.existing_estimates.add(*proposal.get_estimates(type=GroupByEstimate.Type.GENERAL))
+        GroupEstimate.objects.create(change_order=change_order).estimate_templates.add(
+            *proposal.get_estimates(type=GroupByEstimate.Type.ADD_ON)
+        )
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(proposal.get_formulas()), 7)
+        general = proposal.get_formulas(type=GroupByEstimate.Type.GENERAL)
+        self.assertEqual(general.count(), 3)
+        self.assertEqual(proposal.calculation_formula(general)[0], 2)
+        self.assertEqual(proposal.get_assembles(type=GroupByEstimate.Type.GENERAL).count(), 3)
+        self.assertEqual(proposal.get_checked_formula().count(), 4)
+        self.assertEqual(price_comparison.get_formulas().count(), 7)
+        self.assertEqual(change_order._get_formulas().count(), 5)
+        estimate = EstimateTemplate.objects.get(name='estimate 0 1')
+        self.assertEqual(set(estimate.get_formula()), {formulas[estimate.pk], formulas[0]})
+
+    def test_sync_data_of_proposal(self):
+        proposal = ProposalWriting.objects.create(name='proposal')
+        for type in GroupByEstimate.Type:
+            group = GroupByEstimate.objects.create(writing=proposal, type=type)
+            for i in range(2):
+                estimate = EstimateTemplate.objects.create(name=f'estimate {type} {i}', group_by_proposal=group,
+                                                           original=i)
+                assemble = Assemble.objects.create(name='assemble')
+                estimate.assembles.add(assemble)
+                for j in range(i * 2):
+                    POFormula.objects.create(name='formula', assemble=assemble, charge=10 * (type + 1),
+                                             total_cost=5, markup=1)
+
+        with self.assertNumQueries(2):
+            proposal.sync_data()
+        proposal.refresh_from_db()
+        self.assertEqual(proposal.cost_breakdown[0], {
+            'id': 0, 'cost': '0.00', 'count': 0, 'total_price': 0, 'profit': '0.00', 'markup': '0.00',
+            'name': 'estimate 0 0', 'profit_percent': '0.00'
+        })
+        self.assertEqual(proposal.add_on_cost_breakdown[1]['total_price'], 40)
+        self.assertEqual(proposal.add_on_cost_breakdown[1]['count'], 2)
+        self.assertEqual(proposal.additional_cost_breakdown[1]['profit_percent'], '83.33')
+        # Totals are kept as saved by the client
+        self.assertEqual(proposal.additional_cost_total_project_price, 0)
+        self.assertEqual(proposal.total_project_cost, 0)
+
+        # An assemble shared by two estimates is counted once in the totals
+        estimate = EstimateTemplate.objects.get(name='estimate 0 0')
+        estimate.assembles.add(Assemble.objects.get(estimate_templates__name='estimate 0 1'))
+        POFormula.objects.filter(assemble__estimate_templates__name='estimate 0 1').update(charge=20)
+        with self.assertNumQueries(2):
+            proposal.update_info()
+        self.assertEqual(ProposalWriting.objects.get(pk=proposal.pk).total_project_price, 40)
+
+    def test_totals_in_same_response(self):
+        proposal = ProposalWriting.objects.create(name='proposal')
+        formula = {'id': 1, 'name': 'formula', 'charge': 10, 'total_cost': 5, 'markup': 1, 'quantity': 1}
+        data = {'name': 'proposal', 'writing_groups': [{'type': GroupByEstimate.Type.GENERAL, 'estimate_templates': [
+            {'name': 'estimate', 'assembles': [{'name': 'assemble', 'assemble_formulas': [formula]}]}
+        ]}]}
+        response = self.client.put(reverse('detail-proposal', kwargs={'pk': proposal.pk}), data, format='json',
+                                   HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Decimal(response.data['total_project_price']), 10)
+
+        # A nested batch joins the outer one
+        assemble = Assemble.objects.get(assemble_formulas__name='formula', estimate_templates__group_by_proposal__writing=proposal)
+        with batch_proposal_updates():
+            with batch_proposal_updates():
+                POFormula.objects.create(name='other', assemble=assemble, charge=5, total_cost=5, markup=1)
+            self.assertEqual(ProposalWriting.objects.get(pk=proposal.pk).total_project_price, 10)
+        self.assertEqual(ProposalWriting.objects.get(pk=proposal.pk).total_project_price, 15)
+
+    def test_totals_after_task_or_failed_update(self):
+        proposal = ProposalWriting.objects.create(name='proposal')
+        estimate = EstimateTemplate.objects.create(
+            name='estimate', group_by_proposal=GroupByEstimate.objects.create(writing=proposal)
+        )
+        assemble = Assemble.objects.create(name='assemble')
+        estimate.assembles.add(assemble)
+
+        # Formulas saved by a celery task update the proposal once, when it ends
+        task_prerun.send(sender=None, task_id='task')
+        for charge in (10, 20):
+            POFormula.objects.create(name='formula', assemble=assemble, charge=charge)
+        self.assertEqual(ProposalWriting.objects.get(pk=proposal.pk).total_project_price, 0)
+        with self.assertNumQueries(5):
+            task_postrun.send(sender=None, task_id='task')
+        self.assertEqual(ProposalWriting.objects.get(pk=proposal.pk).total_project_price, 30)
+
+        def view(request):
+            POFormula.objects.create(name='formula', assemble=assemble, charge=5)
+            return HttpResponse('saved')
+        with mock.patch.object(ProposalWriting, 'update_estimates', side_effect=ValueError), \
+                self.assertLogs('sales.middleware', 'ERROR'):
+            response = ProposalTotalMiddleware(view)(RequestFactory().post('/'))
+        self.assertEqual(response.content, b'saved')
+
+    def test_update_totals_on_formula_change(self):
+        proposal = ProposalWriting.objects.create(name='proposal')
+        group = GroupByEstimate.objects.create(writing=proposal, type=GroupByEstimate.Type.GENERAL)
+        assembles = []
+        for i in range(2):
+            estimate = EstimateTemplate.objects.create(name=f'estimate {i}', group_by_proposal=group, original=i)
+            assembles.append(Assemble.objects.create(name='assemble'))
+            estimate.assembles.add(assembles[i])
+            POFormula.objects.create(name='formula', assemble=assembles[i], charge=10, total_cost=5, markup=1)
+        proposal.sync_data()
+        proposal.update_info()
+        self.assertEqual(proposal.total_project_price, 20)
+
+        formula = POFormula.objects.get(assemble=assembles[0])
+        # A rename only looks for the formulas naming the formula, totals are not updated
+        with self.assertNumQueries(2), batch_proposal_updates():
+            formula.name = 'renamed'
+            formula.save(update_fields=['name'])
+        with batch_proposal_updates():
+            formula.charge = 30
+            formula.save()
+            POFormula.objects.create(name='formula', assemble=assembles[0], charge=5, total_cost=5, markup=1)
+            POFormula.objects.get(assemble=assembles[1]).delete()
+        proposal.refresh_from_db()
+        self.assertEqual(proposal.total_project_price, 35)
+        self.assertEqual(proposal.total_project_cost, 10)
+        self.assertEqual([entry['total_price'] for entry in proposal.cost_breakdown], [35, 0])
+        self.assertEqual(proposal.cost_breakdown[0]['count'], 2)
+
+        # An estimate keeps one entry when renamed, estimates with the same original and name keep theirs
+        EstimateTemplate.objects.filter(name='estimate 0').update(name='renamed')
+        EstimateTemplate.objects.filter(name='estimate 1').update(name='renamed', original=0)
+        with batch_proposal_updates():
+            POFormula.objects.create(name='formula', assemble=assembles[1], charge=10, total_cost=5, markup=1)
+        proposal.refresh_from_db()
+        self.assertEqual([(entry['name'], entry['total_price']) for entry in proposal.cost_breakdown],
+                         [('renamed', 35), ('renamed', 10)])
+        self.assertEqual(proposal.total_project_price, 45)
+
+    def test_resolve_quantities(self):
+        assemble = Assemble.objects.create(name='assemble')
+        POFormula.objects.create(name='Area', assemble=assemble, quantity=7)
+        estimates = []
+        for i, quantity in enumerate([{'name': 'Area'}, {'name': 'Rooms', 'type': 'data_entry'},
+                                      {'name': 'Total', 'type': 'data_view'}, {}]):
+            estimate = EstimateTemplate.objects.create(name=f'estimate {i}', quantity=quantity)
+            estimate.assembles.add(assemble)
+            DataView.objects.create(name='Area', estimate_template=estimate, result=3)
+            DataView.objects.create(name='Total', estimate_template=estimate, result=None)
+            POFormulaToDataEntry.objects.create(estimate_template=estimate, value='1,200',
+                                                data_entry=DataEntry.objects.create(name='Rooms'))
+            estimates.append(estimate)
+
+        estimates = list(EstimateTemplate.objects.filter(pk__in=[e.pk for e in estimates]).order_by('pk'))
+        with self.assertNumQueries(3):
+            EstimateTemplate.resolve_quantities(estimates)
+            quantities = [estimate.get_value_quantity() for estimate in estimates]
+        self.assertEqual(quantities, [7, 1200, 1, 1])
+
+    def test_parse_template(self):
+        estimates = []
+        for i in range(2):
+            estimate = EstimateTemplate.objects.create(name=f'estimate {i}', quantity={'name': 'Area'})
+            assemble = Assemble.objects.create(name='assemble')
+            estimate.assembles.add(assemble)
+            POFormula.objects.create(name='Area', assemble=assemble, quantity=2, charge=10, total_cost=4,
+                                     material="{'levels': [{'name': 'Brick'}]}")
+            POFormula.objects.create(name=f'formula {i}', assemble=assemble, charge=i)
+            estimates.append(estimate)
+        data = {'writing_groups': [{'type': 0, 'estimate_templates': [{'id': estimates[0].pk}]},
+                                   {'type': 2, 'estimate_templates': [{'id': estimates[1].pk}, {'id': estimates[0].pk}]}]}
+        url = '/api/sales/proposal/proposal-writing/template-groups/'
+
+        proposals = ProposalWriting.objects.count()
+        response = self.client.post(url, data, format='json', HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(ProposalWriting.objects.count(), proposals)
+        groups = response.data
+        general = groups['estimates']['General'][0]['items']
+        self.assertEqual([(e['id'], e['quantity'], e['total_price']) for e in general], [(estimates[0].pk, 2, 10)])
+        self.assertEqual(groups['estimates']['Optional Add-on Services'][0]['items'], [])
+        additional = groups['formulas']['Additional Costs'][0]['items']
+        self.assertEqual([(f['name'], f['estimate_name']) for f in additional],
+                         [('Area', 'estimate 0'), ('formula 0', 'estimate 0'), ('Area', 'estimate 1'), ('formula 1', 'estimate 1')])
+        self.assertEqual(len(groups['Brick']['Additional Costs'][0]['items']), 2)
+
+        # Cached until an estimate changes
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, data, format='json', HTTP_AUTHORIZATION=self.token)
+        # Only the version of the estimates is read
+        self.assertEqual(len([query for query in queries if 'FROM "sales_poformula"' in query['sql']]), 1)
+        self.assertEqual(response.data['formulas']['Additional Costs'][0]['items'], additional)
+        formula = POFormula.objects.get(name='formula 1')
+        formula.charge = 5
+        formula.save()
+        response = self.client.post(url, data, format='json', HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.data['estimates']['Additional Costs'][0]['items'][0]['total_price'], 10 + 5)
+
+    def test_duplicate_proposal(self):
+        proposal = ProposalWriting.objects.create(name='proposal')
+        ProposalFormatting.objects.create(proposal_writing=proposal, intro='intro', has_signed=True)
+        group = GroupByEstimate.objects.create(writing=proposal, open_index='1')
+        for i in range(2):
+            estimate = EstimateTemplate.objects.create(name=f'estimate {i}', group_by_proposal=group)
+            assemble = Assemble.objects.create(name='assemble')
+            estimate.assembles.add(assemble)
+            DataView.objects.create(name='Area', estimate_template=estimate, result=3)
+            POFormula.objects.create(name='Length', assemble=assemble, formula='2')
+            formula = POFormula.objects.create(name='Total', assemble=assemble, formula='Length * Area')
+            data_entry = POFormulaToDataEntry.objects.create(po_formula=formula, value='1',
+                                                             data_entry=DataEntry.objects.create(name='Rooms'))
+            Note.objects.create(data_entry=data_entry, description='note')
+        # A formula may refer to a formula of another assemble of the proposal
+        first_length = POFormula.objects.get(assemble__estimate_templates__name='estimate 0', name='Length')
+        POFormulaDependency.objects.create(formula=formula, formula_ref=first_length)
+        source_formulas = set(POFormula.objects.filter(assemble__estimate_templates__group_by_proposal=group)
+                              .values_list('pk', flat=True))
+        proposal.sync_data()
+        leads = [LeadDetail.objects.create(lead_title=f'lead {i}').pk for i in range(3)]
+        url = '/api/sales/proposal/proposal-writing/duplicate/'
+
+        response = self.client.post(url, {'name': 'copy', proposal.pk: leads}, format='json', HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        copies = ProposalWriting.objects.filter(name='copy').order_by('pk')
+        self.assertEqual([copy.lead_id for copy in copies], leads)
+        for copy in copies:
+            self.assertEqual(copy.proposal_formatting.intro, 'intro')
+            self.assertFalse(copy.proposal_formatting.has_signed)
+            estimates = copy.get_estimates().order_by('order')
+            self.assertEqual([(e.name, e.is_selected) for e in estimates], [('estimate 0', False), ('estimate 1', True)])
+            self.assertEqual([entry['name'] for entry in copy.cost_breakdown], ['estimate 0', 'estimate 1'])
+            formula = POFormula.objects.get(assemble__estimate_templates=estimates[1], name='Total')
+            self.assertEqual(formula.self_data_entries.get().notes.get().description, 'note')
+            references = formula.dependencies.values_list('formula_ref__name', 'data_view__estimate_template')
+            self.assertEqual(set(references), {('Length', None), (None, estimates[1].pk)})
+            references = formula.dependencies.values_list('formula_ref', flat=True)
+            self.assertIn(POFormula.objects.get(assemble__estimate_templates=estimates[0], name='Length').pk, references)
+            self.assertFalse(source_formulas.intersection(references))
+        self.assertEqual(ActivitiesLog.objects.filter(type_id__in=copies.values('pk')).count(), 3)
+
+        # Queries don't depend on the number of leads
+        with CaptureQueriesContext(connection) as queries:
+            clone_proposal(proposal, leads[:1], 'copy')
+        with self.assertNumQueries(len(queries)):
+            clone_proposal(proposal, leads, 'copy')
+
+        response = self.client.post(url, {'name': 'copy', proposal.pk: [0]}, format='json', HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_imgs(self):
+        root = Catalog.objects.create(name='root')
+        category = Catalog.objects.create(name='category')
+        category.parents.add(root)
+        level = CatalogLevel.objects.create(name='level', catalog=category)
+        parent = Catalog.objects.create(name='parent', level=level, icon='parent.png')
+        parent.parents.add(category)
+        leaf = Catalog.objects.create(name='leaf', level=level)
+        leaf.parents.add(parent)
+        proposal = ProposalWriting.objects.create(name='proposal')
+        estimate = EstimateTemplate.objects.create(name='estimate', group_by_proposal=GroupByEstimate.objects.create(writing=proposal))
+        assemble = Assemble.objects.create(name='assemble')
+        estimate.assembles.add(assemble)
+        for material in (f"{{'id': '{leaf.pk}:0'}}", f"{{'id': '{leaf.pk}:1'}}", 'Brick', ''):
+            POFormula.objects.create(name='formula', assemble=assemble, material=material)
+        expected = leaf.get_ancestors()
+        self.assertEqual(set(expected), {leaf, parent})
+
+        url = f'/api/sales/proposal/proposal-writing/{proposal.pk}/image/'
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(image['id'] for image in response.data), sorted(c.pk for c in expected))
+        with self.assertNumQueries(3):
+            # Version of the formulas, cached ids, catalogs
+            self.assertEqual(set(proposal.get_imgs()), set(expected))
+
+        other = Catalog.objects.create(name='other', level=level)
+        other.parents.add(parent)
+        POFormula.objects.create(name='formula', assemble=assemble, material=f"{{'id': '{other.pk}:0'}}")
+        self.assertEqual(set(proposal.get_imgs()), {parent, leaf, other})
+
+    def test_formatting_snapshot(self):
+        proposal = ProposalWriting.objects.create(name='proposal', lead=LeadDetail.objects.create(lead_title='lead'))
+        url = f'/api/sales/proposal/proposal-writing/{proposal.pk}/formatting-v2/'
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.has_header('ETag'))
+
+        proposal.status = 'sent'
+        proposal.save(update_fields=['status'])
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.json()['status'], 'sent')
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.client.get(url, HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['ETag'], response['ETag'])
+        self.assertEqual(len([query for query in queries if 'document_snapshot' in query['sql']]), 1)
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.token, HTTP_IF_NONE_MATCH=cached['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        proposal.name = 'renamed'
+        proposal.save()
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.token, HTTP_IF_NONE_MATCH=cached['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], cached['ETag'])
+
+        # The page of a draft is not stored
+        formatting = ProposalFormatting.objects.get(proposal_writing=proposal)
+        proposal.status = 'draft'
+        proposal.save(update_fields=['status'])
+        response = self.client.get(f'/api/sales/proposal/view-proposal-formatting/{formatting.pk}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(DocumentSnapshot.objects.filter(key__startswith='proposal-formatting-html').exists())
+
+    def test_render_document_pdf(self):
+        proposal = ProposalWriting.objects.create(name='proposal', status='sent')
+        formatting = ProposalFormatting.objects.create(proposal_writing=proposal, element='<p>signed</p>')
+        # The engine echoes the page it is given
+        with tempfile.NamedTemporaryFile('w', suffix='.sh', delete=False) as engine:
+            engine.write('#!/bin/sh\ncat\n')
+        os.chmod(engine.name, 0o755)
+        with override_settings(WKHTMLTOPDF_CMD=engine.name):
+            file_id = render_document_pdf.apply(args=('proposal', proposal.pk, self.user_id)).result
+            self.assertEqual(render_document_pdf.apply(args=('proposal', proposal.pk, self.user_id)).result, file_id)
+            formatting.element = '<p>changed</p>'
+            formatting.save()
+            changed_id = render_document_pdf.apply(args=('proposal', proposal.pk, self.user_id)).result
+            mail_signed_document('proposal', proposal.pk, self.user_id, 'Signed', 'body', ['signed@example.com'])
+        os.remove(engine.name)
+        self.assertIn(b'<p>changed</p>', mail.outbox.pop().attachments[0][1])
+        self.assertNotEqual(changed_id, file_id)
+        self.assertEqual(DocumentSnapshot.objects.get(pdf=changed_id).content_type, 'text/html; charset=utf-8')
+
+        mail_document_pdfs([changed_id, file_id], [['contact@example.com'], []], 'Proposal', 'body')
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['contact@example.com'])
+        name, content, _ = mail.outbox[0].attachments[0]
+        self.assertEqual(name, 'proposal.pdf')
+        self.assertIn(b'<p>changed</p>', content)
+        for file in FileBuilder365.objects.filter(pk__in=[file_id, changed_id]):
+            file.file.delete()
+
+    def test_sign_without_files(self):
+        contact = Contact.objects.create(first_name='first', last_name='last', email='contact@example.com')
+        proposals = [ProposalWriting.objects.create(name=f'proposal {i}', lead=LeadDetail.objects.create(lead_title='lead'),
+                                                    user_create_id=user_id) for i, user_id in enumerate([self.user_id, None])]
+        for proposal in proposals:
+            ProposalFormatting.objects.create(proposal_writing=proposal, primary_contact=contact.pk, is_sent_otp=False,
+                                              element='<p>signed</p>')
+        # The mail is sent by the worker
+        for proposal in proposals:
+            response = self.client.post(f'/api/sales/proposal/proposal-writing/{proposal.pk}/sign/',
+                                        {'otp': '', 'signature': 'signature'}, HTTP_AUTHORIZATION=self.token)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(ProposalWriting.objects.get(pk=proposal.pk).proposal_formatting.has_signed)
+        self.assertEqual(len(mail.outbox), 0)
+
+        # Rendering fails, or the proposal has no owner to render it for
+        with override_settings(WKHTMLTOPDF_CMD='/bin/false'):
+            for proposal in proposals:
+                mail_signed_document('proposal', proposal.pk, proposal.user_create_id, 'signed', 'body',
+                                     ['contact@example.com'])
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual([message.to for message in mail.outbox], [['contact@example.com']] * 2)
+        self.assertEqual([message.attachments for message in mail.outbox], [[], []])
+        self.assertFalse(FileBuilder365.objects.exists())
+
+    def test_export_proposal(self):
+        proposals = []
+        for i in range(2):
+            proposal = ProposalWriting.objects.create(name=f'proposal {i}')
+            estimate = EstimateTemplate.objects.create(
+                name=f'estimate {i}', group_by_proposal=GroupByEstimate.objects.create(writing=proposal)
+            )
+            assemble = Assemble.objects.create(name='assemble')
+            estimate.assembles.add(assemble)
+            POFormula.objects.create(name=f'formula {i}', assemble=assemble, material="{'name': 'Brick'}", charge=i)
+            DataView.objects.create(name='view', estimate_template=estimate, result=i)
+            POFormulaToDataEntry.objects.create(estimate_template=estimate, value=str(i),
+                                                data_entry=DataEntry.objects.create(name='entry'))
+            proposals.append(proposal.pk)
+
+        task_id = export_proposal.apply(args=(proposals, self.user_id)).id
+        chunks = [export_proposal_chunk([pk]) for pk in proposals]
+        merged_id = merge_proposal_exports.apply(args=(chunks, self.user_id)).id
+        self.assertFalse(any(default_storage.exists(name) for name in chunks))
+        files = FileBuilder365.objects.filter(task_id__in=[task_id, merged_id])
+        self.assertEqual(len(files), 2)
+        for file in files:
+            with zipfile.ZipFile(file.file) as zipf:
+                self.assertEqual(zipf.namelist(), ['proposal 0.xlsx', 'proposal 1.xlsx'])
+                workbook = load_workbook(zipf.open('proposal 1.xlsx'), read_only=True)
+            file.file.delete()
+            self.assertEqual(workbook.sheetnames, ['Formula', 'Data Entry', 'Data View'])
+            self.assertEqual(list(workbook['Formula'].iter_rows(values_only=True))[1][:3],
+                             ('estimate 1', 'formula 1', 'Brick'))
+            self.assertEqual(list(workbook['Data Entry'].iter_rows(values_only=True))[1], ('estimate 1', 'entry', None, '1'))
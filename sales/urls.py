@@ -105,13 +105,14 @@ url_catalog = [
     path('list/<int:pk>/tree/', catalog.get_catalog_tree),
     path('list/<int:pk>/list/', catalog.get_catalog_list),
     path('list/ancestors/', catalog.get_catalog_ancestors),
-    path('list/<int:pk>/copy/', catalog.duplicate_catalogs),
-    path('list/materials/', catalog.get_materials),
+    path('list/<int:pk>/copy/', catalog.duplicate_catalogs, name='catalog-copy'),
+    path('list/materials/', catalog.get_materials, name='catalog-materials'),
     path('list/cost-table/', catalog.get_all_cost_table),
     path('cost-table-template/', catalog.CostTableTemplateListView.as_view()),
     path('cost-table-template/<int:pk>/', catalog.CostTableTemplateDetailView.as_view()),
     path('list/<int:pk>/copy-tree/', catalog.duplicate_catalogs_on_tree),
-    path('list/delete/', catalog.delete_catalogs),
+    path('list/delete/', catalog.delete_catalogs, name='catalog-delete'),
+    path('list/reprice/', catalog.reprice_formulas, name='catalog-reprice'),
     path('list/<int:pk_catalog>/levels/', catalog.CatalogLevelList.as_view()),
     path('list/<int:pk_catalog>/levels/<int:pk>/', catalog.CatalogLevelDetail.as_view()),
     path('list/<int:pk_catalog>/swap-level/', catalog.swap_level, name='swap-level'),
@@ -260,6 +261,7 @@ url_estimate = [
     path('estimate-template/<int:pk>/', estimate.EstimateTemplateDetail.as_view(), name='sales.estimate.detail'),
     path('estimate-template/<int:pk>/check-update/', estimate.check_update_estimate),
     path('estimate-template/<int:pk>/tag-values/', estimate.get_formula_tag_value),
+    path('estimate-template/<int:pk>/calculate/', estimate.calculate_estimate, name='sales.estimate.calculate'),
     path('linked-descriptions/', estimate.get_linked_descriptions),
     path('linked-descriptions/<str:pk>/', estimate.get_linked_description),
     path('tag-formula/', estimate.get_tag_formula),
@@ -283,6 +285,7 @@ url_proposal = [
     path('proposal-writing/template-groups/', proposal.parse_template),
     path('proposal-writing/export/', proposal.export_proposal_view),
     path('proposal-writing/duplicate/', proposal.duplicate_proposal),
+    path('proposal-writing/send-pdf/', proposal.send_proposal_pdfs),
     path('proposal-writing-compact/', proposal.ProposalWritingCompactList.as_view()),
     path('proposal-writing/<int:pk>/', proposal.ProposalWritingDetail.as_view(), name='detail-proposal'),
     path('proposal-writing/<int:pk>/reset-signature/', proposal.reset_signature),
@@ -294,6 +297,7 @@ url_proposal = [
     path('proposal-writing/<int:pk>/reset-formatting/', proposal.reset_formatting),
     path('proposal-writing/<int:pk>/table-formatting/', proposal.get_table_formatting),
     path('proposal-writing/<int:pk>/image/', proposal.get_image),
+    path('proposal-writing/<int:pk>/calculate/', proposal.calculate_proposal),
     path('formatting/', proposal.ProposalFormattingTemplateGenericView.as_view(), name='proposal-formatting'),
     path('view-proposal-formatting/<int:formatting_id>/', proposal.view_proposal_formatting),
     path('proposal-writing/<int:pk>/items/', proposal.get_items),
@@ -312,6 +316,7 @@ url_change_order = [
 
 url_invoice = [
     path('', invoice.InvoiceListView.as_view()),
+    path('send-pdf/', invoice.send_invoice_pdfs),
     path('<int:pk>/template-data/', invoice.invoice_template_data),
     path('<int:pk>/publish/', invoice.publish_template),
     path('<int:pk>/sign/', invoice.invoice_sign),
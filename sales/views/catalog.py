@@ -1,23 +1,30 @@
+from collections import defaultdict
+from itertools import product
+
 from celery.result import AsyncResult
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
-from django.db.models import Value
+from django.core.cache import cache
+from django.db.models import Case, Q, Value, When, prefetch_related_objects
 from django.shortcuts import get_object_or_404
 from django_filters import rest_framework as filters
 from django.apps import apps
 from openpyxl.workbook import Workbook
-from rest_framework import generics, permissions, status, filters as rf_filters
+from rest_framework import generics, permissions, serializers, status, filters as rf_filters
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
 
 from base.constants import URL_CLOUD
 from base.models.config import FileBuilder365
 from base.permissions import CatalogPermissions
 from base.serializers.base import FileBuilder365ResSerializer
-from base.tasks import import_catalog_task, process_export_catalog
+from base.tasks import delete_catalogs_task, import_catalog_task, process_export_catalog, reprice_formulas_task
 from base.utils import file_response
 from ..filters.catalog import CatalogFilter
-from ..models.catalog import Catalog, CatalogLevel, DataPointUnit, CostTableTemplate
+from ..models.catalog import Catalog, CatalogClosure, CatalogLevel, CostTableRow, DataPoint, DataPointUnit, CostTableTemplate, \
+    TREE_FIELDS, DEFAULT_TREE_FIELDS, MATERIAL_LEVELS_CACHE_KEY, MATERIAL_LEVELS_CACHE_TIMEOUT, invalidate_ancestors, \
+    invalidate_material_levels
 from ..serializers import catalog
 from ..serializers.catalog import CatalogEstimateSerializer, CatalogSerializer
 from api.middleware import get_request
@@ -152,8 +159,22 @@ def get_catalog_levels(request, pk):
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated & CatalogPermissions])
 def get_catalog_tree(request, pk):
+    """
+    Params: depth: int (optional), fields: comma separated keys of each node (optional)
+    """
     catalog = get_object_or_404(Catalog, pk=pk)
-    catalog_tree = catalog.get_tree_view()
+    depth = request.GET.get('depth')
+    fields = request.GET.get('fields')
+    if depth is not None:
+        if not depth.isdigit():
+            return Response(status=status.HTTP_400_BAD_REQUEST, data='depth must be a positive integer')
+        depth = int(depth)
+    if fields:
+        fields = [f for f in fields.split(',') if f]
+        invalid = set(fields).difference(TREE_FIELDS)
+        if invalid:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data=f'Invalid fields: {", ".join(sorted(invalid))}')
+    catalog_tree = catalog.get_tree_view(depth=depth, fields=fields or DEFAULT_TREE_FIELDS)
     return Response(status=status.HTTP_200_OK, data=catalog_tree)
 
 
@@ -167,16 +188,45 @@ def get_catalog_list(request, pk):
     return Response(status=status.HTTP_200_OK, data=serializer.data)
 
 
+# Number of catalogs from which a delete runs in background
+BACKGROUND_DELETE_SIZE = 1000
+
+
 @api_view(['DELETE'])
 @permission_classes([permissions.IsAuthenticated & CatalogPermissions])
 def delete_catalogs(request):
+    """
+    Delete catalogs with their descendants, body: [id].
+    Return 204 once deleted. Branches of more than BACKGROUND_DELETE_SIZE catalogs, or any branch with
+    ?background=true, are deleted by a task: return 200 {"task_id": id}
+    """
     ids = request.data
-    catalogs = Catalog.objects.filter(pk__in=ids)
-    for catalog in catalogs:
-        catalog.delete()
+    background = serializers.BooleanField().to_internal_value(request.query_params.get('background', False))
+    if background or CatalogClosure.objects.filter(ancestor__in=ids).count() + len(ids) > BACKGROUND_DELETE_SIZE:
+        process_delete = delete_catalogs_task.delay(ids, request.user.pk)
+        task_id = process_delete.id
+        return Response(status=status.HTTP_200_OK, data={"task_id": task_id})
+
+    delete_catalogs_task(ids, request.user.pk)
     return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated & CatalogPermissions])
+def reprice_formulas(request):
+    """
+    Report the formulas whose cost changed in the cost tables of these catalogs, update them in background
+    unless dry_run. Body: {"catalogs": [id], "dry_run": true}
+    """
+    catalog_ids = list(Catalog.objects.filter(
+        pk__in=request.data.get('catalogs', []), company=request.user.company
+    ).values_list('pk', flat=True))
+    if serializers.BooleanField().to_internal_value(request.data.get('dry_run', True)):
+        return Response(status=status.HTTP_200_OK, data=reprice_formulas_task(catalog_ids, dry_run=True))
+    process_reprice = reprice_formulas_task.delay(catalog_ids, dry_run=False)
+    return Response(status=status.HTTP_200_OK, data={"task_id": process_reprice.id})
+
+
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated & CatalogPermissions])
 def get_catalog_ancestors(request):
@@ -228,7 +278,6 @@ def duplicate_catalogs(request, pk):
     """
 
     parent_catalog = get_object_or_404(Catalog, pk=pk)
-    new_c = []
     data = []
     # duplicate by level
     if isinstance(request.data, list):
@@ -237,14 +286,12 @@ def duplicate_catalogs(request, pk):
             data_points = d.get('data_points', [])
             try:
                 c = Catalog.objects.get(pk=d.get('id'))
-                new_c.append(c.duplicate(parent=parent_catalog, depth=depth, data_points=data_points))
+                data.extend(c.duplicate(parent=parent_catalog, depth=depth, data_points=data_points).values())
             except Catalog.DoesNotExist:
                 pass
-        for new in new_c:
-            data.extend(new.get_all_descendant(have_self=True))
+        data = Catalog.objects.filter(id__in=data).prefetch_related('parents', 'children', 'data_points__unit')
         return Response(status=status.HTTP_201_CREATED,
-                        data=catalog.CatalogSerializer(Catalog.objects.filter(id__in=data),
-                                                       many=True, context={'request': request}).data)
+                        data=catalog.CatalogSerializer(data, many=True, context={'request': request}).data)
     return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
@@ -262,11 +309,11 @@ def duplicate_catalogs_on_tree(request, pk):
         parents = Catalog.objects.filter(pk__in=descendant, level_id=level)
         for root in parents:
             try:
-                root.duplicate_by_catalog(parent=parent_catalog, descendant=descendant,
-                                          data_points=data_points)
+                root.duplicate(parent=parent_catalog, descendant=descendant, data_points=data_points)
             except Catalog.DoesNotExist:
                 pass
-        data = Catalog.objects.filter(pk__in=parent_catalog.get_all_descendant())
+        data = Catalog.objects.filter(pk__in=parent_catalog.get_all_descendant()).prefetch_related(
+            'parents', 'children', 'data_points__unit')
         serializer = catalog.CatalogSerializer(data, many=True, context={'request': request})
         return Response(status=status.HTTP_201_CREATED, data=serializer.data)
     return Response(status=status.HTTP_400_BAD_REQUEST)
@@ -285,38 +332,47 @@ def swap_level(request, pk_catalog):
             levels = request.data.get('levels')
             catalogs = request.data.get('catalogs')
 
-            updated_level = []
-            level_id = []
+            level_id = [l.get('id') for l in levels]
+            updated_level = CatalogLevel.objects.in_bulk(level_id)
+            if len(updated_level) != len(set(level_id)):
+                raise CatalogLevel.DoesNotExist('Level not found')
             for l in levels:
-                pk = l.get('id')
-                level_id.append(pk)
-                level = CatalogLevel.objects.get(pk=pk)
-                level.parent_id = l.get('parent')
-                updated_level.append(level)
+                updated_level[l.get('id')].parent_id = l.get('parent')
+            updated_level = [updated_level[pk] for pk in level_id]
             ancestor_catalog.all_levels.filter(pk__in=level_id).update(parent=None)
             CatalogLevel.objects.bulk_update(updated_level, fields=['parent'])
 
             # Validate level
             ordered_level = ancestor_catalog.get_ordered_levels()
-
-            updated_catalog = []
-            for key in catalogs.keys():
-                parent_catalog = Catalog.objects.get(pk=key)
-                children_catalog = Catalog.objects.filter(id__in=catalogs[key])
-                for c in children_catalog:
-                    c.parents.clear()
-                    c.parents.add(parent_catalog)
-                    c.level_index = ordered_level.index(c.level)
-                    updated_catalog.append(c)
+            level_index = {l.pk: index for index, l in enumerate(ordered_level)}
+
+            # Move all the categories at once
+            new_parents = {int(child): int(key) for key in catalogs.keys() for child in catalogs[key]}
+            if Catalog.objects.filter(pk__in=set(new_parents.values())).count() != len(set(new_parents.values())):
+                raise Catalog.DoesNotExist('Parent category not found')
+            updated_catalog = list(Catalog.objects.filter(id__in=list(new_parents)))
+            for c in updated_catalog:
+                if c.level_id not in level_index:
+                    raise Exception('Category is not in a level of the catalog')
+                c.level_index = level_index[c.level_id]
+            through = Catalog.parents.through
+            through.objects.filter(from_catalog_id__in=list(new_parents)).delete()
+            through.objects.bulk_create([through(from_catalog_id=c.pk, to_catalog_id=new_parents[c.pk])
+                                         for c in updated_catalog])
+            CatalogClosure.refresh(new_parents)
 
             # Validate catalog
             if Catalog.objects.filter(level__in=level_id).count() != len(updated_catalog):
                 raise Exception('Missing or too much categories updated')
 
             # Update level index for all categories
-            for l in ordered_level:
-                Catalog.objects.filter(level=l).update(level_index=ordered_level.index(l))
+            Catalog.objects.filter(level__in=ordered_level).update(level_index=Case(
+                *[When(level_id=pk, then=Value(index)) for pk, index in level_index.items()]
+            ))
+            invalidate_ancestors([ancestor_catalog.pk])
+            invalidate_material_levels(ancestor_catalog.company_id)
 
+            prefetch_related_objects(updated_catalog, 'parents', 'children', 'data_points__unit')
             catalog_serializer = catalog.CatalogSerializer(updated_catalog, many=True,
                                                            context={'request': request})
             level_serializer = catalog.CatalogLevelModelSerializer(updated_level, many=True,
@@ -332,63 +388,91 @@ def swap_level(request, pk_catalog):
     return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
-def parse_dict(dictionary, is_formula=[], actual_data=[]):
-    data = []
-    i = 0
-    for name, value in dictionary.items():
-        data.append({'name': name, 'value': value, 'is_formula': is_formula[i] if i < len(is_formula) else False, 
-                     'default_value': actual_data[i] if i < len(actual_data) else 0})
-        i += 1
-    return data
+class MaterialPagination(CursorPagination):
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
 
 
-def parse_c_table(children):
-    data = []
-    for child in children:
+def get_material_levels(company):
+    """
+    Serialized full ancestor of every catalog having a cost table, by catalog id.
+    Cached per company until a catalog, its data points or the tree change.
+    """
+    key = MATERIAL_LEVELS_CACHE_KEY.format(company.pk if company else None)
+    levels = cache.get(key)
+    if levels is not None:
+        return levels
+
+    catalog_ids = set(CostTableRow.objects.filter(company=company).values_list('catalog_id', flat=True))
+    chains = Catalog.get_ancestor_chains(catalog_ids, Catalog.objects.defer('c_table').prefetch_related('data_points'))
+
+    levels = {}
+    for pk, chain in chains.items():
         try:
-            try:
-                ancestor = child.get_full_ancestor()
-                levels = [CatalogEstimateSerializer(c).data for c in ancestor[::-1]]
-            except:
-                levels = []
-            c_table = child.c_table
-            header = c_table['header']
-
-            if len(header) >= 3:
-                header[:3] = 'name', 'unit', 'cost'
-            header_formats = [is_formula.get('isFormula') for is_formula in c_table.get('header_format', [])]
-            actual_data = c_table.get('actual_data', [])
-            for i, d in enumerate(c_table['data']):
-                actual_value = actual_data[i] if i < len(actual_data) else []
-                content = {**{header[j]: d[j] for j in range(len(header))}, **{"id": f'{child.pk}:{i}'},
-                           'levels': levels}
-                clone = content.copy()
-                clone.pop('id')
-                clone.pop('levels')
-                content['columns'] = parse_dict(clone, header_formats, actual_value)
-                data.append(content)
+            ancestor = chain[0].get_full_ancestor_from_chain(chain)
+            levels[pk] = [CatalogEstimateSerializer(c).data for c in ancestor[::-1]]
         except:
-            """Some old data is not valid"""
-    return data
+            levels[pk] = []
+    cache.set(key, levels, MATERIAL_LEVELS_CACHE_TIMEOUT)
+    return levels
+
+
+def serialize_material(row, levels):
+    columns = [dict(column) for column in row.columns]
+    if len(columns) >= 3:
+        for column, name in zip(columns, ('name', 'unit', 'cost')):
+            column['name'] = name
+    return {**{column['name']: column['value'] for column in columns}, **{"id": row.material_id},
+            'levels': levels.get(row.catalog_id, []), 'columns': columns}
+
+
+def parse_c_table(children):
+    """
+    Parameters:
+        children: queryset of catalogs
+    """
+    levels = get_material_levels(get_request().user.company)
+    rows = CostTableRow.objects.filter(catalog__in=children).order_by(
+        'catalog__index', '-catalog__modified_date', 'catalog_id', 'row_index'
+    )
+    return [serialize_material(row, levels) for row in rows]
+
+
+def filter_materials(rows, params):
+    search = params.get('search')
+    if search:
+        query = Q(name__icontains=search) | Q(unit__icontains=search)
+        cost = CostTableRow.parse_cost(search)
+        if cost is not None:
+            query |= Q(cost=cost)
+        rows = rows.filter(query)
+    unit = params.get('unit')
+    if unit:
+        rows = rows.filter(unit=unit)
+    return rows
 
 
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated & CatalogPermissions])
 def get_materials(request):
     """
-    Get cost table from ancestor catalog
+    Get cost table rows, paginated by cursor
+    Params: catalog: int, search: str (name, unit or cost), unit: str, cursor: str, page_size: int
     """
+    company = get_request().user.company
     filter_query = request.GET.get('catalog', None)
     if filter_query:
         c = get_object_or_404(Catalog.objects.all(), pk=filter_query)
-        children = Catalog.objects.filter(
-            pk__in=c.get_all_descendant(have_self=True)
-        )
+        rows = CostTableRow.objects.filter(catalog_id__in=c.get_all_descendant(have_self=True))
     else:
-        children = Catalog.objects.filter(company=get_request().user.company)
-    children = children.difference(Catalog.objects.filter(c_table=Value('{}')))
-    data = parse_c_table(children)
-    return Response(status=status.HTTP_200_OK, data=data)
+        rows = CostTableRow.objects.filter(company=company)
+    rows = filter_materials(rows, request.GET)
+    paginator = MaterialPagination()
+    page = paginator.paginate_queryset(rows, request)
+    levels = get_material_levels(company)
+    return paginator.get_paginated_response([serialize_material(row, levels) for row in page])
 
 
 @api_view(['GET'])
@@ -431,8 +515,12 @@ def get_file_export_catalog(request, task_id, *args, **kwargs):
 @permission_classes([permissions.IsAuthenticated & CatalogPermissions])
 def get_status_process(request, task_id,  *args, **kwargs):
     result = AsyncResult(task_id)
-
-    return Response(status=status.HTTP_200_OK, data={"status": result.status})
+    data = {"status": result.status}
+    if result.status == 'PROGRESS':
+        data['progress'] = result.info
+    elif result.status == 'SUCCESS' and isinstance(result.result, dict):
+        data['result'] = result.result
+    return Response(status=status.HTTP_200_OK, data=data)
 
 
 @api_view(['GET'])
@@ -476,179 +564,102 @@ def export_catalog(request, *args, **kwargs):
 
 
 def handle_export(pk, workbook, sheet_name):
-    root_catalogs = Catalog.objects.filter(id=pk)
-    all_paths = []
-    name = root_catalogs.first().name
-    level = Catalog.objects.get(id=pk).get_ordered_levels()
-    # get all path catalog to cost table
-    for root_catalog in root_catalogs:
-        find_all_paths(root_catalog, [], all_paths)
-
-    # get all data point with catalog on path
-    rs = []
-    for path in all_paths:
-        temp = list()
-        temp_catalog_not_dtp = list()
-        for idx, data in enumerate(path):
-            if isinstance(data, list):
-                temp.append(data)
-                temp_catalog_not_dtp.append(data)
-            elif isinstance(data, Catalog):
-                tmp = list()
-                if data.data_points.exists():
-                    temp_list = []
-                    for data_point in data.data_points.all():
-                        temp_list.append(data.name)
-                        temp_list.append(data.icon)
-                        if data_point.unit:
-                            temp_list.append(data_point.unit.name)
-                        else:
-                            temp_list.append('')
-                        temp_list.append(data_point.value)
-                        temp_list.append(data_point.linked_description)
-                        tmp.append(temp_list)
-                        temp_list = []
-                        if idx != 0 and len(path) == 2:
-                            temp_catalog_not_dtp.append([data.id])
-                    temp.append(tmp)
-                else:
-                    if idx != 0:
-                        temp.append([data.id])
-                        temp_catalog_not_dtp.append([data.id])
-        if temp == []:
-            rs.append(temp_catalog_not_dtp)
-
-        elif len(temp) == 1 and isinstance(temp[0], list):
-            rs.append(temp_catalog_not_dtp)
-        else:
-            rs.append(temp)
-
-    # get all path with data point
-    result_paths = []
-    for i in rs:
-        generate_paths(i, [], result_paths)
-
-    # handle write headers all catalog and cost table
-    # workbook = Workbook()
-    data_sheet_name = sheet_name + '-' + name
+    """
+    Write the sheet of catalog pk, one row per combination of data points and cost table row on each path.
+    The subtree is loaded once and rows are generated lazily, so a write-only workbook keeps memory bounded
+    """
+    root = Catalog.objects.get(id=pk)
+    level = root.get_ordered_levels()
+    nodes, _, children = root.get_subtree()
+    data_points = defaultdict(list)
+    for data_point in DataPoint.objects.filter(catalog__in=list(nodes)).select_related('unit'):
+        data_points[data_point.catalog_id].append(data_point)
+    root = nodes[root.pk]
+
+    def iter_categories():
+        for path in iter_catalog_paths(root, children):
+            categories = get_export_categories(path, data_points)
+            if categories and all(categories):
+                yield categories
+
+    # Cost table columns of all paths are needed for the header row, before writing any data
+    all_key = {}
+    for categories in iter_categories():
+        if isinstance(categories[-1][0], dict):
+            for data in categories[-1]:
+                all_key.update(dict.fromkeys(data))
+    all_key = list(all_key)
+
+    data_sheet_name = sheet_name + '-' + root.name
     data_sheet_name = data_sheet_name.replace("/", "-")
     data_sheet_name = data_sheet_name[:31]
     catalog_sheet = workbook.create_sheet(title=data_sheet_name)
     headers = []
-    for i in range(1, len(level) + 1):
-        data_level = level[i - 1]
-        iteration_headers = [f"{data_level.name}", "image", f"value", f"unit", f"des"]
-        headers.extend(iteration_headers)
-
-    all_key = []
-    for path in result_paths:
-        for data in path:
-            if isinstance(data, dict):
-                for key in data.keys():
-                    if key not in all_key:
-                        all_key.append(key)
-                break
+    for data_level in level:
+        headers.extend([f"{data_level.name}", "image", "value", "unit", "des"])
     headers.extend(all_key)
     catalog_sheet.append(headers)
 
     # write all data into excel
     if len(level) > 0:
-        for path in result_paths:
-            number = len(level) * 5
-            row = [""] * (number + len(all_key))
-            for idx, data in enumerate(path):
-                # write catalog data
-                if isinstance(data, int):
-                    data_catalog = Catalog.objects.get(id=data)
-                    if idx == 0:
-                        row[idx] = data_catalog.name
-                        row[idx + 1] = data_catalog.icon
-                    else:
-                        row[idx * 5] = data_catalog.name
-                        row[idx * 5 + 1] = data_catalog.icon
-
-                elif isinstance(data, list):
-                    if idx == 0:
-                        row[idx] = data[0]
-                        row[idx + 1] = data[1]
-                        row[idx + 2] = data[2]
-                        row[idx + 3] = data[3]
-                        row[idx + 4] = data[4]
-                    else:
-                        row[idx * 5] = data[0]
-                        row[idx * 5 + 1] = data[1]
-                        row[idx * 5 + 2] = data[2]
-                        row[idx * 5 + 3] = data[3]
-                        row[idx * 5 + 4] = data[4]
-                # write cost table
-                elif isinstance(data, dict):
-                    temp_len = len(headers) - number
-                    temp_length = headers[-temp_len:]
-                    for index, header in enumerate(temp_length, number):
-                        if header in data:
-                            row[index] = data[header]
-                        else:
-                            row[index] = ""
-                # write catalog not data point
-                else:
-                    if idx == 0:
-                        row[idx] = data
+        number = len(level) * 5
+        for categories in iter_categories():
+            for path in product(*categories):
+                row = [""] * (number + len(all_key))
+                for idx, data in enumerate(path):
+                    # write catalog not data point
+                    if isinstance(data, Catalog):
+                        row[idx * 5] = data.name
+                        row[idx * 5 + 1] = data.icon
+                    # write catalog data point
+                    elif isinstance(data, list):
+                        row[idx * 5:idx * 5 + 5] = data
+                    # write cost table
                     else:
-                        row[idx * 5] = data
-            catalog_sheet.append(row)
+                        for index, header in enumerate(all_key, number):
+                            row[index] = data.get(header, "")
+                catalog_sheet.append(row)
 
 
-def generate_paths(categories, current_path, result):
-    if categories == [[]]:
-        current_category = []
-    elif categories == []:
-        current_category = categories
-    elif isinstance(categories[0][0], dict):
-        current_category = categories[0]
+def iter_catalog_paths(node, children, path=()):
+    """Yield every path of catalogs from node to a leaf, depth first"""
+    path = path + (node,)
+    if not children[node.pk]:
+        yield path
+    for child in children[node.pk]:
+        yield from iter_catalog_paths(child, children, path)
 
-    elif isinstance(categories[0][0], list):
 
-        current_category = categories[0]
-
-    elif isinstance(categories[0][0], int):
-        current_category = categories[0]
-
-    else:
-        current_category = set(categories[0])
-    for item in current_category:
-        new_path = current_path + [item]
-
-        if len(categories) == 1:
-            result.append(new_path)
-        else:
-            generate_paths(categories[1:], new_path, result)
-
-
-def find_all_paths(node, current_path, all_paths):
-    if node is None:
-        return
-
-    current_path.append(node)
-    if not node.children.exists():
-        path = list(current_path)
-        if hasattr(node, 'c_table') and node.c_table:
-            result_list = []
-            headers = node.c_table['header']
-            for row in node.c_table["data"]:
-                result_dict = dict(zip(headers, row))
-                result_list.append(result_dict)
-            all_paths.append(path + [result_list])
-
-        elif hasattr(node, 'c_table') and not node.c_table:
-            # all_paths.append(path + [node.name])
-            all_paths.append(path)
-        current_path.pop()
-    else:
-        for child in node.children.all():
-            find_all_paths(child, list(current_path), all_paths)
-
-    if len(current_path) > 1:
-        current_path.pop()
+def get_export_categories(path, data_points):
+    """
+    Return the choices of each column group of a path: the catalog itself, one of its data points
+    or one of the cost table rows of the leaf. Every combination of choices is a row of the export
+    """
+    leaf = path[-1]
+    cost_table = None
+    if leaf.c_table:
+        headers = leaf.c_table['header']
+        cost_table = [dict(zip(headers, row)) for row in leaf.c_table['data']]
+    length = len(path) + (cost_table is not None)
+    categories = []
+    categories_not_dtp = []
+    for idx, data in enumerate(path):
+        if data_points[data.pk]:
+            categories.append([[data.name, data.icon, data_point.unit.name if data_point.unit else '',
+                                data_point.value, data_point.linked_description]
+                               for data_point in data_points[data.pk]])
+            if idx != 0 and length == 2:
+                categories_not_dtp.append([data])
+        elif idx != 0:
+            categories.append([data])
+            categories_not_dtp.append([data])
+    if cost_table is not None:
+        categories.append(cost_table)
+        categories_not_dtp.append(cost_table)
+    # a single group is written without its data points
+    if len(categories) <= 1:
+        return categories_not_dtp
+    return categories
 
 
 @api_view(['POST'])
@@ -700,14 +711,12 @@ def move_catalog(request):
     Payload: [id: int]
     """
     data = request.data
-    catalog_update = []
-    for index, data_catalog in enumerate(data):
-        catalog = Catalog.objects.get(pk=data_catalog)
-        catalog.index = index
-        catalog_update.append(catalog)
-
-    Catalog.objects.bulk_update(catalog_update, ['index'])
-    rs = Catalog.objects.filter(id__in=data)
+    indexes = {int(pk): index for index, pk in enumerate(data)}
+    if indexes:
+        Catalog.objects.filter(id__in=list(indexes)).update(index=Case(
+            *[When(pk=pk, then=Value(index)) for pk, index in indexes.items()]
+        ))
+    rs = Catalog.objects.filter(id__in=data).prefetch_related('parents', 'children', 'data_points__unit')
     catalogs = CatalogSerializer(
         rs, many=True, context={'request': request}).data
     return Response(status=status.HTTP_200_OK, data=catalogs)
\ No newline at end of file
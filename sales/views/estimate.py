@@ -17,7 +17,7 @@ from rest_framework.response import Response
 from rest_framework import serializers
 
 from base.permissions import EstimatePermissions
-from base.utils import file_response
+from base.utils import file_response, parse_literal
 from sales.filters.estimate import FormulaFilter, EstimateTemplateFilter, AssembleFilter, GroupFormulaFilter,\
     DescriptionFilter, UnitFilter, DataEntryFilter
 from sales.models import DataPoint, Catalog
@@ -27,11 +27,10 @@ from sales.serializers.catalog import CatalogEstimateSerializer, CatalogEstimate
 from sales.serializers.estimate import POFormulaGroupCompactSerializer, POFormulaSerializer, POFormulaGroupingSerializer, DataEntrySerializer, \
     UnitLibrarySerializer, DescriptionLibrarySerializer, LinkedDescriptionSerializer, AssembleSerializer, \
     EstimateTemplateSerializer, TaggingSerializer, GroupFormulasSerializer, POFormulaCompactSerializer, \
-    AssembleCompactSerializer, EstimateTemplateCompactSerializer
+    AssembleCompactSerializer, EstimateTemplateCompactSerializer, CalculateEstimateSerializer
 from sales.views.catalog import parse_c_table
 from api.middleware import get_request
 from base.views.base import CompanyFilterMixin
-from base.constants import null, true, false
 
 DATA_ENTRY_PREFETCH_RELATED = ['data_entry__unit', 'data_entry__material_selections', 'data_entry']
 FORMULA_PREFETCH_RELATED = ['self_data_entries__' + i for i in DATA_ENTRY_PREFETCH_RELATED]
@@ -307,6 +306,20 @@ def get_formula_tag_value(request, pk):
     return Response(status=status.HTTP_200_OK, data=data)
 
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated & EstimatePermissions])
+def calculate_estimate(request, pk):
+    """
+    Evaluate the formulas of an estimate.
+    Body: data_entries ({data entry id: value}) to override the values of the estimate, save to store the results
+    """
+    estimate = get_object_or_404(EstimateTemplate.objects.filter(company=request.user.company), pk=pk)
+    serializer = CalculateEstimateSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    data = estimate.calculate(serializer.validated_data['data_entries'], save=serializer.validated_data['save'])
+    return Response(status=status.HTTP_200_OK, data=data)
+
+
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated & EstimatePermissions])
 def get_tag_formula(request):
@@ -365,7 +378,6 @@ def get_material_by_data_entry(request, pk):
     children = Catalog.objects.none()
     for category in categories:
         children |= Catalog.objects.filter(pk__in=category.get_all_descendant(have_self=True))
-    children = children.difference(Catalog.objects.filter(c_table=Value('{}')))
     data = parse_c_table(children)
     return Response(status=status.HTTP_200_OK, data=data)
 
@@ -713,7 +725,7 @@ def import_data_entry(request):
             'name': row[0].value,
             'unit': unit,
             'is_dropdown': row[2].value,
-            'dropdown': eval(row[3].value),
+            'dropdown': parse_literal(row[3].value),
             'is_material_selection': row[4].value,
         }
 
@@ -769,8 +781,8 @@ def import_formula(request):
             'gross_profit': row[13].value or '',
             'description_of_formula': row[14].value or '',
             'formula_scenario': row[15].value or '',
-            'material_data_entry': eval(row[16].value),
-            'catalog_materials': eval(row[17].value),
+            'material_data_entry': parse_literal(row[16].value),
+            'catalog_materials': parse_literal(row[17].value),
         }
 
         ul = POFormula.objects.create(**data_create)
@@ -832,7 +844,7 @@ def import_assemble(request):
         row = assemble_sheet[row_number]
         data_create = {
             'name': row[0].value,
-            **eval(row[1].value)
+            **parse_literal(row[1].value)
         }
 
         serializer = AssembleSerializer(data=data_create, context={'request': request})
@@ -857,7 +869,7 @@ def import_estimate(request):
         row = estimate_sheet[row_number]
         data_create = {
             'name': row[0].value,
-            **eval(row[1].value)
+            **parse_literal(row[1].value)
         }
         serializer = EstimateTemplateSerializer(data=data_create, context={'request': request})
         if serializer.is_valid(raise_exception=False):
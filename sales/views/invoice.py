@@ -6,16 +6,18 @@ from django.utils.crypto import get_random_string
 from rest_framework import generics, permissions
 from rest_framework import status, filters as rf_filters
 from rest_framework.response import Response
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.renderers import JSONRenderer
 from django_filters import rest_framework as filters
 
 from api.models import InvoiceSetting
+from base.models.config import DocumentSnapshot
 from base.permissions import InvoicePermissions
 from base.serializers.config import CompanySerializer
 from base.views.base import CompanyFilterMixin
-from base.tasks import celery_send_mail, send_mail_with_attachment
+from base.tasks import celery_send_mail, send_mail_with_attachment, start_mail_pdfs
 from sales.models import Invoice, PaymentHistory, LeadDetail, CreditMemo, InvoiceTemplate
-from sales.models.invoice import TemplateInvoice
+from sales.models.invoice import INVOICE_DOCUMENT_KEY, INVOICE_HTML_KEY, TemplateInvoice
 from sales.models.proposal import ProposalWriting
 from sales.serializers.invoice import InvoiceSerializer, InvoiceTemplateMinorSerializer, PaymentHistorySerializer, InvoicePaymentSerializer, \
     ProposalForInvoiceSerializer, LeadInvoiceSerializer, CreditMemoSerializer, InvoiceTemplateSerializer
@@ -100,8 +102,75 @@ class InvoiceTemplateDetail(CompanyFilterMixin, generics.RetrieveUpdateDestroyAP
     queryset = InvoiceTemplate.objects.all()
 
 
+def get_template_data(request, invoice_obj, template_obj):
+    """Items, payments, company and lead of an invoice with its template"""
+    company = invoice_obj.company
+    company_data = CompanySerializer(company).data
+    data = {
+        # 'items': [{'name': 'name', 'description': 'description',
+        #            'quantity': 'quantity', 'total_price': '100', 'unit_price': '123'} for i in range(5)],
+        'items': invoice_obj.get_items(),
+        'company': company_data,
+        'invoice': InvoiceSerializer(invoice_obj).data,
+        'lead': None,
+    }
+    from django.db.models import Sum
+    amount_paid = invoice_obj.payment_histories.aggregate(Sum('amount', default=0))['amount__sum']
+    amount_paid = amount_paid or 0
+    total_amount = sum(d['total_price'] for d in data['items'])
+    data['amount_paid'] = amount_paid
+    data['balance_due'] = total_amount - amount_paid
+    if data['invoice']['lead_id']:
+        data['lead'] = LeadDetailCreateSerializer(LeadDetail.objects.get(pk=data['invoice']['lead_id']),
+                                                  context={'request': request}).data
+    return {**data, **InvoiceTemplateMinorSerializer(template_obj).data}
+
+
+def store_template_document(request, invoice_obj, template_obj):
+    """Render the template of a published invoice and store it as the snapshot served to clients"""
+    content = JSONRenderer().render(get_template_data(request, invoice_obj, template_obj))
+    return DocumentSnapshot.store(INVOICE_DOCUMENT_KEY.format(invoice_obj.pk), content, invoice_obj.company)
+
+
+def get_invoice_html(request, pk):
+    """Snapshot of the page of an invoice rendered from its template and the name of its PDF"""
+    invoice_obj = Invoice.objects.get(pk=pk)
+    snapshot = DocumentSnapshot.objects.filter(key=INVOICE_HTML_KEY.format(pk)).first()
+    if not snapshot:
+        template_obj = TemplateInvoice.objects.get_or_create(invoice=invoice_obj)[0]
+        content = render_to_string('invoice-document.html', {
+            **get_template_data(request, invoice_obj, template_obj), 'signature': template_obj.signature
+        })
+        snapshot = DocumentSnapshot.store(INVOICE_HTML_KEY.format(pk), content, invoice_obj.company,
+                                          'text/html; charset=utf-8', save=invoice_obj.status != Invoice.InvoiceStatus.DRAFT)
+    return snapshot, f'{invoice_obj.name}.pdf'
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated & InvoicePermissions])
+def send_invoice_pdfs(request):
+    """
+    Render invoices to PDF in background and mail each one to the contacts of its template
+    Payloads: {"invoices": [1, 2], "subject": "", "content": ""}
+    """
+    templates = TemplateInvoice.objects.filter(invoice__in=request.data.get('invoices', []),
+                                               invoice__company=request.user.company)
+    contacts = dict(Contact.objects.filter(pk__in={pk for t in templates for pk in t.contacts or []}).values_list('pk', 'email'))
+    documents = [(t.invoice_id, [contacts[pk] for pk in t.contacts or [] if contacts.get(pk)]) for t in templates]
+    if not documents:
+        return Response(status=status.HTTP_400_BAD_REQUEST, data={'invoices': ['No invoice to send']})
+    process_mail = start_mail_pdfs('invoice', documents, request.user.pk, request.data.get('subject', ''),
+                                   request.data.get('content', ''))
+    return Response(status=status.HTTP_200_OK, data={'task_id': process_mail.id})
+
+
 @api_view(['GET', 'PUT'])
 def invoice_template_data(request, pk):
+    if request.method == 'GET':
+        # Published invoices are served from their snapshot
+        snapshot = DocumentSnapshot.objects.filter(key=INVOICE_DOCUMENT_KEY.format(pk)).first()
+        if snapshot:
+            return snapshot.get_response(request, status=status.HTTP_201_CREATED)
     invoice_obj = get_object_or_404(Invoice.objects.all(), pk=pk)
     company = invoice_obj.company
 
@@ -122,31 +191,14 @@ def invoice_template_data(request, pk):
             )
         template_obj.description = invoice_setting.default_owners_invoice
         template_obj.save()
-    serializer = InvoiceTemplateMinorSerializer(template_obj)
     if request.method == 'PUT':
         serializer = InvoiceTemplateMinorSerializer(instance=template_obj, data=request.data)
         serializer.is_valid(raise_exception=True)
         serializer.save()
-    company = invoice_obj.company
-    company_data = CompanySerializer(company).data
-    data = {
-        # 'items': [{'name': 'name', 'description': 'description',
-        #            'quantity': 'quantity', 'total_price': '100', 'unit_price': '123'} for i in range(5)],
-        'items': invoice_obj.get_items(),
-        'company': company_data,
-        'invoice': InvoiceSerializer(invoice_obj).data,
-        'lead': None,
-    }
-    from django.db.models import Sum
-    amount_paid = invoice_obj.payment_histories.aggregate(Sum('amount', default=0))['amount__sum']
-    amount_paid = amount_paid or 0
-    total_amount = sum(d['total_price'] for d in data['items'])
-    data['amount_paid'] = amount_paid
-    data['balance_due'] = total_amount - amount_paid
-    if data['invoice']['lead_id']:
-        data['lead'] = LeadDetailCreateSerializer(LeadDetail.objects.get(pk=data['invoice']['lead_id']),
-                                                  context={'request': request}).data
-    return Response(status=status.HTTP_201_CREATED, data={**data, **serializer.data})
+    elif invoice_obj.status != Invoice.InvoiceStatus.DRAFT:
+        snapshot = store_template_document(request, invoice_obj, template_obj)
+        return snapshot.get_response(request, status=status.HTTP_201_CREATED)
+    return Response(status=status.HTTP_201_CREATED, data=get_template_data(request, invoice_obj, template_obj))
 
 
 Contact = apps.get_model('sales', 'Contact')
@@ -162,6 +214,7 @@ def publish_template(request, pk):
     serializer.is_valid(raise_exception=True)
     template_obj.printed = serializer.validated_data['printed']
     template_obj.save()
+    store_template_document(request, invoice_obj, template_obj)
     contacts = Contact.objects.filter(id__in=template_obj.contacts).distinct()
     for contact in contacts:
         url = f'{settings.BASE_URL}{request.data["path"]}'
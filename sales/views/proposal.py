@@ -1,31 +1,40 @@
+import hashlib
 import uuid
+from collections import defaultdict
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
 from django.http import Http404
-from django.shortcuts import get_object_or_404, render
+from django.shortcuts import get_object_or_404
 from django.template.loader import render_to_string
 from django.utils.crypto import get_random_string
 from django_filters import rest_framework as filters
 from django.apps import apps
 from django.utils import timezone
 from openpyxl.reader.excel import load_workbook
-from rest_framework import generics, permissions, filters as rf_filters, status
+from rest_framework import generics, permissions, filters as rf_filters, serializers, status
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
 from api.middleware import get_request
 from base.constants import DEFAULT_NOTE, INTRO
+from base.models.config import DocumentSnapshot
 from base.permissions import ProposalPermissions
 from base.serializers.config import CompanySerializer
 from base.utils import file_response, pop
 from base.views.base import CompanyFilterMixin
-from base.tasks import celery_send_mail, export_proposal, send_mail_with_attachment
+from base.tasks import celery_send_mail, mail_signed_document, send_mail_with_attachment, start_export_proposal, start_mail_pdfs
+from sales.cloning import clone_proposal
 from sales.filters.proposal import PriceComparisonFilter, ProposalWritingFilter, ProposalTemplateFilter
 from sales.models import ProposalTemplate, PriceComparison, ProposalFormatting, ProposalWriting, POFormula, \
     ProposalFormattingSign, ProposalSetting
 from sales.models.estimate import EstimateTemplate
-from sales.models.lead_list import ActivitiesLog
-from sales.models.proposal import ProposalStatus
+from sales.models.lead_list import ActivitiesLog, LeadDetail
+from sales.models.proposal import GroupByEstimate, PROPOSAL_DOCUMENT_KEY, PROPOSAL_HTML_KEY, ProposalStatus
 from sales.serializers.catalog import CatalogImageSerializer
 from sales.serializers.estimate import EstimateTemplateForFormattingSerializer, EstimateTemplateForInvoiceSerializer, POFormulaDataSerializer, POFormulaForInvoiceSerializer
 from sales.serializers.proposal import FormatEstimateSerializer, FormatFormulaSerializer, ProposalFormattingTemplateMinorSerializer, ProposalTemplateSerializer, PriceComparisonSerializer, \
@@ -38,6 +47,10 @@ from sales.views.estimate import ALL_ESTIMATE_PREFETCH_RELATED
 PROPOSAL_GROUP_PREFETCH_RELATED = ['estimate_templates__' + i for i in ALL_ESTIMATE_PREFETCH_RELATED]
 PROPOSAL_PREFETCH_RELATED = ['writing_groups__' + i for i in PROPOSAL_GROUP_PREFETCH_RELATED]
 PRICE_COMPARISION_PREFETCH_RELATED = ['groups__' + i for i in PROPOSAL_GROUP_PREFETCH_RELATED]
+TEMPLATE_GROUPS_CACHE_KEY = 'proposal-template-groups-{}-{}'
+TEMPLATE_GROUPS_CACHE_TIMEOUT = 60 * 60 * 24
+TEMPLATE_SECTIONS = {GroupByEstimate.Type.GENERAL: 'General', GroupByEstimate.Type.ADD_ON: 'Optional Add-on Services',
+                     GroupByEstimate.Type.ADDITIONAL_COST: 'Additional Costs'}
 
 
 class ProposalTemplateGenericView(CompanyFilterMixin, generics.ListCreateAPIView):
@@ -196,6 +209,15 @@ def get_table_formatting(request, pk):
     return Response(status=status.HTTP_200_OK, data=data)
 
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated & ProposalPermissions])
+def calculate_proposal(request, pk):
+    """Evaluate the formulas of every estimate of a proposal, save the results when save is true"""
+    proposal = get_object_or_404(ProposalWriting.objects.filter(company=request.user.company), pk=pk)
+    data = proposal.calculate(save=serializers.BooleanField().to_internal_value(request.data.get('save', False)))
+    return Response(status=status.HTTP_200_OK, data=data)
+
+
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated & ProposalPermissions])
 def get_image(request, pk):
@@ -253,9 +275,8 @@ def proposal_formatting_view(request, pk):
     return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-@api_view(['GET', 'PUT'])
-def proposal_formatting_v2_view(request, pk):
-    proposal_writing = get_object_or_404(ProposalWriting.objects.all(), pk=pk)
+def get_formatting_data(proposal_writing):
+    """Company, proposal setting and fields sent with the formatting of a proposal"""
     all_formula_fields = ['id', 'name', 'linked_description', 'formula', 'quantity', 'markup', 'charge', 'material', 'unit',
                          'unit_price', 'cost', 'total_cost', 'gross_profit', 'description_of_formula', 'formula_scenario']
     company = proposal_writing.company
@@ -270,17 +291,37 @@ def proposal_formatting_v2_view(request, pk):
         )
     company_data = CompanySerializer(company).data
     all_format_fields = ['id', 'name', 'description', 'unit', 'quantity', 'total_price', 'unit_price']
-    data = {'all_format_fields': all_format_fields, 'company': company_data,
+    return {'all_format_fields': all_format_fields, 'company': company_data,
             'all_formula_fields': all_formula_fields,
             'status': proposal_writing.status,
             'proposal_setting': ProposalSettingSerializer(proposal_setting).data}
+
+
+def store_formatting_document(request, proposal_writing):
+    """Render the formatting of a published proposal and store it as the snapshot served to clients"""
+    proposal_formatting = ProposalFormatting.objects.get_or_create(proposal_writing=proposal_writing)[0]
+    serializer = ProposalFormattingTemplateMinorSerializer(proposal_formatting, context={'request': request})
+    content = JSONRenderer().render({**serializer.data, **get_formatting_data(proposal_writing)})
+    return DocumentSnapshot.store(PROPOSAL_DOCUMENT_KEY.format(proposal_writing.pk), content, proposal_writing.company)
+
+
+@api_view(['GET', 'PUT'])
+def proposal_formatting_v2_view(request, pk):
+    if request.method == 'GET':
+        # Published proposals are served from their snapshot
+        snapshot = DocumentSnapshot.objects.filter(key=PROPOSAL_DOCUMENT_KEY.format(pk)).first()
+        if snapshot:
+            return snapshot.get_response(request)
+    proposal_writing = get_object_or_404(ProposalWriting.objects.all(), pk=pk)
     if request.method == 'GET':
+        if proposal_writing.status != ProposalStatus.DRAFT:
+            return store_formatting_document(request, proposal_writing).get_response(request)
         try:
             proposal_formatting = ProposalFormatting.objects.get(proposal_writing=proposal_writing)
         except ProposalFormatting.DoesNotExist:
             proposal_formatting = ProposalFormatting.objects.create(proposal_writing=proposal_writing)
         serializer = ProposalFormattingTemplateMinorSerializer(proposal_formatting, context={'request': request})
-        return Response(status=status.HTTP_200_OK, data={**serializer.data, **data})
+        return Response(status=status.HTTP_200_OK, data={**serializer.data, **get_formatting_data(proposal_writing)})
 
     if request.method == 'PUT':
         proposal_formatting = ProposalFormatting.objects.get(proposal_writing=proposal_writing)
@@ -305,7 +346,7 @@ def proposal_formatting_v2_view(request, pk):
         serializer = ProposalFormattingTemplateMinorSerializer(proposal_formatting, data=request.data, context={'request': request})
         serializer.is_valid()
         serializer.save()
-        return Response(status=status.HTTP_200_OK, data={**serializer.data, **data})
+        return Response(status=status.HTTP_200_OK, data={**serializer.data, **get_formatting_data(proposal_writing)})
     return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -321,13 +362,31 @@ def reset_formatting(request, pk):
     return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+def store_formatting_html(proposal_formatting):
+    """Render the page of a formatting from its element, stored as the snapshot served to clients once published"""
+    content = render_to_string('proposal_formatting.html', context={'javascript_code': proposal_formatting.element})
+    proposal_writing = proposal_formatting.proposal_writing
+    return DocumentSnapshot.store(PROPOSAL_HTML_KEY.format(proposal_formatting.pk), content, proposal_formatting.company,
+                                  'text/html; charset=utf-8',
+                                  save=bool(proposal_writing and proposal_writing.status != ProposalStatus.DRAFT))
+
+
+def get_proposal_html(request, pk):
+    """Snapshot of the page of the formatting of a proposal and the name of its PDF"""
+    proposal_formatting = ProposalFormatting.objects.select_related('proposal_writing').get(proposal_writing=pk)
+    snapshot = DocumentSnapshot.objects.filter(key=PROPOSAL_HTML_KEY.format(proposal_formatting.pk)).first()
+    return snapshot or store_formatting_html(proposal_formatting), f'{proposal_formatting.proposal_writing.name}.pdf'
+
+
 def view_proposal_formatting(request, formatting_id):
+    snapshot = DocumentSnapshot.objects.filter(key=PROPOSAL_HTML_KEY.format(formatting_id)).first()
+    if snapshot:
+        return snapshot.get_response(request)
     try:
-        data_proposal = ProposalFormatting.objects.get(id=formatting_id)
+        data_proposal = ProposalFormatting.objects.select_related('proposal_writing').get(id=formatting_id)
     except ProposalFormatting.DoesNotExist:
         raise Http404("ProposalFormatting does not exist")
-    data_html = data_proposal.element
-    return render(request, 'proposal_formatting.html', context={'javascript_code': data_html})
+    return store_formatting_html(data_proposal).get_response(request)
 
 
 @api_view(['POST'])
@@ -342,20 +401,14 @@ def duplicate_proposal(request):
 
     if not name:
         return Response(status=status.HTTP_400_BAD_REQUEST, data={"name": ["This field is required"]})
-    proposal_ids = request.data.keys()
+    lead_ids = {lead for leads in request.data.values() for lead in leads if lead is not None}
+    if LeadDetail.objects.filter(pk__in=lead_ids).count() != len(lead_ids):
+        return Response(status=status.HTTP_400_BAD_REQUEST, data={"lead": ["Invalid pk - object does not exist."]})
     objs = []
-    for proposal_id in proposal_ids:
-        for lead in request.data[proposal_id]:
-            p = ProposalWriting.objects.get(pk=proposal_id)
-            serializer = ProposalWritingSerializer(p, context={'request': request}).data
-            temp = []
-            for contact in serializer['proposal_formatting']['contacts']:
-                temp.append(contact['id'])
-
-            serializer['proposal_formatting']['contacts'] = temp
-            dup = ProposalWritingSerializer(data=serializer, context={'request': request})
-            dup.is_valid(raise_exception=True)
-            objs.append(dup.save(lead_id=lead, name=name).id)
+    with transaction.atomic():
+        for proposal_id, leads in request.data.items():
+            proposal = get_object_or_404(ProposalWriting.objects.all(), pk=proposal_id)
+            objs.extend(copy.pk for copy in clone_proposal(proposal, leads, name))
     serializer = ProposalWritingCompactSerializer(ProposalWriting.objects.filter(id__in=objs),
                                                   many=True, context={'request': request})
     return Response(status=status.HTTP_201_CREATED, data=serializer.data)
@@ -382,6 +435,7 @@ def proposal_formatting_public(request, pk):
     proposal_writing.save(update_fields=['status'])
     ActivitiesLog.objects.create(lead=proposal_writing.lead, status='sent', type_id=proposal_writing.pk,
                                  title=f'{proposal_writing.name}', type='proposal', start_date=timezone.now())
+    store_formatting_document(request, proposal_writing)
     for contact in contacts:
         url = f'{settings.BASE_URL}{request.data["path"]}'
         if contact.pk == proposal_writing.proposal_formatting.primary_contact:
@@ -425,8 +479,13 @@ def proposal_sign(request, pk):
             files = request.data.getlist('file')
             contact = Contact.objects.get(pk=proposal_template.primary_contact)
             content = render_to_string('proposal-formatting-sign-otp-success.html', {'contact': contact})
-            send_mail_with_attachment(f'Sign Electronically OTP', content, settings.EMAIL_HOST_USER,
-                                      [contact.email], files)
+            if files:
+                send_mail_with_attachment(f'Sign Electronically OTP', content, settings.EMAIL_HOST_USER,
+                                          [contact.email], files)
+            else:
+                # The client sent no PDF, the worker renders the signed proposal and mails it
+                mail_signed_document.delay('proposal', proposal_writing.pk, proposal_writing.user_create_id,
+                                           f'Sign Electronically OTP', content, [contact.email])
             return Response(status=status.HTTP_200_OK, data={'data': 'Success'})
         else:
             return Response(status=status.HTTP_400_BAD_REQUEST, data={'data': 'Fail'})
@@ -463,11 +522,29 @@ def check_code_proposal_formatting_sign(request):
         return Response(status=status.HTTP_400_BAD_REQUEST, data={'data': 'code error'})
 
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated & ProposalPermissions])
+def send_proposal_pdfs(request):
+    """
+    Render proposals to PDF in background and mail each one to the contacts of its formatting
+    Payloads: {"proposals": [1, 2], "subject": "", "content": ""}
+    """
+    formattings = ProposalFormatting.objects.filter(proposal_writing__in=request.data.get('proposals', []),
+                                                    proposal_writing__company=request.user.company)
+    contacts = dict(Contact.objects.filter(pk__in={pk for f in formattings for pk in f.contacts or []}).values_list('pk', 'email'))
+    documents = [(f.proposal_writing_id, [contacts[pk] for pk in f.contacts or [] if contacts.get(pk)]) for f in formattings]
+    if not documents:
+        return Response(status=status.HTTP_400_BAD_REQUEST, data={'proposals': ['No proposal to send']})
+    process_mail = start_mail_pdfs('proposal', documents, request.user.pk, request.data.get('subject', ''),
+                                   request.data.get('content', ''))
+    return Response(status=status.HTTP_200_OK, data={'task_id': process_mail.id})
+
+
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated & ProposalPermissions])
 def export_proposal_view(request):
     user_id = request.user.id
-    process_export = export_proposal.delay(list_proposal=request.GET.getlist('pk'), user_id=user_id)
+    process_export = start_export_proposal(request.GET.getlist('pk'), user_id)
     task_id = process_export.id
 
     return Response(status=status.HTTP_200_OK, data={"task_id": task_id})
@@ -524,10 +601,8 @@ def reset_signature(request, pk):
 
 def get_data_template_group(estimates, tab):
     template_groups = []
-    for estimate in estimates:
-        estimate.get_info()
-        estimate_data = FormatEstimateSerializer(estimate).data
-        del estimate_data['formulas']
+    estimates = EstimateTemplate.resolve_info(EstimateTemplate.resolve_quantities(estimates))
+    for estimate_data in FormatEstimateSerializer(estimates, many=True, context={'formulas': False}).data:
         estimate_data['section'] = tab
         estimate_data['is_formula'] = False
         template_groups.append(estimate_data)
@@ -538,62 +613,75 @@ def get_data(type, items):
     return {'name': 'Unassigned', 'id': uuid.uuid4(), 'type': type, 'can_edit': False, 'items': items}
 
 
+def get_template_items(estimate_ids, company):
+    """
+    Estimate and formula items of the template groups of a proposal, by type of group, read from the estimates
+    of {type: [estimate id]} without persisting anything.
+    Cached per set of estimate versions (see EstimateTemplate.get_versions).
+    """
+    estimates = EstimateTemplate.objects.filter(company=company, pk__in={pk for ids in estimate_ids.values() for pk in ids})
+    versions = EstimateTemplate.get_versions(estimates)
+    estimate_ids = {type: [pk for pk in ids if pk in versions] for type, ids in estimate_ids.items()}
+    key = repr(sorted((type, [(pk, versions[pk]) for pk in ids]) for type, ids in estimate_ids.items()))
+    key = TEMPLATE_GROUPS_CACHE_KEY.format(company.pk if company else None, hashlib.md5(key.encode()).hexdigest())
+    items = cache.get(key)
+    if items is not None:
+        return items
+
+    estimates = {estimate.pk: estimate for estimate in estimates.select_related('unit')}
+    formulas = defaultdict(list)
+    for formula in POFormula.objects.filter(assemble__estimate_templates__in=versions).annotate(
+        estimate_pk=F('assemble__estimate_templates')
+    ).order_by('pk'):
+        formulas[formula.estimate_pk].append(formula)
+
+    items = {}
+    for type, ids in estimate_ids.items():
+        section = TEMPLATE_SECTIONS[type]
+        # An assemble linked to many estimates of the group has its formulas once, named after the first estimate
+        type_formulas, estimate_names = {}, {}
+        for pk in ids:
+            for formula in formulas[pk]:
+                type_formulas.setdefault(formula.pk, formula)
+                estimate_names.setdefault(formula.assemble_id, estimates[pk].name)
+        type_formulas = sorted(type_formulas.values(), key=lambda formula: formula.pk)
+        items[type] = {
+            'estimates': get_data_template_group([estimates[pk] for pk in ids], section),
+            'formulas': FormatFormulaSerializer(type_formulas, many=True, context={'estimate_names': estimate_names}).data,
+        }
+    cache.set(key, items, TEMPLATE_GROUPS_CACHE_TIMEOUT)
+    return items
+
+
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated & ProposalPermissions])
 def parse_template(request):
-    #  Get Proposal Serializer
-    data = request.data
-    data['name'] = 'Template'
-    serializer = ProposalWritingSerializer(data=request.data, context={'request': request})
-    serializer.is_valid(raise_exception=True)
-    proposal_writing = serializer.save(is_show=False)
-    template_groups = {'estimates': {'General': [], 'Optional Add-on Services': [], 'Additional Costs': []},
-                       'formulas': {'General': [], 'Optional Add-on Services': [], 'Additional Costs': []}}
-    #  Get Proposal Formatting
-    general_estimates = proposal_writing.get_estimates(type=0)
-    template_groups['estimates']['General'].append(get_data('estimates', get_data_template_group(general_estimates, 'General')))
-    general_items = FormatFormulaSerializer(proposal_writing.get_formulas(0), many=True).data
-    template_groups['formulas']['General'].append(get_data('formulas', general_items))
-
-    add_on_estimates = proposal_writing.get_estimates(type=1)
-    template_groups['estimates']['Optional Add-on Services'].append(
-        get_data('estimates', get_data_template_group(add_on_estimates, 'Optional Add-on Services'))
-    )
-    service_items = FormatFormulaSerializer(proposal_writing.get_formulas(1), many=True).data
-    template_groups['formulas']['Optional Add-on Services'].append(get_data('formulas', service_items))
-
-    additional_estimates = proposal_writing.get_estimates(type=2)
-    template_groups['estimates']['Additional Costs'].append(get_data('estimates', get_data_template_group(additional_estimates, 'Additional Costs')))
-    addon_items = FormatFormulaSerializer(proposal_writing.get_formulas(2), many=True).data
-    template_groups['formulas']['Additional Costs'].append(get_data('formulas', addon_items))
-
-    for formula in general_items:
-        if formula['catalog_name']:
-            template_groups[formula['catalog_name']] = {
-                'General': [{'name': 'Unassigned', 'id': uuid.uuid4(), 'type': 'formulas', 'items': []}],
-                'Optional Add-on Services': [{'name': 'Unassigned', 'id': uuid.uuid4(), 'type': 'formulas', 'items': []}],
-                'Additional Costs': [{'name': 'Unassigned', 'id': uuid.uuid4(), 'type': 'formulas', 'items': []}]}
-    for formula in service_items:
-        if formula['catalog_name']:
-            template_groups[formula['catalog_name']] = {
-                'General': [{'name': 'Unassigned', 'id': uuid.uuid4(), 'type': 'formulas', 'items': []}],
-                'Optional Add-on Services': [{'name': 'Unassigned', 'id': uuid.uuid4(), 'type': 'formulas', 'items': []}],
-                'Additional Costs': [{'name': 'Unassigned', 'id': uuid.uuid4(), 'type': 'formulas', 'items': []}]}
-    for formula in addon_items:
-        if formula['catalog_name']:
-            template_groups[formula['catalog_name']] = {
-                'General': [{'name': 'Unassigned', 'id': uuid.uuid4(), 'type': 'formulas', 'items': []}],
-                'Optional Add-on Services': [{'name': 'Unassigned', 'id': uuid.uuid4(), 'type': 'formulas', 'items': []}],
-                'Additional Costs': [{'name': 'Unassigned', 'id': uuid.uuid4(), 'type': 'formulas', 'items': []}]}
-
-    for formula in general_items:
-        if formula['catalog_name']:
-            template_groups[formula['catalog_name']]['General'][0]['items'].append(formula)
-    for formula in service_items:
-        if formula['catalog_name']:
-            template_groups[formula['catalog_name']]['Optional Add-on Services'][0]['items'].append(formula)
-    for formula in addon_items:
-        if formula['catalog_name']:
-            template_groups[formula['catalog_name']]['Additional Costs'][0]['items'].append(formula)
-    proposal_writing.delete()
+    estimate_ids = {type: [] for type in TEMPLATE_SECTIONS}
+    try:
+        for group in request.data.get('writing_groups') or []:
+            ids = estimate_ids[int(group.get('type') or GroupByEstimate.Type.GENERAL)]
+            for estimate_template in group.get('estimate_templates') or []:
+                pk = int(estimate_template['id'])
+                if pk not in ids:
+                    ids.append(pk)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise ValidationError({'writing_groups': 'Groups must have a valid type and estimates with an id'})
+    items = get_template_items(estimate_ids, request.user.company)
+
+    template_groups = {'estimates': {section: [] for section in TEMPLATE_SECTIONS.values()},
+                       'formulas': {section: [] for section in TEMPLATE_SECTIONS.values()}}
+    for type, section in TEMPLATE_SECTIONS.items():
+        template_groups['estimates'][section].append(get_data('estimates', items[type]['estimates']))
+        template_groups['formulas'][section].append(get_data('formulas', items[type]['formulas']))
+    for type in TEMPLATE_SECTIONS:
+        for formula in items[type]['formulas']:
+            if formula['catalog_name']:
+                template_groups[formula['catalog_name']] = {
+                    section: [{'name': 'Unassigned', 'id': uuid.uuid4(), 'type': 'formulas', 'items': []}]
+                    for section in TEMPLATE_SECTIONS.values()
+                }
+    for type, section in TEMPLATE_SECTIONS.items():
+        for formula in items[type]['formulas']:
+            if formula['catalog_name']:
+                template_groups[formula['catalog_name']][section][0]['items'].append(formula)
     return Response(status=status.HTTP_200_OK, data=template_groups)